@@ -24,12 +24,13 @@ from .import_export import (
     LedgerBalanceImportExport, LedgerPLImportExport, LedgerICImportExport
 )
 from .mixins import copy_entity, make_installment_payment
+from .process import OrderStatusSync
 from .models import (
     Article, FiscalPeriod, LedgerAccount, LedgerBalance, LedgerPL, LedgerIC
 )
 
 from . import forms, models
-from . import api_cash_ctrl, connector_cash_ctrl as conn
+from . import connector_cash_ctrl as conn
 from .ledger import LoadLedgerBalance, LoadFunctionalLedger
 
 
@@ -204,7 +205,7 @@ def sync_accounting(modeladmin, request, queryset):
         for instance in queryset.all():
             if not instance.is_enabled_sync:
                 instance.is_enabled_sync = True
-                instance.sync_accounting = True
+                instance.sync_to_accounting = True
                 instance.save()
 
 
@@ -250,23 +251,13 @@ def incoming_order_approve(modeladmin, request, queryset):
 
 @admin.action(description=_("Get Order Status"))
 def order_get_status(modeladmin, request, queryset):
-    ''' filtering not working so we must read all orders
-    '''
+    ''' read status from cashCtrl, see process.OrderStatusSync '''
     if action_check_nr_selected(request, queryset, min_count=1):
-        # prepare
-        item = queryset.first()
-        status_list = [x for x in item.category.STATUS]
-        status_ids = [x['id'] for x in item.category.status_data]
-
-        # get from cashCtrl
-        api = api_cash_ctrl.Order(
-            item.tenant.cash_ctrl_org_name,
-            item.tenant.cash_ctrl_api_key)
-        for order in queryset.all():
-            invoice = api.read(order.c_id)
-            index = status_ids.index(invoice['status_id'])
-            order.status = status_list[index]
-            order.save()
+        tenant = queryset.first().tenant
+        count = OrderStatusSync(modeladmin.model, tenant).run(queryset)
+        msg = _("Status: {updated} updated, {unchanged} unchanged, "
+                "{failed} not found.").format(**count)
+        messages.success(request, msg)
 
 
 @action_with_form(
@@ -3,10 +3,12 @@ accounting/api_cash_ctrl.py
 
 central file for communication to cash ctrl
 '''
+from collections import Counter
 from datetime import datetime
 from decimal import Decimal
 from enum import Enum
-from time import sleep
+from threading import Lock
+from urllib.parse import urlparse
 
 import json
 import logging
@@ -16,12 +18,25 @@ import pytz
 import re
 import requests
 import xmltodict
+from requests.adapters import HTTPAdapter
+
+from .api_rate_limit import get_limiter, RATE, BURST
 
 
 DECODE = 'utf-8'
 TIMEZONE = pytz.timezone('Europe/Zurich')
 URL_ROOT = "https://{org}.cashctrl.com"
 
+# Connection pooling
+POOL_SIZE = 10  # max. keep-alive connections per org
+PAGE_SIZE = 500  # records per request in list_paged
+
+_sessions = {}  # org -> requests.Session
+_sessions_lock = Lock()
+
+# requests sent, e.g. {'GET account/list.json': 3}
+request_counter = Counter()
+
 
 # Standard Accounts
 """
@@ -294,6 +309,45 @@ def slugify_filename(filename):
     return filename
 
 
+# Sessions
+def get_session(org, pool_size=None):
+    '''
+    return the shared keep-alive session of org, all CashCtrl instances of
+    the same org use the same connection pool
+    '''
+    with _sessions_lock:
+        session = _sessions.get(org)
+        if session is None:
+            pool_size = pool_size or POOL_SIZE
+            adapter = HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[org] = session
+        return session
+
+
+def close_sessions():
+    ''' close all pooled connections, e.g. at the end of a command '''
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def get_operation(method, url):
+    ''' e.g. 'GET account/list.json' '''
+    path = urlparse(url).path
+    if '/api/v1/' in path:
+        path = path.split('/api/v1/', 1)[1]
+    return f"{method.upper()} {path}"
+
+
+def reset_request_counter():
+    request_counter.clear()
+
+
 # Xml <-> JSON
 def clean_value(value):
     ''' use cashctrl <values> xml and remove <values> '''
@@ -406,7 +460,11 @@ class CashCtrl():
 
     # Rate-limiting constants
     MAX_TRIES = 5  # Maximum number of retries
-    SLEEP_DURATION = 2  # Sleep duration between retries in second
+    RATE = RATE  # requests per second and org
+    BURST = BURST  # max. requests sent at once
+
+    # Connection pool size of the shared org session
+    POOL_SIZE = POOL_SIZE
 
     def __init__(
             self, org, api_key, language='en', convert_dt=True,
@@ -421,6 +479,10 @@ class CashCtrl():
         self.timezone = timezone
         self.convert_dt = convert_dt
 
+        # Session and rate limiter, shared by all instances of org
+        self.session = get_session(org, self.POOL_SIZE)
+        self.limiter = get_limiter(org, self.RATE, self.BURST)
+
         # Data
         self.data = None  # data can be loaded (list, read) or posted
 
@@ -428,6 +490,23 @@ class CashCtrl():
         ''' defined in child class '''
         return getattr(self, 'url')
 
+    def _request(self, method, url, limit=True, **kwargs):
+        ''' send request via the pooled session and count it
+            limit: wait for the org rate limiter, False for non cashCtrl urls
+        '''
+        if limit:
+            self.limiter.acquire()
+        request_counter[get_operation(method, url)] += 1
+        return self.session.request(method, url, **kwargs)
+
+    def _backoff(self, response, attempt, method, url):
+        ''' register 429 response, the next acquire() waits '''
+        wait = self.limiter.backoff(
+            attempt, response.headers.get('Retry-After'))
+        logging.info(
+            f"{method} rate limit hit for {url}, retrying in {wait:.1f}s "
+            f"(Attempt {attempt + 2})...")
+
     # REST API CashCtrl: post, get
     def get(self, url, params, timeout=10):
         '''
@@ -439,18 +518,16 @@ class CashCtrl():
 
         if params.get('filter'):
             params['filter'] = json.dumps(params['filter'])
-        response = requests.get(
-            url, params=params, auth=self.auth, timeout=timeout)
 
         for attempt in range(self.MAX_TRIES):
             try:
-                response = requests.get(
-                    url, params=params, auth=self.auth, timeout=timeout
+                response = self._request(
+                    'GET', url, params=params, auth=self.auth,
+                    timeout=timeout
                 )
 
                 if response.status_code == 429:
-                    logging.info("GET rate limit hit. Retrying...")
-                    sleep(self.SLEEP_DURATION)
+                    self._backoff(response, attempt, 'GET', url)
                     continue
 
                 response.raise_for_status()
@@ -461,10 +538,6 @@ class CashCtrl():
             except requests.exceptions.RequestException as e:
                 raise Exception(f"GET request error: {e}")
 
-            if attempt < self.MAX_TRIES - 1:
-                logging.info(f"Retrying GET request to {url} (Attempt {attempt + 2})...")
-                sleep(self.SLEEP_DURATION)
-
         raise Exception(
             f"Maximum retry attempts ({self.MAX_TRIES}) reached for GET request to '{url}'."
         )
@@ -492,14 +565,13 @@ class CashCtrl():
         # Retry mechanism for rate-limiting
         for attempt in range(self.MAX_TRIES):
             try:
-                response = requests.post(
-                    url, params=params, data=post_data,
+                response = self._request(
+                    'POST', url, params=params, data=post_data,
                     auth=self.auth, timeout=timeout
                 )
 
                 if response.status_code == 429:  # Rate limit
-                    logging.info("Rate limit reached. Retrying...")
-                    sleep(self.SLEEP_DURATION)
+                    self._backoff(response, attempt, 'POST', url)
                     continue
 
                 if not response.ok:
@@ -525,13 +597,6 @@ class CashCtrl():
                 raise Exception(
                     f"An error occurred during the POST request: {e}")
 
-            # Sleep before retrying if it's not the last attempt
-            if attempt < self.MAX_TRIES - 1:
-                logging.info(
-                    f"Retrying POST request to {url} "
-                    f"(Attempt {attempt + 2})...")
-                sleep(self.SLEEP_DURATION)
-
         # Raise an exception if all attempts fail
         raise Exception(
             f"Maximum retry attempts ({self.MAX_TRIES}) reached for POST "
@@ -554,8 +619,8 @@ class CashCtrl():
         files = json.dumps([{'name': file_name, 'mimeType': mime_type}])
 
         # Raise and process the response
-        response = requests.post(
-            url, auth=self.auth, files={'files': (None, files)})
+        response = self._request(
+            'POST', url, auth=self.auth, files={'files': (None, files)})
         response_data = response.json()
         if not response_data.get('success'):
             raise Exception('Failed to prepare file upload')
@@ -566,7 +631,8 @@ class CashCtrl():
 
         # Step 2: Put (Upload the file)
         with open(file_path, 'rb') as f:
-            put_response = requests.put(write_url, data=f)
+            put_response = self._request(
+                'PUT', write_url, limit=False, data=f)
 
         if put_response.status_code != 200:
             raise Exception('Failed to upload file')
@@ -575,8 +641,8 @@ class CashCtrl():
         # Step 3: Persist
         persist_url = (
             f'https://{self.org}.cashctrl.com/api/v1/file/persist.json')
-        persist_response = requests.post(
-            persist_url, auth=self.auth, data={'ids': file_id})
+        persist_response = self._request(
+            'POST', persist_url, auth=self.auth, data={'ids': file_id})
 
         if not persist_response.json().get('success'):
             raise Exception('Failed to persist file')
@@ -591,8 +657,8 @@ class CashCtrl():
         params = {'id': file_id}
         url = self.BASE_DIR.format(
             org=self.org, url=self.url, action='get')
-        response = requests.get(
-            url, auth=self.auth, params=params, allow_redirects=True)
+        response = self._request(
+            'GET', url, auth=self.auth, params=params, allow_redirects=True)
 
         if response.status_code == 200:
             # If output_path is a directory, use file_id as the filename
@@ -617,6 +683,20 @@ class CashCtrl():
         ]
         return self.data
 
+    def list_paged(self, params=None, limit=PAGE_SIZE):
+        ''' cash_ctrl list, page by page for large lists '''
+        params = params or {}
+        data, start = [], 0
+        while True:
+            page = self.list(dict(params, start=start, limit=limit))
+            data.extend(page)
+            if len(page) < limit:
+                break
+            start += limit
+
+        self.data = data
+        return self.data
+
     def read(self, id=None, params=None):
         """ Fetch a single entry by ID. """
         # Init params
@@ -1066,7 +1146,7 @@ class OrderPayment(CashCtrl):
         url = self.BASE_DIR.format(
             org=self.org, url=self.url, action='download')
         print("*url", url)
-        response = requests.get(url, auth=self.auth, params=params)
+        response = self._request('GET', url, auth=self.auth, params=params)
 
         # Check response status
         if response.status_code == 200:
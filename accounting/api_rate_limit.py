@@ -0,0 +1,192 @@
+'''
+accounting/api_rate_limit.py
+
+rate limiting for the cashCtrl api
+
+Every request first takes a token from the per org token bucket. Within one
+process the bucket is guarded by a lock; across processes the requests per
+second are counted in the django cache (if django is configured), so all
+workers of an org stay together below the api quota.
+'''
+from threading import Lock
+from time import monotonic, sleep, time
+
+import logging
+import random
+
+
+logger = logging.getLogger(__name__)
+
+# Defaults, cashCtrl allows only a few requests per second and org
+RATE = 4  # requests per second
+BURST = 8  # bucket capacity
+BACKOFF_BASE = 1  # seconds, doubled with every retry
+BACKOFF_MAX = 30  # seconds
+CACHE_PREFIX = 'cash_ctrl_rate'
+
+_limiters = {}  # org -> RateLimiter
+_limiters_lock = Lock()
+
+
+def get_shared_cache():
+    ''' return django cache if available, otherwise None (local only) '''
+    try:
+        from django.conf import settings
+        if not settings.configured:
+            return None
+        from django.core.cache import cache
+        return cache
+    except ImportError:
+        return None
+
+
+def parse_retry_after(value):
+    ''' Retry-After header in seconds; http dates are not sent by cashCtrl '''
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    '''
+    Token bucket limiter with adaptive backoff
+
+    :org: cashCtrl org, one bucket per org
+    :rate: tokens refilled per second
+    :burst: capacity of the bucket
+    :cache: django cache to share the quota across processes, None for
+        local limiting only
+    '''
+    def __init__(self, org, rate=RATE, burst=BURST, cache=None):
+        self.org = org
+        self.rate = rate
+        self.burst = burst
+        self.cache = cache
+
+        # Bucket
+        self.lock = Lock()
+        self.tokens = burst
+        self.updated = monotonic()
+        self.blocked_until = 0  # epoch, set by 429 responses
+
+        # Metrics
+        self.started = time()
+        self.requests = 0
+        self.retries = 0
+        self.throttled_time = 0
+
+    # keys
+    def _key(self, name):
+        return f'{CACHE_PREFIX}:{self.org}:{name}'
+
+    def _reserve(self):
+        ''' take one token, return seconds to wait until it is available '''
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1  # may get negative, i.e. reserved for later
+            self.requests += 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def _wait_blocked(self):
+        ''' seconds to wait because of a Retry-After of any process '''
+        blocked_until = self.blocked_until
+        if self.cache is not None:
+            blocked_until = max(
+                blocked_until, self.cache.get(self._key('blocked'), 0))
+        return max(blocked_until - time(), 0)
+
+    def _wait_shared(self):
+        ''' seconds to wait for the shared quota of the current second '''
+        if self.cache is None:
+            return 0
+
+        second = int(time())
+        key = self._key(second)
+        self.cache.add(key, 0, timeout=5)
+        try:
+            count = self.cache.incr(key)
+        except ValueError:
+            return 0  # key expired in between, do not block
+        if count > self.rate:
+            return second + 1 - time()
+        return 0
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            with self.lock:
+                self.throttled_time += seconds
+            sleep(seconds)
+
+    def acquire(self):
+        ''' block until the next request of the org may be sent '''
+        self._sleep(self._wait_blocked())
+        self._sleep(self._reserve())
+        while True:
+            wait = self._wait_shared()
+            if not wait:
+                break
+            self._sleep(wait)
+
+    def backoff(self, attempt, retry_after=None):
+        '''
+        register a rate limit response and return seconds to wait,
+        Retry-After if given, otherwise exponential backoff with jitter
+        '''
+        wait = parse_retry_after(retry_after)
+        if wait is None:
+            wait = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+            wait = random.uniform(wait / 2, wait)
+
+        # Block all requests of the org
+        blocked_until = time() + wait
+        with self.lock:
+            self.retries += 1
+            self.blocked_until = max(self.blocked_until, blocked_until)
+            self.tokens = min(self.tokens, 0)  # empty bucket
+        if self.cache is not None:
+            self.cache.set(
+                self._key('blocked'), blocked_until, timeout=int(wait) + 1)
+
+        logger.info(f"{self.org}: rate limit hit, waiting {wait:.1f}s.")
+        return wait
+
+    def metrics(self):
+        ''' return throttled time, retries and achieved requests / second '''
+        elapsed = time() - self.started
+        return {
+            'org': self.org,
+            'requests': self.requests,
+            'retries': self.retries,
+            'throttled_time': round(self.throttled_time, 3),
+            'requests_per_second': (
+                round(self.requests / elapsed, 3) if elapsed else 0)
+        }
+
+    def reset_metrics(self):
+        with self.lock:
+            self.started = time()
+            self.requests = 0
+            self.retries = 0
+            self.throttled_time = 0
+
+
+def get_limiter(org, rate=RATE, burst=BURST):
+    ''' return the limiter of org, shared by all api instances '''
+    with _limiters_lock:
+        limiter = _limiters.get(org)
+        if limiter is None:
+            limiter = RateLimiter(org, rate, burst, cache=get_shared_cache())
+            _limiters[org] = limiter
+        return limiter
+
+
+def get_metrics():
+    ''' metrics of all orgs used in this process '''
+    with _limiters_lock:
+        return [limiter.metrics() for limiter in _limiters.values()]
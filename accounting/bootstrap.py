@@ -0,0 +1,268 @@
+'''
+accounting/bootstrap.py
+
+Accounting setup of a tenant in cashCtrl (called by
+signals_cash_ctrl.tenant_accounting_post_save)
+
+Steps:
+- uploads in dependency order: core data, CustomFieldGroup, CustomField,
+  ArticleCategory, FileCategory, OrderLayout
+- downloads: all lists are fetched in parallel, then stored in dependency
+  order (e.g. AccountCategory before Account)
+- uploads depending on downloads: AccountCategory, Collection, Element
+
+Every finished step is stored in TenantSetupStep; after a failure the setup
+can be run again and continues with the first unfinished step.
+In async mode a step saves its records and outbox rows in one transaction
+and uploads its own rows afterwards. Inline uploads are not wrapped in a
+transaction: every record keeps its c_id once created in cashCtrl, so a
+rerun updates instead of creating duplicates.
+'''
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+import logging
+
+from django.db import transaction
+
+from asset.models import Unit, AssetCategory
+from core.models import Title, PersonCategory
+from scerp.mixins import read_yaml_file
+from . import connector_cash_ctrl as conn
+from . import models, outbox
+
+
+logger = logging.getLogger(__name__)
+
+ACCOUNT_SETUP_YAML = 'init_tenant.yaml'
+WORKERS = 4  # parallel downloads, the rate limiter paces them
+
+# core data shifted to accounting
+CORE_MODELS = (
+    Title,
+    PersonCategory,
+    Unit,
+    AssetCategory,
+)
+
+# in order of dependency, e.g. Account needs AccountCategory
+DOWNLOADS = (
+    (conn.Location, models.Location),
+    (conn.FiscalPeriod, models.FiscalPeriod),
+    (conn.Currency, models.Currency),
+    (conn.SequenceNumber, models.SequenceNumber),
+    (conn.CostCenterCategory, models.CostCenterCategory),
+    (conn.CostCenter, models.CostCenter),
+    (conn.AccountCategory, models.AccountCategory),
+    (conn.Account, models.Account),
+    (conn.Rounding, models.Rounding),
+    (conn.Setting, models.Setting),
+    (conn.Tax, models.Tax),
+    (conn.BankAccount, models.BankAccount),
+)
+
+
+class SetupError(Exception):
+    pass
+
+
+class TenantBootstrap:
+    '''
+    Setup accounting of tenant
+
+    :tenant: tenant with cash_ctrl_org_name and cash_ctrl_api_key
+    :restart: ignore finished steps and run all steps again
+    :workers: parallel downloads
+    '''
+    def __init__(self, tenant, restart=False, workers=WORKERS):
+        self.tenant = tenant
+        self.created_by = tenant.created_by
+        self.workers = workers
+        self.init_data = read_yaml_file('accounting', ACCOUNT_SETUP_YAML)
+        self.report = []  # (step, seconds), finished steps only
+
+        if restart:
+            models.TenantSetupStep.objects.filter(tenant=tenant).delete()
+        self.done = set(
+            models.TenantSetupStep.objects.filter(
+                tenant=tenant).values_list('step', flat=True))
+
+    # Helpers
+    def add_logging(self, data):
+        ''' add logging data to cashCtrl instances '''
+        data.update({
+            'created_by': self.created_by,
+            'sync_to_accounting': True,  # send to cashCtrl
+        })
+
+    def run_step(self, step, func, *args):
+        ''' run func unless already finished, store checkpoint '''
+        if step in self.done:
+            logger.info(f"{self.tenant}: {step} already done")
+            return
+
+        start = monotonic()
+        if outbox.is_async():
+            with outbox.collect() as ids, transaction.atomic():
+                func(*args)
+            self.flush(step, ids)
+        else:
+            func(*args)  # commit per record, remote creates are final
+        duration = monotonic() - start
+
+        models.TenantSetupStep.objects.update_or_create(
+            tenant=self.tenant, step=step, defaults={'duration': duration})
+        self.done.add(step)
+        self.report.append((step, round(duration, 3)))
+        logger.info(f"{self.tenant}: {step} done in {duration:.2f}s")
+
+    def flush(self, step, ids):
+        ''' upload the outbox rows of the step before the next step,
+            other pending rows of the tenant are left to the worker
+        '''
+        if not ids:
+            return
+
+        count = outbox.process_tenant(self.tenant.id, close=False, ids=ids)
+        if count['failed'] or count['skipped']:
+            raise SetupError(f"{step}: upload failed, {count}")
+
+    def update_or_create(self, model, key, data_list, **lookups):
+        ''' create or update records of init data, key is the identifier '''
+        for data in data_list:
+            data = dict(data, **lookups)
+            self.add_logging(data)
+            model.objects.update_or_create(
+                tenant=self.tenant, **{key: data.pop(key)}, defaults=data)
+        logger.info(f"saved {model.__name__}")
+
+    # Upload steps
+    def shift_core_data(self):
+        for model in CORE_MODELS:
+            queryset = model.objects.filter(
+                tenant=self.tenant, is_enabled_sync=False)
+            for obj in queryset.all():
+                obj.is_enabled_sync = True
+                obj.sync_to_accounting = True
+                obj.save()
+                logger.info(f"saved {obj}")
+
+    def create_custom_fields(self):
+        groups = {
+            group.code: group
+            for group in models.CustomFieldGroup.objects.filter(
+                tenant=self.tenant)
+        }
+        for data in self.init_data['CustomField']:
+            group = groups.get(data.get('group_ref'))
+            if not group:
+                raise SetupError(f"{data}: no group given")
+            self.update_or_create(
+                models.CustomField, 'code', [data], group=group)
+
+    def create_account_categories(self):
+        ''' ER / IR categories like 3.1, 4.1 etc. '''
+        parents = {
+            category.number: category
+            for category in models.AccountCategory.objects.filter(
+                tenant=self.tenant)
+        }
+        for data in self.init_data['AccountCategory']:
+            data = dict(data)
+            parent = parents.get(data.pop('parent_number'))
+            self.update_or_create(
+                models.AccountCategory, 'number', [data], parent=parent)
+
+    def create_elements(self):
+        collections = {
+            collection.code: collection
+            for collection in models.Collection.objects.filter(
+                tenant=self.tenant)
+        }
+        for data in self.init_data['Element']:
+            data = dict(data)
+            collection = collections.get(data.pop('collection_ref'))
+            if not collection:
+                raise SetupError(f"{data}: no collection given")
+            self.update_or_create(
+                models.Element, 'code', [data], collection=collection)
+
+    # Download steps
+    @staticmethod
+    def step_name(model):
+        return f"get_{model.__name__}"
+
+    def fetch(self, connector, model):
+        ''' download raw data, runs in thread, no db access '''
+        api = connector(model)._get_api(self.tenant)
+        if connector is conn.Setting:
+            return api.read()
+        return api.list({})
+
+    def store(self, connector, model, data):
+        ''' store downloaded data, we do not delete existing records '''
+        api = connector(model)
+        if connector is conn.Setting:
+            api.get(self.tenant, self.created_by, data=data)
+        else:
+            api.get(
+                self.tenant, self.created_by, delete_not_existing=False,
+                data_list=data)
+
+    def download(self):
+        downloads = [
+            (connector, model) for connector, model in DOWNLOADS
+            if self.step_name(model) not in self.done
+        ]
+        if not downloads:
+            return
+
+        # Fetch all in parallel, http only
+        start = monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [
+                executor.submit(self.fetch, connector, model)
+                for connector, model in downloads
+            ]
+            results = [future.result() for future in futures]
+        logger.info(
+            f"{self.tenant}: fetched {len(downloads)} lists in "
+            f"{monotonic() - start:.2f}s")
+
+        # Store in order of dependency
+        for (connector, model), data in zip(downloads, results):
+            self.run_step(
+                self.step_name(model), self.store, connector, model, data)
+
+    # Main
+    def run(self):
+        ''' run all steps, return list of (step, seconds) done now '''
+        init_data = self.init_data
+
+        # Upload
+        self.run_step('core_data', self.shift_core_data)
+        self.run_step(
+            'custom_field_group', self.update_or_create,
+            models.CustomFieldGroup, 'code', init_data['CustomFieldGroup'])
+        self.run_step('custom_field', self.create_custom_fields)
+        self.run_step(
+            'article_category', self.update_or_create,
+            models.ArticleCategory, 'code', init_data['ArticleCategory'])
+        self.run_step(
+            'file_category', self.update_or_create,
+            models.FileCategory, 'code', init_data['FileCategory'])
+        self.run_step(
+            'order_layout', self.update_or_create,
+            models.OrderLayout, 'name', init_data['OrderLayout'])
+
+        # Download
+        self.download()
+
+        # Upload, depending on downloads
+        self.run_step('account_category', self.create_account_categories)
+        self.run_step(
+            'collection', self.update_or_create,
+            models.Collection, 'code', init_data['Collection'])
+        self.run_step('element', self.create_elements)
+
+        logger.info(f"{self.tenant}: setup {self.report}")
+        return self.report
@@ -1,9 +1,17 @@
 '''
 accounting/connector_cash_ctrl.py
 '''
+import hashlib
+import json
+import logging
 import os
 import re
-from django.db.models import Q
+from collections import Counter
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max
 from django.forms.models import model_to_dict
 from django.utils import timezone
 from django.utils.encoding import force_str
@@ -19,15 +27,38 @@ from .api_cash_ctrl import PERSON_CATEGORY, TITLE
 CASH_CTRL_FIELDS = [
     'c_id', 'c_created', 'c_created_by', 'c_last_updated', 'c_last_updated_by'
 ]
+# downloaded key -> field
+CASH_CTRL_DOWNLOAD_FIELDS = {
+    'created': 'c_created',
+    'created_by': 'c_created_by',
+    'last_updated': 'c_last_updated',
+    'last_updated_by': 'c_last_updated_by',
+}
 EXCLUDE_FIELDS = CASH_CTRL_FIELDS + [
     'id', 'tenant', 'sync_to_accounting', 'is_enabled_sync',
     'modified_at', 'modified_by', 'created_at', 'created_by',
     'is_protected', 'attachment', 'version',
-    'last_received', 'message'
+    'last_received', 'message', 'c_payload_hash'
 ]
 
+# CustomField keys, {model field name: 'customFieldN'} per tenant and model
+CUSTOM_FIELD_CACHE_PREFIX = 'cash_ctrl_custom_fields'
+CUSTOM_FIELD_CACHE_TIMEOUT = 24 * 60 * 60  # invalidated by signals anyway
+
+# cache lookups, {'hit': n, 'miss': n}
+custom_field_cache_counter = Counter()
+
+
+logger = logging.getLogger(__name__)
+
 
 # helpers
+def get_payload_hash(data):
+    ''' fingerprint of the normalized upload data '''
+    data_str = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(data_str.encode('utf-8')).hexdigest()
+
+
 def is_html(text):
     return bool(re.search(r'<[^>]+>', text))
 
@@ -38,15 +69,51 @@ def convert_text_to_html(text):
     return text
 
 
+def get_custom_field_cache_key(tenant_id, model):
+    label = model._meta.label_lower
+    return f"{CUSTOM_FIELD_CACHE_PREFIX}:{tenant_id}:{label}"
+
+
+def invalidate_custom_fields(tenant_id):
+    ''' called by CustomField signals, clear mappings of all models '''
+    keys = [
+        get_custom_field_cache_key(tenant_id, model)
+        for model in apps.get_models() if getattr(model, 'CUSTOM', None)
+    ]
+    cache.delete_many(keys)
+
+    # other threads may have cached the old state before the commit
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def custom_field_cache_stats():
+    hits = custom_field_cache_counter['hit']
+    total = hits + custom_field_cache_counter['miss']
+    return {
+        'hit': hits,
+        'miss': custom_field_cache_counter['miss'],
+        'hit_rate': round(hits / total, 3) if total else None
+    }
+
+
 class CashCtrl:
     api_class = None  # gets assigned with get, save or delete
+    skip_unchanged = True  # no update if payload same as last one sent
+    filter_last_updated = True  # list accepts a lastUpdated filter
+    related = {}  # download key: model, e.g. {'category_id': Category}
 
     def __init__(self, model=None, language=None):
         self.language = language
         self.model = model  # needed for get and fields with custom
         self.api = None  # store later for further usage
+        self.related_records = {}  # download key: {c_id: record}
 
     def _get_api(self, tenant):
+        # Reuse api, all api instances share the pooled session of the org
+        if (self.api and self.api.org == tenant.cash_ctrl_org_name
+                and self.api.api_key == tenant.cash_ctrl_api_key):
+            return self.api
+
         self.api = self.api_class(
             tenant.cash_ctrl_org_name,
             tenant.cash_ctrl_api_key,
@@ -64,36 +131,70 @@ class CashCtrl:
         '''
         # Init
         custom_fields = getattr(self.model, 'CUSTOM', [])
-        custom = {}
+        if not custom_fields:
+            return {}
+
+        # Cache
+        key = get_custom_field_cache_key(instance.tenant_id, self.model)
+        custom = cache.get(key)
+        if custom is not None:
+            custom_field_cache_counter['hit'] += 1
+            return custom
+        custom_field_cache_counter['miss'] += 1
+
+        # Get all field instances at once
+        codes = [code for __, code in custom_fields]
+        keys = {
+            x.code: x.custom_field_key
+            for x in models.CustomField.objects.filter(
+                tenant_id=instance.tenant_id, code__in=codes)
+        }
 
-        # Parse fields
+        # Assign
+        custom = {}
         for field_name, custom_field__code in custom_fields:
-            # Get field instance
-            custom_field = models.CustomField.objects.filter(
-                tenant=instance.tenant, code=custom_field__code).first()
-
-            # Assign
-            if custom_field:
-                custom[field_name] = custom_field.custom_field_key
+            if custom_field__code in keys:
+                custom[field_name] = keys[custom_field__code]
             else:
                 msg = f"custom field {custom_field__code} not existing."
-                raise ValueError(msg)
+                raise ValueError(msg)  # not cached, may get created later
 
+        cache.set(key, custom, CUSTOM_FIELD_CACHE_TIMEOUT)
         return custom
 
-    def get_custom_field_tag(self, code):
-        ''' return xml tag that can be sent to cashCtrl '''
-        try:
-            field = models.CustomField.objects.get(
-                tenant=self.tenant, code=code)
-            return f"customField{field.c_id}"
-        except:
-            raise ValueError(f"'{code}' not existing.")
+    def preload_related(self, tenant, data_list):
+        ''' load records referenced in data_list, one query per key '''
+        self.related_records = {}
+        for key, model in self.related.items():
+            c_ids = {data[key] for data in data_list if data.get(key)}
+            self.related_records[key] = {
+                x.c_id: x for x in model.objects.filter(
+                    tenant=tenant, c_id__in=c_ids)
+            }
+
+    def get_related(self, instance, data, key):
+        ''' record referenced by data[key], preloaded if available;
+            a miss is queried, the record may have been saved meanwhile
+        '''
+        c_id = data.get(key)
+        if not c_id:
+            return None
+        records = self.related_records.setdefault(key, {})
+        if c_id not in records:
+            record = self.related[key].objects.filter(
+                tenant=instance.tenant, c_id=c_id).first()
+            if record is None:
+                return None
+            records[c_id] = record
+        return records[c_id]
 
     def get(self, tenant, created_by, params={}, overwrite_data=True,
-            delete_not_existing=True, **filter_kwargs):
+            delete_not_existing=True, data_list=None, **filter_kwargs):
+        ''' data_list: list already downloaded, e.g. in bootstrap.py '''
         api = self._get_api(tenant)
-        data_list = api.list(params)
+        if data_list is None:
+            data_list = api.list(params)
+        self.preload_related(tenant, data_list)
         c_ids = []
 
         for data in data_list:
@@ -119,6 +220,10 @@ class CashCtrl:
 
             if instance.is_inactive is None:
                 instance.is_inactive = False
+            instance.c_payload_hash = None  # remote data may differ now
+            for key, field in CASH_CTRL_DOWNLOAD_FIELDS.items():
+                setattr(instance, field, data.get(key))
+            instance.last_received = timezone.now()
 
             # save instance
             if getattr(self, 'save_download', None):
@@ -131,8 +236,125 @@ class CashCtrl:
 
         if delete_not_existing:
             self.model.objects.filter(
-                ~Q(tenant=tenant), ~Q(c_id__in=c_ids), c_id__isnull=False
-            ).delete()
+                tenant=tenant, c_id__isnull=False
+            ).exclude(c_id__in=c_ids).delete()
+
+    def get_watermark(self, tenant):
+        ''' last cashCtrl update of the records downloaded so far '''
+        return self.model.objects.filter(
+            tenant=tenant, c_id__isnull=False
+        ).aggregate(Max('c_last_updated'))['c_last_updated__max']
+
+    def get_changed(
+            self, tenant, created_by, params=None, create=True,
+            data_list=None):
+        '''
+        incremental download, only records changed in cashCtrl since the
+        last download are written (bulk, no signals); records are never
+        deleted, use get for a full sync
+        The api returns records updated at or after the watermark (ge, the
+        timestamps have seconds only), the local compare drops the ones
+        already stored.
+        create: create records not existing yet
+        returns {'created': n, 'updated': n, 'unchanged': n}
+        '''
+        api = self._get_api(tenant)
+        count = {'created': 0, 'updated': 0, 'unchanged': 0}
+
+        # Download, changed records only if the api supports it
+        watermark = self.get_watermark(tenant)
+        if data_list is None:
+            params = dict(params or {})
+            if watermark and self.filter_last_updated:
+                value = watermark.astimezone(api_cash_ctrl.TIMEZONE)
+                params['filter'] = [{
+                    'comparison': 'ge',
+                    'field': 'lastUpdated',
+                    'value': value.strftime('%Y-%m-%d %H:%M:%S')
+                }]
+            data_list = api.list(params)
+
+        # Existing records, c_id is only unique within the tenant
+        queryset = self.model.objects.filter(tenant=tenant)
+        existing = {
+            x.c_id: x for x in queryset.filter(
+                c_id__in=[data['id'] for data in data_list])
+        }
+
+        # Compare timestamps locally
+        self.preload_related(tenant, data_list)
+        now = timezone.now()
+        created, updated = [], []
+        for data in data_list:
+            instance = existing.get(data['id'])
+            last_updated = data.get('last_updated')
+            if instance:
+                if (last_updated and instance.c_last_updated
+                        and last_updated <= instance.c_last_updated):
+                    count['unchanged'] += 1
+                    continue
+                updated.append(instance)
+            elif create:
+                instance = self.model(
+                    c_id=data['id'], tenant=tenant, created_by=created_by)
+                created.append(instance)
+            else:
+                continue
+
+            # add data, fields not downloaded are kept
+            for field in model_to_dict(instance, exclude=self.exclude):
+                if field in data:
+                    setattr(instance, field, data[field])
+            for key, field in CASH_CTRL_DOWNLOAD_FIELDS.items():
+                setattr(instance, field, data.get(key))
+            if instance.is_inactive is None:
+                instance.is_inactive = False
+            instance.last_received = now
+            instance.sync_to_accounting = False
+            instance.c_payload_hash = None  # remote data may differ now
+
+            if getattr(self, 'save_download', None):
+                self.save_download(instance, data)
+
+        # Write
+        fields = [
+            field.name for field in self.model._meta.concrete_fields
+            if not field.primary_key
+            and field.name not in ('tenant', 'created_at', 'created_by')
+        ]
+        with transaction.atomic():
+            if created:
+                self.model.objects.bulk_create(created)
+                self.link_created(tenant, created, data_list)
+            if updated:
+                self.model.objects.bulk_update(updated, fields)
+
+        count['created'], count['updated'] = len(created), len(updated)
+        logger.info(f"{tenant}, {self.model.__name__}: {count}")
+        return count
+
+    def link_created(self, tenant, created, data_list):
+        '''
+        for hierarchies: save_download again after all new records exist,
+        e.g. a parent category downloaded after its child; MySQL does not
+        return the ids of bulk_create, so we reload by c_id
+        '''
+        fields = [
+            field.name for field in self.model._meta.concrete_fields
+            if field.many_to_one and field.related_model is self.model
+            and field.name != 'version'
+        ]
+        if not fields or not getattr(self, 'save_download', None):
+            return
+
+        data = {x['id']: x for x in data_list}
+        self.preload_related(tenant, data_list)  # new records exist now
+        instances = list(self.model.objects.filter(
+            tenant=tenant, c_id__in=[x.c_id for x in created]))
+        for instance in instances:
+            instance.tenant = tenant  # no query per record
+            self.save_download(instance, data[instance.c_id])
+        self.model.objects.bulk_update(instances, fields)
 
     def reload(self, instance):
         data = self.api.read(instance.c_id)
@@ -142,7 +364,18 @@ class CashCtrl:
             elif key in CASH_CTRL_FIELDS + self.reload_keys:
                 setattr(instance, key, value)
 
-    def save(self, instance, created=None):
+    def save_payload_hash(self, instance, payload_hash):
+        ''' store without signals, the record is not changed '''
+        instance.c_payload_hash = payload_hash
+        type(instance).objects.filter(pk=instance.pk).update(
+            c_payload_hash=payload_hash)
+
+    def save(self, instance, created=None, force=False):
+        '''
+        upload instance
+        force: send update even if the data is the same as last time,
+            use for repairs
+        '''
         # Check if read only
         if getattr(self, 'read_only', False):
             raise ValueError('cashCtrl, read only entity. Only code saved.')
@@ -165,6 +398,14 @@ class CashCtrl:
         if getattr(self, 'adjust_for_upload', None):
             self.adjust_for_upload(instance, data, created)
 
+        # Check if changed
+        payload_hash = get_payload_hash(data)
+        if (not force and not created and instance.c_id
+                and self.skip_unchanged
+                and payload_hash == instance.c_payload_hash):
+            logger.info(f"{instance}: unchanged, not sent")
+            return
+
         # Save
         if created or not instance.c_id:
             # Save object
@@ -184,6 +425,7 @@ class CashCtrl:
         else:
             data['id'] = instance.c_id
             _response = api.update(data)
+        self.save_payload_hash(instance, payload_hash)
 
         if getattr(self, 'post_save', None):
             self.post_save(instance)
@@ -213,6 +455,7 @@ class CustomFieldGroup(CashCtrl):
 class CustomField(CashCtrl):
     api_class = api_cash_ctrl.CustomField
     exclude = EXCLUDE_FIELDS + ['code', 'group_ref', 'notes', 'is_inactive']
+    related = {'group_id': models.CustomFieldGroup}
 
     def get(self, tenant, created_by, params={}, update=True):
         for field in api_cash_ctrl.FIELD_TYPE:
@@ -227,7 +470,10 @@ class CustomField(CashCtrl):
     def save_download(self, instance, data):
         if not instance.code:
             instance.code = f"custom {data['id']}"
-        instance.group = models.CustomFieldGroup.objects.get(c_id=data['id'])
+        instance.group = self.get_related(instance, data, 'group_id')
+        if instance.group is None:
+            raise models.CustomFieldGroup.DoesNotExist(
+                f"group {data['group_id']} not existing.")
 
 
 class FileCategory(CashCtrl):
@@ -270,18 +516,19 @@ class Unit(CashCtrl):
 class CostCenterCategory(CashCtrl):
     api_class = api_cash_ctrl.AccountCostCenterCategory
     exclude = EXCLUDE_FIELDS + ['code', 'notes', 'is_inactive']
+    related = {'parent_id': models.CostCenterCategory}
 
     def adjust_for_upload(self, instance, data, created=None):
         data['parent_id'] = instance.parent.c_id if instance.parent else None
 
     def save_download(self, instance, data):
-        instance.parent = models.CostCenterCategory.objects.filter(
-            c_id=data['parent_id']).first()
+        instance.parent = self.get_related(instance, data, 'parent_id')
 
 
 class CostCenter(CashCtrl):
     api_class = api_cash_ctrl.AccountCostCenter
     exclude = EXCLUDE_FIELDS
+    related = {'category_id': models.CostCenterCategory}
 
     def adjust_for_upload(self, instance, data, created=None):
         if instance.category:
@@ -290,13 +537,13 @@ class CostCenter(CashCtrl):
     def save_download(self, instance, data):
         if not instance.code:
             instance.code = f"custom {data['id']}"
-        instance.category = models.CostCenterCategory.objects.filter(
-            c_id=data['category_id']).first()
+        instance.category = self.get_related(instance, data, 'category_id')
 
 
 class AccountCategory(CashCtrl):
     api_class = api_cash_ctrl.AccountCategory
     exclude = EXCLUDE_FIELDS + ['is_inactive', 'notes']
+    related = {'parent_id': models.AccountCategory}
 
     @staticmethod
     def add_numbers(name, number):
@@ -327,8 +574,7 @@ class AccountCategory(CashCtrl):
 
     def save_download(self, instance, data):
         # parent
-        instance.parent = models.AccountCategory.objects.filter(
-            c_id=data['parent_id']).first()
+        instance.parent = self.get_related(instance, data, 'parent_id')
 
         # decode name
         if instance.tenant.encode_numbers:
@@ -344,6 +590,7 @@ class AccountCategory(CashCtrl):
 class Account(CashCtrl):
     api_class = api_cash_ctrl.Account
     exclude = EXCLUDE_FIELDS
+    related = {'category_id': models.AccountCategory}
 
     def adjust_for_upload(self, instance, data, created=None):
         # category_id
@@ -366,13 +613,13 @@ class Account(CashCtrl):
 
     def save_download(self, instance, data):
         # category
-        instance.category = models.AccountCategory.objects.filter(
-            c_id=data['category_id']).first()
+        instance.category = self.get_related(instance, data, 'category_id')
 
 
 class BankAccount(CashCtrl):
     api_class = api_cash_ctrl.AccountBankAccount
     exclude = EXCLUDE_FIELDS + ['account', 'code', 'notes']
+    related = {'account_id': models.Account}
     #read_only = True
 
     def adjust_for_upload(self, instance, data, created=None):
@@ -386,8 +633,7 @@ class BankAccount(CashCtrl):
 
     def save_download(self, instance, data):
         # account
-        instance.account = models.Account.objects.filter(
-            c_id=data['account_id']).first()
+        instance.account = self.get_related(instance, data, 'account_id')
 
         if not instance.code:
             instance.code = f"custom {data['id']}"
@@ -396,6 +642,7 @@ class BankAccount(CashCtrl):
 class Tax(CashCtrl):
     api_class = api_cash_ctrl.Tax
     exclude = EXCLUDE_FIELDS + ['code' + 'is_inactive', 'notes']
+    related = {'account_id': models.Account}
 
     def adjust_for_upload(self, instance, data, created=None):
         # account_id
@@ -407,13 +654,13 @@ class Tax(CashCtrl):
             instance.code = f"custom {data['id']}"
 
         # account
-        instance.account = models.Account.objects.filter(
-            c_id=data['account_id']).first()
+        instance.account = self.get_related(instance, data, 'account_id')
 
 
 class Rounding(CashCtrl):
     api_class = api_cash_ctrl.Rounding
     exclude = EXCLUDE_FIELDS + ['code' + 'is_inactive', 'notes']
+    related = {'account_id': models.Account}
 
     def adjust_for_upload(self, instance, data, created=None):
         # account_id
@@ -425,20 +672,20 @@ class Rounding(CashCtrl):
             instance.code = f"custom {data['id']}"
 
         # account
-        instance.account = models.Account.objects.filter(
-            c_id=data['account_id']).first()
+        instance.account = self.get_related(instance, data, 'account_id')
 
 
 class Setting(CashCtrl):
     api_class = api_cash_ctrl.Setting
     exclude = EXCLUDE_FIELDS + ['code' + 'is_inactive', 'notes']
 
-    def save(self, instance, created=None):
+    def save(self, instance, created=None, force=False):
         raise ValueError("Currently no save of Settings")
 
-    def get(self, tenant, created_by, params={}, update=True):
+    def get(self, tenant, created_by, params={}, update=True, data=None):
         api = self._get_api(tenant)
-        data = api.read()
+        if data is None:
+            data = api.read()
         data['id'] = 1  # enforce settings to have an id
         data = {k.lower(): v for k, v in data.items()}  # convert cases
 
@@ -486,12 +733,12 @@ class OrderCategory(CashCtrl):
         if instance.sequence_number:
             data['sequence_nr_id'] = instance.sequence_number.c_id
 
-    def save(self, instance, created=None):
+    def save(self, instance, created=None, force=False):
         '''
         Order Category needs reload status after save. This is why we define
         here our own save()
         '''
-        super().save(instance, created)
+        super().save(instance, created, force)
 
         # get the full record to update status
         instance.refresh_from_db()
@@ -618,6 +865,7 @@ class Order(CashCtrl):
     exclude = EXCLUDE_FIELDS
     reload_keys = ['nr']
     abstract = True
+    skip_unchanged = False  # post_save updates the document
 
     def make_base(self, instance, data):
         # Category, person
@@ -1,25 +1,50 @@
 '''
 accounting/import_export.py
+
+Ledger import from Excel, done in two phases:
+- phase 1: parse the file and build the ledger tree in memory, i.e. type,
+  function and parent of every position (see ledger.Ledger)
+- phase 2: save positions, AccountCategory and Account in bulk, level by
+  level so that parents get their ids first; uploads to cashCtrl are written
+  to the outbox at the end (see ledger.LedgeUpdate for the numbering)
 '''
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import openpyxl
 from decimal import Decimal
 
 from django.conf import settings
 from django.contrib import messages
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models import Max
 from django.shortcuts import get_object_or_404
 from django.utils.translation import gettext as _
 
 
-from scerp.mixins import make_multi_language
-from .models import Ledger, LedgerBalance, LedgerPL, LedgerIC
+from scerp.mixins import PrefixTrie, make_multi_language
+from . import connector_cash_ctrl as conn
+from . import outbox
+from .ledger import (
+    Ledger, LedgerIndex, LedgerRollUp, LedgerBalanceUpdate, LedgerPLUpdate,
+    LedgerICUpdate)
+from .models import (
+    Account, AccountCategory, LedgerBalance, LedgerPL, LedgerIC)
 
 
 logger = logging.getLogger(__name__)
 
+BATCH_SIZE = 500  # bulk_create, bulk_update
+
 
 class ImportExport:
+    '''
+    import excel file into ledger
+    model: LedgerBalance, LedgerPL, LedgerIC
+    update_class: LedgeUpdate subclass used for numbering
+    '''
+    model = None
+    update_class = None
+    fields_import = []
 
     def __init__(self, ledger, request, language=None):
         self.ledger = ledger
@@ -27,16 +52,34 @@ class ImportExport:
         self.request = request
         self.language = language if language else self.tenant.language
 
-    def update_or_get(self, excel_file):
-        # Load the workbook
+    @staticmethod
+    def get_key(position):
+        ''' unique within ledger, hrm of accounts repeats in functions '''
+        return position.function, position.hrm
+
+    @staticmethod
+    def get_levels(positions):
+        ''' group positions by depth, parents come first '''
+        depth, levels = {}, []
+        for position in positions:
+            level = depth[id(position.parent)] + 1 if position.parent else 0
+            depth[id(position)] = level
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(position)
+        return levels
+
+    # Phase 1
+    def read(self, excel_file):
+        ''' return rows, read only is much faster for large files '''
         # We need data_only=False to find out e.g. 3100.00 without seeing it as
         # int or float
-        wb = openpyxl.load_workbook(excel_file, data_only=False)
+        wb = openpyxl.load_workbook(excel_file, read_only=True, data_only=False)
         sheet = wb.active  # Get the first sheet
 
         # Loop through it preserving .00
         rows = []
-        for row_idx, row in enumerate(sheet.iter_rows(min_row=2), start=2):
+        for row in sheet.iter_rows(min_row=2):
             new_row = []
             for col_idx, cell in enumerate(row):
                 value = cell.value
@@ -57,13 +100,16 @@ class ImportExport:
                     except:
                         pass
 
-                # Append to new row, convert None to empty string
-                new_row.append(value if value is not None else None)
+                new_row.append(value)
 
             # Append the processed new row to rows
             rows.append(new_row)
 
-        # Init
+        wb.close()
+        return rows
+
+    def get_data_list(self, rows):
+        ''' skip rows without name, merge line breaks in names '''
         data_list = []
         last_row = None  # last complete row
 
@@ -74,14 +120,14 @@ class ImportExport:
             data = dict(zip(self.fields_import, row))
 
             # Validate name
-            if not data['name']:
+            if not data.get('name'):
                 msg = _(f"row {nr} skipping, has no name").format(nr=nr)
                 messages.info(request, msg)
                 last_row = None  # reset
                 continue
 
             # Validate hrm
-            if not data['hrm']:
+            if not data.get('hrm'):
                 # Check merging
                 if last_row and last_row['hrm'] and last_row['name']:
                     # Merge line breaks in name
@@ -94,41 +140,316 @@ class ImportExport:
                 last_row = data
                 data_list.append(data)
 
-        # Create_or_update
-        updates, creates = 0, 0
+        return data_list
+
+    def make_positions(self, data_list):
+        '''
+        build the tree in memory, no positions are saved
+        category: hrm without '.', the hrm is the function, parent is the
+            category with the longest function being a prefix
+        account: hrm with '.', parent is the last category above
+        '''
+        positions = []
+        categories = PrefixTrie()  # function: position
+        category = None  # last category
+
         for data in data_list:
-            # Make multilanguage
-            name_json = make_multi_language(data.pop('name'), self.language)
-
-            # Add name, logging
-            # is_enabled_sync: False
-            #   as we don't want to fire signals at the beginning
-            data.update({
-                'is_enabled_sync': False,
-                'name': name_json,
-                'tenant': self.tenant,
-                'ledger': self.ledger,
-                'manual_creation': False,  # important for getting parent
-                'created_by': self.request.user,
-                'sync_to_accounting': True
-            })
-
-            # Create
-            # Ensures the transaction is fully completed
+            data = dict(data)
+            code = str(data.pop('hrm')).strip()
+            position = self.model(
+                tenant=self.tenant,
+                ledger=self.ledger,
+                name=make_multi_language(data.pop('name'), self.language),
+                created_by=self.request.user,
+                is_enabled_sync=False,  # we save accounts ourselves
+                sync_to_accounting=False,
+                hrm=code,
+                **data
+            )
+
+            if '.' in code:
+                position.type = self.model.TYPE.ACCOUNT
+                if category:
+                    position.function = category.function
+                    position.parent = category
+            else:
+                position.type = self.model.TYPE.CATEGORY
+                position.function = code
+                position.parent = categories.longest_prefix(code)
+                categories.add(code, position)
+                category = position
+
+            # Validate, side, message
+            Ledger(self.model, position).update()
+            positions.append(position)
+
+        return positions
+
+    # Phase 2
+    def get_update_fields(self):
+        fields = [x for x in self.fields_import if x != 'hrm'] + [
+            'type', 'function', 'parent', 'message']
+        if self.model == LedgerBalance:
+            fields.append('side')
+        return fields
+
+    def save_positions(self, positions):
+        '''
+        create or update positions level by level, return saved positions
+        in the same order and counts
+        '''
+        existing = {
+            self.get_key(x): x
+            for x in self.model.objects.filter(
+                ledger=self.ledger).select_related(
+                    *self.update_class.category_fields, 'account')
+        }
+        update_fields = self.get_update_fields()
+        saved = {}
+        count = {'created': 0, 'updated': 0}
+
+        for level in self.get_levels(positions):
+            creates, updates = [], []
+            for position in level:
+                if position.parent:
+                    position.parent = saved[self.get_key(position.parent)]
+
+                obj = existing.get(self.get_key(position))
+                if obj:
+                    for field_name in update_fields:
+                        setattr(obj, field_name, getattr(position, field_name))
+                    obj.modified_by = self.request.user
+                    updates.append(obj)
+                    saved[self.get_key(obj)] = obj
+                else:
+                    creates.append(position)
+
+            self.model.objects.bulk_create(creates, batch_size=BATCH_SIZE)
+            self.model.objects.bulk_update(
+                updates, update_fields + ['modified_by'],
+                batch_size=BATCH_SIZE)
+
+            # Get ids, not all databases return them with bulk_create
+            keys = {self.get_key(x) for x in creates}
+            if any(x.pk is None for x in creates):
+                creates = [
+                    x for x in self.model.objects.filter(
+                        ledger=self.ledger,
+                        hrm__in={x.hrm for x in creates}
+                    ).select_related('parent')
+                    if self.get_key(x) in keys
+                ]
+                for obj in creates:
+                    # keep the in memory parent with its categories
+                    if obj.parent:
+                        obj.parent = saved[self.get_key(obj.parent)]
+            for obj in creates:
+                saved[self.get_key(obj)] = obj
+
+            count['created'] += len(creates)
+            count['updated'] += len(updates)
+
+        return [saved[self.get_key(x)] for x in positions], count
+
+    def bulk_save(self, model, pending, fields, keys):
+        '''
+        pending: {number: instance}, return created and updated instances
+        keys: fields that identify a created instance together with number,
+            needed if the database does not return ids with bulk_create
+        '''
+        creates = [x for x in pending.values() if x.pk is None]
+        updates = [x for x in pending.values() if x.pk]
+        returns_ids = connection.features.can_return_rows_from_bulk_insert
+        if creates and not returns_ids:
+            last_id = model.objects.aggregate(last_id=Max('id'))['last_id']
+        model.objects.bulk_create(creates, batch_size=BATCH_SIZE)
+        model.objects.bulk_update(updates, fields, batch_size=BATCH_SIZE)
+
+        # Get ids, not all databases return them with bulk_create;
+        # only rows inserted now are candidates, e.g. not older unsynced
+        # rows with the same number
+        if creates and not returns_ids:
+            names = [
+                model._meta.get_field(x).attname for x in ['number', *keys]]
+
+            def get_key(obj):
+                return tuple(getattr(obj, x) for x in names)
+
+            created = {}
+            for obj in model.objects.filter(
+                    tenant=self.tenant, c_id=None, id__gt=last_id or 0,
+                    number__in=[x.number for x in creates]).order_by('id'):
+                created.setdefault(get_key(obj), obj)
+            creates = [created[get_key(x)] for x in creates]
+        return creates, updates
+
+    def save_categories(self, positions, uploads):
+        ''' create or update AccountCategory, parents first '''
+        categories = {
+            x.number: x
+            for x in AccountCategory.objects.filter(tenant=self.tenant)
+        }
+
+        for level in self.get_levels(positions):
+            pending, assign = {}, []
+            for position in level:
+                handler = self.update_class(self.model, position)
+                for field_name in handler.category_fields:
+                    category = getattr(position, field_name)
+                    if category:
+                        if not position.parent:
+                            continue  # top level is not changed
+                    else:
+                        if position.parent:
+                            create = True
+                            parent = getattr(position.parent, field_name)
+                        else:
+                            create, parent = handler.get_top_category(
+                                field_name)
+                        if not create:
+                            setattr(position, field_name, parent)
+                            continue
+                        elif not parent:
+                            continue
+
+                        # Reuse category, most probably from previous year
+                        category = categories.get(
+                            handler.get_number(field_name))
+                        if not category:
+                            category = AccountCategory(
+                                tenant=self.tenant,
+                                created_by=self.request.user)
+                        category.parent = parent
+                        category.is_scerp = True
+
+                    category.name = position.name
+                    category.number = handler.get_number(field_name)
+                    category.sync_to_accounting = True
+                    category.modified_by = self.request.user
+                    pending[category.number] = category
+                    assign.append((position, field_name, category.number))
+
+            creates, updates = self.bulk_save(
+                AccountCategory, pending, [
+                    'name', 'number', 'parent', 'is_scerp',
+                    'sync_to_accounting', 'modified_by'], keys=['parent'])
+            for category in creates + updates:
+                categories[category.number] = category
+            for position, field_name, number in assign:
+                setattr(position, field_name, categories[number])
+
+            uploads.append((conn.AccountCategory, AccountCategory, creates, True))
+            uploads.append(
+                (conn.AccountCategory, AccountCategory, updates, False))
+
+    def save_accounts(self, positions, uploads):
+        ''' create or update Account '''
+        accounts = {
+            x.number: x for x in Account.objects.filter(tenant=self.tenant)}
+        pending, assign = {}, []
+
+        for position in positions:
+            handler = self.update_class(self.model, position)
+            number = handler.get_number()
+            account = position.account
+            if not account:
+                category = (
+                    handler.get_account_category() if position.parent
+                    else None)
+                if not category:
+                    msg = _("{position}: no category found.").format(
+                        position=position)
+                    messages.warning(self.request, msg)
+                    continue
+
+                account = accounts.get(number)
+                if not account:
+                    account = Account(
+                        tenant=self.tenant, created_by=self.request.user)
+                account.category = category
+
+            account.name = position.name
+            account.number = number
+            account.hrm = position.hrm
+            account.function = position.function
+            account.sync_to_accounting = True
+            account.modified_by = self.request.user
+            pending[number] = account
+            assign.append((position, number))
+
+        creates, updates = self.bulk_save(
+            Account, pending, [
+                'name', 'number', 'hrm', 'function', 'category',
+                'sync_to_accounting', 'modified_by'],
+            keys=['category', 'hrm', 'function'])
+        for account in creates + updates:
+            accounts[account.number] = account
+        for position, number in assign:
+            position.account = accounts[number]
+
+        uploads.append((conn.Account, Account, creates, True))
+        uploads.append((conn.Account, Account, updates, False))
+
+    def create_accounts(self, positions):
+        '''
+        create AccountCategory and Account of positions like
+        ledger.LedgeUpdate but in bulk, write uploads to outbox
+        '''
+        uploads = []  # (connector, model, instances, created) in order
+        self.save_categories([
+            x for x in positions if x.type == self.model.TYPE.CATEGORY
+        ], uploads)
+        self.save_accounts([
+            x for x in positions if x.type == self.model.TYPE.ACCOUNT
+        ], uploads)
+
+        # Positions are synced now
+        for position in positions:
+            position.is_enabled_sync = True
+            position.sync_to_accounting = False
+        self.model.objects.bulk_update(
+            positions, self.update_class.category_fields + [
+                'account', 'is_enabled_sync', 'sync_to_accounting'],
+            batch_size=BATCH_SIZE)
+
+        if self.tenant.cash_ctrl_org_name:
+            for connector, model, instances, created in uploads:
+                outbox.enqueue_bulk(connector, model, instances, created)
+
+    def update_or_get(self, excel_file):
+        ''' import excel_file, return counts '''
+        # Phase 1, no db access
+        data_list = self.get_data_list(self.read(excel_file))
+        positions = self.make_positions(data_list)
+
+        # Phase 2
+        with transaction.atomic():
+            positions, count = self.save_positions(positions)
+            LedgerRollUp(self.model).rebuild(self.ledger.id)  # no signals
+        LedgerIndex.changed(self.model, self.ledger.id)
+        msg = _("{created} positions created, {updated} updated.").format(
+            **count)
+        messages.info(self.request, msg)
+
+        try:
             with transaction.atomic():
-                obj, created = self.model.objects.update_or_create(
-                    ledger=data.pop('ledger'),
-                    hrm=data.pop('hrm'),
-                    defaults=data)
+                self.create_accounts(positions)
+        except ValueError as e:
+            # e.g. accounting setup missing, positions remain unsynced for
+            # SyncLedger
+            messages.warning(self.request, str(e))
+            return count
 
-            if created:
-                creates = creates + 1
-            else:
-                updates = updates + 1
+        # Upload at once if there is no outbox worker
+        if self.tenant.cash_ctrl_org_name and not outbox.is_async():
+            outbox.process_tenant(self.tenant.id, close=False)
+
+        return count
 
 
 class LedgerBalanceImportExport(ImportExport):
     model = LedgerBalance
+    update_class = LedgerBalanceUpdate
     fields_import = [
         'hrm', 'name', 'opening_balance', 'closing_balance', 'increase',
         'decrease', 'notes']
@@ -136,6 +457,7 @@ class LedgerBalanceImportExport(ImportExport):
 
 class LedgerPLImportExport(ImportExport):
     model = LedgerPL
+    update_class = LedgerPLUpdate
     fields_import = [
         'hrm', 'name', 'expense', 'revenue',
         'expense_budget', 'revenue_budget',
@@ -144,6 +466,7 @@ class LedgerPLImportExport(ImportExport):
 
 class LedgerICImportExport(ImportExport):
     model = LedgerIC
+    update_class = LedgerICUpdate
     fields_import = [
         'hrm', 'name', 'expense', 'revenue',
         'expense_budget', 'revenue_budget',
@@ -153,40 +476,100 @@ class LedgerICImportExport(ImportExport):
 class SyncLedger:
     '''
     call this by management console as admin.py has its problems
+
+    Uploads unsynced positions of a ledger: categories level by level, then
+    accounts; positions of the same level are uploaded in parallel, the
+    rate limiter of api_cash_ctrl paces the requests.
+    A synced position has is_enabled_sync = True, a failed one keeps False
+    and gets the error in message, so the next run continues with it.
     '''
-    def __init__(self, category):
+    WORKERS = 4  # parallel uploads
+
+    def __init__(self, category, workers=WORKERS):
         self.model = {
             'balance': LedgerBalance,
             'pl': LedgerPL,
             'ic': LedgerIC
         }.get(category.lower())
+        self.workers = workers
+
+    def get_batches(self, queryset, ledger_id):
+        ''' return lists of position ids, categories by depth, accounts '''
+        parents = dict(self.model.objects.filter(
+            ledger_id=ledger_id).values_list('id', 'parent_id'))
+
+        def get_depth(pk):
+            depth = 0
+            while parents.get(pk):
+                pk = parents[pk]
+                depth += 1
+            return depth
+
+        categories, accounts = {}, []
+        for pk, type_, hrm in queryset.values_list('id', 'type', 'hrm'):
+            # type is set in pre_save if missing, see ledger.Ledger
+            if type_ == self.model.TYPE.ACCOUNT or (
+                    not type_ and hrm and '.' in hrm):
+                accounts.append(pk)
+            else:
+                categories.setdefault(get_depth(pk), []).append(pk)
 
-    def load(self, org_name, ledger_id, max_count=9999):
-        queryset = self.model.objects.filter(
-            ledger__id=ledger_id, tenant__cash_ctrl_org_name=org_name,
-            is_enabled_sync=False
-        ).order_by('function', '-type', 'hrm')[:max_count]
-
-        for position in queryset:
-            position.is_enabled_sync = True
-            position.sync_to_accounting = True
-            position.save(update_fields=[
-                'is_enabled_sync', 'sync_to_accounting'])
-
-            # Manually trigger signals if necessary (after save)
-            position.refresh_from_db()
-            logger.info(f"synched {position.hrm}.")
+        return [categories[x] for x in sorted(categories)] + [accounts], parents
 
-            try:
+    def sync_position(self, pk):
+        ''' runs in thread, return error message or None '''
+        try:
+            position = self.model.objects.get(pk=pk)
+            with outbox.inline():
+                # post_save creates categories or account and uploads them
                 position.is_enabled_sync = True
                 position.sync_to_accounting = True
-                position.save(update_fields=[
-                    'is_enabled_sync', 'sync_to_accounting'])
-
-                # Manually trigger signals if necessary (after save)
-                position.refresh_from_db()
-                logger.info(f"synched {position.hrm}.")
-            except:
-                logger.error(f"could not synch {position.hrm}.")
-        if not queryset:
+                position.save()
+            return None
+        except Exception as e:
+            message = str(e)
+            self.model.objects.filter(pk=pk).update(
+                is_enabled_sync=False, message=message[:200])
+            return message
+        finally:
+            connection.close()  # thread owns its connection
+
+    def load(self, org_name, ledger_id, max_count=None):
+        ''' return count of done, failed, skipped positions '''
+        queryset = self.model.objects.filter(
+            ledger__id=ledger_id, tenant__cash_ctrl_org_name=org_name,
+            is_enabled_sync=False
+        ).order_by('function', '-type', 'hrm')
+        count = {'done': 0, 'failed': 0, 'skipped': 0}
+        for message in LedgerIndex.get(self.model, ledger_id).validate():
+            logger.warning(message)
+
+        batches, parents = self.get_batches(queryset, ledger_id)
+        failed = set()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for batch in batches:
+                # Children of failed positions have to wait for next run
+                todo = []
+                for pk in batch:
+                    if parents.get(pk) in failed:
+                        failed.add(pk)
+                        count['skipped'] += 1
+                    else:
+                        todo.append(pk)
+                if max_count is not None:
+                    todo = todo[:max_count - count['done'] - count['failed']]
+
+                for pk, message in zip(
+                        todo, executor.map(self.sync_position, todo)):
+                    if message:
+                        failed.add(pk)
+                        count['failed'] += 1
+                        logger.error(f"could not synch {pk}: {message}")
+                    else:
+                        count['done'] += 1
+                logger.info(f"synched {len(todo)} positions, {count}")
+
+        if not any(batches):
             logger.warning(f"no positions to by synched.")
+        return count
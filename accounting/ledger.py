@@ -5,13 +5,18 @@ Ledger utilities
 '''
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+from threading import Lock
 
 from django.contrib import messages
+from django.core.cache import cache
+from django.db.models import F
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-from scerp.mixins import find_first_match_in_nested_dict
+from scerp.mixins import PrefixTrie, index_nested_dict
 from . import api_cash_ctrl
 from .connector_cash_ctrl import Element as ConnElement
 from .models import (
@@ -23,6 +28,234 @@ from .models import (
 logger = logging.getLogger(__name__)
 
 
+# Hierarchy index ---------------------------------------------------------
+class LedgerIndex:
+    '''
+    categories of a ledger in a trie over function codes, loaded once with
+    one query and updated by signals.py, so parent lookups need no queries
+
+    The version in the cache tells other processes (e.g. admin and
+    process_accounting) to reload after changes, call changed() after bulk
+    operations that do not fire signals.
+    '''
+    VERSION_KEY = 'ledger-index:{label}:{ledger_id}'
+    _indexes = {}  # (model, ledger_id): LedgerIndex
+    _lock = Lock()
+
+    def __init__(self, model, ledger_id, version):
+        self.model = model
+        self.ledger_id = ledger_id
+        self.version = version
+        self.functions, self.parents = {}, {}
+        for pk, function, parent_id in model.objects.filter(
+                ledger_id=ledger_id, type=model.TYPE.CATEGORY
+                ).order_by('id').values_list('id', 'function', 'parent_id'):
+            self.parents[pk] = parent_id
+            if function is not None:
+                self.functions[pk] = function
+        self.categories = PrefixTrie(
+            (function, pk) for pk, function in self.functions.items())
+
+    @classmethod
+    def get_version_key(cls, model, ledger_id):
+        return cls.VERSION_KEY.format(
+            label=model._meta.label_lower, ledger_id=ledger_id)
+
+    @classmethod
+    def get(cls, model, ledger_id):
+        ''' return index of ledger, reload if changed by other process '''
+        version = cache.get(cls.get_version_key(model, ledger_id), 0)
+        with cls._lock:
+            index = cls._indexes.get((model, ledger_id))
+            if index is None or index.version != version:
+                index = cls(model, ledger_id, version)
+                cls._indexes[(model, ledger_id)] = index
+            return index
+
+    @classmethod
+    def changed(cls, model, ledger_id):
+        ''' new version, return it '''
+        key = cls.get_version_key(model, ledger_id)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+            return 1
+
+    @classmethod
+    def update(cls, model, instance, deleted=False):
+        ''' called by signals after save or delete of a position '''
+        version = cls.changed(model, instance.ledger_id)
+        with cls._lock:
+            index = cls._indexes.get((model, instance.ledger_id))
+            if index is None:
+                return
+            if index.version != version - 1:
+                # changed by another process meanwhile, reload if needed
+                del cls._indexes[(model, instance.ledger_id)]
+                return
+
+            # Remove old entry
+            index.parents.pop(instance.pk, None)
+            function = index.functions.pop(instance.pk, None)
+            if function is not None:
+                if index.categories.get(function) == instance.pk:
+                    index.categories.remove(function)
+
+            # Add
+            if not deleted and instance.type == model.TYPE.CATEGORY:
+                index.parents[instance.pk] = instance.parent_id
+                if instance.function is not None:
+                    index.functions[instance.pk] = instance.function
+                    index.categories.add(instance.function, instance.pk)
+            index.version = version
+
+    def get_category(self, function):
+        ''' pk of the category of function '''
+        return self.categories.get(function)
+
+    def get_parent(self, function):
+        ''' pk of the category above function '''
+        return self.categories.longest_prefix(function)
+
+    def get_descendants(self, function):
+        ''' pks of the categories below function '''
+        return self.categories.descendants(function)
+
+    def get_ancestors(self, pk):
+        ''' pks of category pk and the categories above '''
+        ancestors = []
+        while pk and pk not in ancestors:
+            ancestors.append(pk)
+            pk = self.parents.get(pk)
+        return ancestors
+
+    def validate(self):
+        ''' return messages of positions not fitting into the hierarchy '''
+        result = []
+        for pk, type_, function, hrm in self.model.objects.filter(
+                ledger_id=self.ledger_id).values_list(
+                    'id', 'type', 'function', 'hrm'):
+            if not function:
+                result.append(f"{hrm}: no function")
+            elif type_ == self.model.TYPE.CATEGORY:
+                if len(function) > 1 and self.get_category(
+                        function[:-1]) is None:
+                    result.append(f"{function}: no category {function[:-1]}")
+            elif self.get_category(function) is None:
+                result.append(f"{function} {hrm}: no category {function}")
+        return result
+
+
+# Top categories of tenants, e.g. 3.1, they are protected against deletion
+def get_top_category(tenant, number):
+    ''' return AccountCategory with number, not cached: needed for top
+        level positions only and may change in another process
+    '''
+    return AccountCategory.objects.filter(
+        tenant=tenant, number=number).first()
+
+
+# Category totals ---------------------------------------------------------
+class LedgerRollUp:
+    '''
+    values of categories are the totals of the accounts below
+    update: add the change of an account to its ancestors, see signals.py
+    rebuild: calculate all totals of a ledger, e.g. after bulk updates
+    '''
+    FIELDS_BALANCE = [
+        'opening_balance', 'closing_balance', 'increase', 'decrease']
+    FIELDS_FUNCTIONAL = [
+        'expense', 'revenue', 'expense_budget', 'revenue_budget',
+        'expense_previous', 'revenue_previous']
+    BATCH_SIZE = 500
+
+    def __init__(self, model):
+        self.model = model
+        self.fields = (
+            self.FIELDS_BALANCE if model == LedgerBalance
+            else self.FIELDS_FUNCTIONAL)
+
+    def add(self, pks, deltas):
+        ''' add deltas to categories pks, one query '''
+        deltas = {key: value for key, value in deltas.items() if value}
+        if pks and deltas:
+            self.model.objects.filter(pk__in=pks).update(**{
+                key: Coalesce(F(key), Decimal(0)) + value
+                for key, value in deltas.items()
+            })
+
+    def update(self, instance, created=False, deleted=False):
+        ''' called by signals after save or delete of a position '''
+        loaded = getattr(instance, '_loaded_values', {})
+        if not created and not all(
+                x in loaded for x in self.fields + ['parent_id']):
+            # deferred fields, previous values unknown
+            self.rebuild(instance.ledger_id)
+            return
+
+        old_parent_id = loaded.get('parent_id')
+        new_parent_id = None if deleted else instance.parent_id
+
+        if instance.type != self.model.TYPE.ACCOUNT:
+            if not created and old_parent_id != new_parent_id:
+                # subtree moved
+                self.rebuild(instance.ledger_id)
+        else:
+            old = {key: loaded.get(key) or 0 for key in self.fields}
+            new = {
+                key: 0 if deleted else getattr(instance, key) or 0
+                for key in self.fields
+            }
+            index = LedgerIndex.get(self.model, instance.ledger_id)
+            if old_parent_id == new_parent_id:
+                self.add(index.get_ancestors(new_parent_id), {
+                    key: Decimal(new[key]) - Decimal(old[key])
+                    for key in self.fields
+                })
+            else:
+                self.add(index.get_ancestors(old_parent_id), {
+                    key: -Decimal(value) for key, value in old.items()})
+                self.add(index.get_ancestors(new_parent_id), {
+                    key: Decimal(value) for key, value in new.items()})
+
+        # the instance can be saved again, e.g. by LedgeUpdate
+        loaded.update({key: getattr(instance, key) for key in self.fields})
+        loaded['parent_id'] = instance.parent_id
+        instance._loaded_values = loaded
+
+    def rebuild(self, ledger_id):
+        ''' calculate totals of all categories, return number updated '''
+        rows = list(self.model.objects.filter(ledger_id=ledger_id).values(
+            'id', 'type', 'parent_id', *self.fields))
+        parents = {row['id']: row['parent_id'] for row in rows}
+        totals = {
+            row['id']: dict.fromkeys(self.fields, Decimal(0))
+            for row in rows if row['type'] != self.model.TYPE.ACCOUNT
+        }
+
+        for row in rows:
+            if row['type'] != self.model.TYPE.ACCOUNT:
+                continue
+            pk, seen = row['parent_id'], set()
+            while pk in totals and pk not in seen:
+                seen.add(pk)
+                for key in self.fields:
+                    totals[pk][key] += row[key] or 0
+                pk = parents[pk]
+
+        updates = [
+            self.model(id=row['id'], **totals[row['id']])
+            for row in rows if row['id'] in totals and any(
+                row[key] != totals[row['id']][key] for key in self.fields)
+        ]
+        self.model.objects.bulk_update(
+            updates, self.fields, batch_size=self.BATCH_SIZE)
+        logger.info(
+            f"{self.model.__name__} {ledger_id}: {len(updates)} totals")
+        return len(updates)
+
+
 # Ledger to cashCtrl Mapper, called by signals ----------------------------
 class Ledger:
     '''
@@ -64,27 +297,23 @@ class Ledger:
         # type
         instance.type = self.model.TYPE.ACCOUNT
 
-        # parent
-        if not instance.parent:
+        # parent, parent can be an unsaved instance, e.g. import
+        if (not instance.parent_id and instance.parent is None
+                and instance.function is not None):
             # derive from function
-            instance.parent = self.model.objects.filter(
-                ledger=instance.ledger,
-                function=instance.function,
-                type=self.model.TYPE.CATEGORY
-            ).order_by('id').last()
+            index = LedgerIndex.get(self.model, instance.ledger_id)
+            instance.parent_id = index.get_category(instance.function)
 
     def update_category(self, instance):
         # type
         instance.type = self.model.TYPE.CATEGORY
 
-        # parent
-        function_parent = instance.function[:-1]  # Removes the last character
-        if not instance.parent:
-            instance.parent = self.model.objects.filter(
-                ledger=instance.ledger,
-                type=self.model.TYPE.CATEGORY,
-                function=function_parent
-            ).order_by('hrm').last()
+        # parent, the category with the longest function above
+        # parent can be an unsaved instance, e.g. import
+        if (not instance.parent_id and instance.parent is None
+                and instance.function):
+            index = LedgerIndex.get(self.model, instance.ledger_id)
+            instance.parent_id = index.get_parent(instance.function)
 
         # function
         instance.hrm = instance.function
@@ -264,8 +493,7 @@ class LedgerBalanceUpdate(LedgeUpdate):
         # top level is a cashCtrl entity -> no comma
         number = int(self.get_number(field_name))
 
-        parent = AccountCategory.objects.filter(
-            tenant=self.instance.tenant, number=number).first()
+        parent = get_top_category(self.instance.tenant, number)
         return create, parent
 
     def get_account_category(self):
@@ -303,14 +531,11 @@ class LedgerFunctionalUpdate(LedgeUpdate):
         create = True  # Functional categories do not exist
 
         # parent
-        queryset = AccountCategory.objects.filter(tenant=self.instance.tenant)
-
+        tenant = self.instance.tenant
         if field_name == 'category_expense':
-            parent = queryset.filter(
-                number=self.top_level_expense).first()
+            parent = get_top_category(tenant, self.top_level_expense)
         elif field_name == 'category_revenue':
-            parent = queryset.filter(
-                number=self.top_level_revenue).first()
+            parent = get_top_category(tenant, self.top_level_revenue)
         else:
             raise ValueError(f"{field_name}: not a valid field name")
 
@@ -345,6 +570,7 @@ class LoadBalanceFromAccount:
         model: LedgerBalance, LedgerPL,
         queryset: items of model to be updated
     '''
+    WORKERS = 4  # parallel requests, paced by the rate limiter
 
     def __init__(self, model, request, queryset):
         self.model = model
@@ -356,63 +582,64 @@ class LoadBalanceFromAccount:
         self.conn = api_cash_ctrl.Account(
             tenant.cash_ctrl_org_name, tenant.cash_ctrl_api_key)
 
-    def load_balance(self, date=None):
-        '''Load LedgerBalance
-        '''
-        balance = {}
-        for item in self.queryset.exclude(account=None):
+    def get_accounts(self):
+        ''' return positions with accounts, warn if not synced '''
+        items = []
+        for item in self.queryset.exclude(
+                account=None).select_related('account'):
             if item.account.c_id:
-                balance[item.hrm] = self.conn.get_balance(
-                    item.account.c_id, date)
-                item.closing_balance = balance[item.hrm]
-                item.balance_updated = timezone.now()
-                item.save()
+                items.append(item)
             else:
                 msg = _("{item} has no cashCtrl id.").format(item=item)
                 messages.warning(self.request, msg)
+        return items
 
-        # Calc balances for categories
-        for item in self.queryset.filter(account=None):
-            balance_sum = sum([
-                value or 0
-                for hrm, value in balance.items()
-                if hrm.startswith(item.function)
-            ])
-            item.closing_balance = balance_sum
-            item.balance_updated = timezone.now()
-            item.save()
+    def get_balances(self, items, date=None):
+        ''' fetch balance of every account once, in parallel
+            return {c_id: balance}
+        '''
+        c_ids = list({item.account.c_id for item in items})
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+            balances = executor.map(
+                lambda c_id: self.conn.get_balance(c_id, date), c_ids)
+            return dict(zip(c_ids, balances))
+
+    def load_balance(self, date=None):
+        '''Load LedgerBalance
+        '''
+        now = timezone.now()
+        items = self.get_accounts()
+        balances = self.get_balances(items, date)
+        for item in items:
+            item.closing_balance = balances[item.account.c_id]
+            item.balance_updated = now
+
+        self.model.objects.bulk_update(
+            items, ['closing_balance', 'balance_updated'])
+        self.update_categories(now)
 
     def load_pl_or_ic(self, date=None):
-        # Load balance from cashCtrl
-        balance = {
-            'expense': {},
-            'revenue': {}
-        }
-        for item in self.queryset.exclude(account=None):
-            for key in balance.keys():
-                if item.account.c_id:
-                    balance[key][item.function] = self.conn.get_balance(
-                        item.account.c_id, date)
-                    setattr(item, key, balance[key][item.function])
-                else:
-                    msg = _("{item} has no cashCtrl id.").format(item=item)
-                    print("*item.account.c_id", category, item.account.c_id)
-                    messages.warning(self.request, msg)
+        now = timezone.now()
+        keys = ('expense', 'revenue')
 
-                item.balance_updated = timezone.now()
-                item.save()
-
-        # Calc balances for categories
-        for item in self.queryset.filter(account=None):
-            for key in balance.keys():
-                balance_sum = sum([
-                    value or 0
-                    for function, value in balance[key].items()
-                    if function.startswith(item.function)
-                ])
-                setattr(item, key,balance_sum)
-            item.balance_updated = timezone.now()
-            item.save()
+        # Load balance from cashCtrl
+        items = self.get_accounts()
+        balances = self.get_balances(items, date)
+        for item in items:
+            for key in keys:
+                setattr(item, key, balances[item.account.c_id])
+            item.balance_updated = now
+
+        self.model.objects.bulk_update(
+            items, list(keys) + ['balance_updated'])
+        self.update_categories(now)
+
+    def update_categories(self, now):
+        ''' totals of categories, bulk_update does not fire signals '''
+        for ledger_id in set(self.queryset.values_list(
+                'ledger_id', flat=True)):
+            LedgerRollUp(self.model).rebuild(ledger_id)
+        self.queryset.filter(account=None).update(balance_updated=now)
 
     def load(self, date=None):
         if self.model == LedgerBalance:
@@ -448,6 +675,22 @@ class LoadBalance:
         data = conn.get_element_data(element, period)
         return data
 
+    @staticmethod
+    def _get_index(data):
+        ''' index report nodes once, cashCtrl report has accounts with
+            accountId and categories with id, e.g. 'category-985'
+        '''
+        return index_nested_dict(data, ['accountId', 'id'])
+
+    @staticmethod
+    def _get_key(ledger_position, category):
+        ''' return key, value of report node of ledger_position '''
+        if ledger_position.type == ledger_position.TYPE.ACCOUNT:
+            return 'accountId', ledger_position.account.c_id
+        elif category:
+            return 'id', f'category-{category.c_id}'
+        return None, None
+
     def _update_positions(self, updated_objects, field_names):
         # Update balance
         self.model.objects.bulk_update(updated_objects, field_names)
@@ -457,25 +700,21 @@ class LoadLedgerBalance(LoadBalance):
 
     def load(self, _date=None):
         updated_objects = []
-        data = self._get_data('balance')
+        index = self._get_index(self._get_data('balance'))
+        queryset = self.queryset.select_related('account', 'category')
 
         # Update accounts
-        for ledger_position in self.queryset:
-            if ledger_position.type == self.model.TYPE.ACCOUNT:
-                key = 'accountId'
-                value = ledger_position.account.c_id
-            elif getattr(ledger_position, 'category', None):
-                # Make key, value as cashCtrl report is e.g. id: 'category-985'
-                key = 'id'
-                value = f'category-{ledger_position.category.c_id}'
-            else:
+        for ledger_position in queryset:
+            key, value = self._get_key(
+                ledger_position, getattr(ledger_position, 'category', None))
+            if not key:
                 msg = _("no category for {category}.").format(
                     category=ledger_position)
                 messages.warning(self.request, msg)
                 continue
 
             # Get result
-            result = find_first_match_in_nested_dict(data, key, value)
+            result = index[key].get(value)
             if not result:
                 msg = _("no result for {position}.").format(
                     position=ledger_position)
@@ -502,34 +741,32 @@ class LoadFunctionalLedger(LoadBalance):
 
     def load(self, _date=None):
         updated_objects = []
-        data = self._get_data('pls')
-
-        # Update expense accounts
-        for update_field in ('expense', 'revenue'):
-            # Init
-            category_field = f'category_{update_field}'
-            hrm_category = self.HRM_CATEGORY_MAPPING[update_field]
-
-            # Parse
-            for ledger_position in self.queryset:
-                if ledger_position.type == self.model.TYPE.ACCOUNT:
-                    if ledger_position.hrm_category != hrm_category:
-                        continue
-                    key = 'accountId'
-                    value = ledger_position.account.c_id
-                elif getattr(ledger_position, category_field, None):
-                    # Make key, value as cashCtrl report is e.g. id: 'category-985'
-                    key = 'id'
-                    category = getattr(ledger_position, category_field)
-                    value = f'category-{category.c_id}'
-                else:
+        index = self._get_index(self._get_data('pls'))
+        queryset = self.queryset.select_related(
+            'account', 'category_expense', 'category_revenue')
+
+        # Parse
+        for ledger_position in queryset:
+            updated = False
+
+            # Update expense and revenue
+            for update_field, hrm_category in (
+                    self.HRM_CATEGORY_MAPPING.items()):
+                if (ledger_position.type == self.model.TYPE.ACCOUNT
+                        and ledger_position.hrm_category != hrm_category):
+                    continue
+
+                category = getattr(
+                    ledger_position, f'category_{update_field}', None)
+                key, value = self._get_key(ledger_position, category)
+                if not key:
                     msg = _("no category for {category}.").format(
                         category=ledger_position)
                     messages.warning(self.request, msg)
                     continue
 
                 # Get result
-                result = find_first_match_in_nested_dict(data, key, value)
+                result = index[key].get(value)
                 if not result:
                     msg = _("no result for {position}.").format(
                         position=ledger_position)
@@ -539,7 +776,9 @@ class LoadFunctionalLedger(LoadBalance):
                 # Assign result
                 setattr(ledger_position, update_field, result.get('endAmount'))
                 ledger_position.balance_updated=timezone.now()
+                updated = True
 
+            if updated:
                 updated_objects.append(ledger_position)
 
         # Update balance
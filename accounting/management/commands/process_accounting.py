@@ -2,14 +2,27 @@
 accounting/management/commands/process_accounting.py
 
 usage:
-   python manage.py process_accounting sync --org_name=test167 --ledger_id=1 --category=ic --max_count=100
-   python manage.py process_accounting sync_outgoing_order --days_back=5
+   python manage.py process_accounting sync --org_name=test167 --ledger_id=1 --category=ic --workers=4
+   python manage.py process_accounting sync_outgoing_order --days_back=5 --workers=4
+   python manage.py process_accounting sync_outbox --workers=4
+   python manage.py process_accounting sync_outbox --force  # repair
+   python manage.py process_accounting setup_tenant --org_name=test167 --restart
+   python manage.py process_accounting refresh --org_name=test167 --entity=account
+   python manage.py process_accounting rollup --ledger_id=1 --category=pl
+   python manage.py process_accounting order_status  # all tenants
 
 '''
 from django.core.management.base import BaseCommand
 
+from core.models import Tenant
+from accounting.bootstrap import TenantBootstrap
+from accounting.connector_cash_ctrl import custom_field_cache_stats
 from accounting.import_export import SyncLedger
-from accounting.process import sync_outgoing_order
+from accounting.ledger import LedgerRollUp
+from accounting.models import LedgerBalance, LedgerPL, LedgerIC
+from accounting.outbox import drain
+from accounting.process import (
+    REFRESH, make_summary, refresh, sync_order_status, sync_outgoing_order)
 
 class Command(BaseCommand):
     help = 'Init accounting'
@@ -18,7 +31,9 @@ class Command(BaseCommand):
         # Required positional argument
         parser.add_argument(
             'action', type=str,
-            choices=['sync', 'sync_outgoing_order'],
+            choices=[
+                'sync', 'sync_outgoing_order', 'sync_outbox', 'setup_tenant',
+                'refresh', 'rollup', 'order_status'],
             help='Sync ledger')
 
         # Optional arguments
@@ -34,6 +49,18 @@ class Command(BaseCommand):
             '--max_count', type=int, help='max number of records (< 100)')
         parser.add_argument(
             '--days_back', type=int, help='sync days back')
+        parser.add_argument(
+            '--workers', type=int,
+            help='tenants or ledger positions processed in parallel')
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='setup_tenant: run all steps again')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='sync_outbox: send data even if unchanged')
+        parser.add_argument(
+            '--entity', type=str, action='append', choices=list(REFRESH),
+            help='refresh: entity to download, default: all')
             
     def handle(self, *args, **options):
         # Retrieve action
@@ -41,13 +68,63 @@ class Command(BaseCommand):
 
         # Perform actions based on the retrieved options
         if action == 'sync':
-            sync = SyncLedger(options.get('category'))
+            sync = SyncLedger(
+                options.get('category'), workers=options.get('workers') or 4)
             org_name = options.get('org_name')
             ledger_id = options.get('ledger_id')
-            max_count = options.get('max_count', 100)
-            sync.load(org_name, ledger_id, max_count)
+            max_count = options.get('max_count')
+            count = sync.load(org_name, ledger_id, max_count)
+            self.stdout.write(f"ledger {ledger_id}: {count}")
             
-        if action == 'sync_outgoing_order':            
+        if action == 'sync_outgoing_order':
             days_back = options.get('days_back') or 5
-            count = sync_outgoing_order(days_back)
+            result = sync_outgoing_order(
+                days_back, workers=options.get('workers') or 4)
+            for line in make_summary(result):
+                self.stdout.write(line)
+
+        if action == 'sync_outbox':
+            workers = options.get('workers') or 4
+            max_count = options.get('max_count')
+            result = drain(workers, max_count, force=options['force'])
+            for tenant_id, count in result.items():
+                self.stdout.write(f"tenant {tenant_id}: {count}")
+            self.stdout.write(
+                f"custom field cache: {custom_field_cache_stats()}")
 
+        if action == 'setup_tenant':
+            tenant = Tenant.objects.get(
+                cash_ctrl_org_name=options.get('org_name'))
+            bootstrap = TenantBootstrap(
+                tenant, restart=options['restart'],
+                workers=options.get('workers') or 4)
+            for step, seconds in bootstrap.run():
+                self.stdout.write(f"{step}: {seconds}s")
+            tenant.is_initialized_accounting = True
+            tenant.save(update_fields=['is_initialized_accounting'])
+
+        if action == 'refresh':
+            tenant = Tenant.objects.get(
+                cash_ctrl_org_name=options.get('org_name'))
+            result = refresh(tenant, tenant.created_by, options.get('entity'))
+            for entity, count in result.items():
+                self.stdout.write(f"{entity}: {count}")
+
+        if action == 'rollup':
+            # rebuild category totals, all ledger types if no category
+            category = options.get('category')
+            models = {
+                'balance': LedgerBalance, 'pl': LedgerPL, 'ic': LedgerIC}
+            for key, model in models.items():
+                if category and key != category:
+                    continue
+                count = LedgerRollUp(model).rebuild(options.get('ledger_id'))
+                self.stdout.write(f"{key}: {count} categories updated")
+
+        if action == 'order_status':
+            org_name = options.get('org_name')
+            result = sync_order_status(
+                [org_name] if org_name else None,
+                workers=options.get('workers') or 4)
+            for (org_name, model), count in result.items():
+                self.stdout.write(f"{org_name} {model}: {count}")
@@ -7,7 +7,7 @@ pylint checked 2024-12-25
 '''
 from django.utils.translation import get_language, gettext_lazy as _
 
-from scerp.mixins import COPY, SafeDict
+from scerp.mixins import COPY, PrefixTrie, SafeDict
 from .models import OutgoingItem
 
 DIGITS_FUNCTIONAL = 4, 0
@@ -85,23 +85,21 @@ class AccountPositionCheck():
         # Check levels
         self.positions = [x for x in query_positions]
 
-    def get_parent(self, position):
-        # Init
-        level_check = position.level - 1
-        nr = self.positions.index(position)
-
-        # Check
-        for pos in reversed(self.positions[:nr]):
+        # Index, first position of a code wins as in a search from the top
+        self.categories = PrefixTrie()
+        self.functions = {}
+        for position in reversed(self.positions):
             if position.is_category:
-                c1 = pos.account_number[:level_check]
-                c2 = position.account_number[:level_check]
-                if c1 == c2:
-                    return pos
-            elif pos.function == position.function:
-                return pos
-            else:
-                print("*", pos.function, position.function)
-        return None
+                self.categories.add(position.account_number, position)
+            self.functions[getattr(position, 'function', None)] = position
+
+    def get_parent(self, position):
+        if position.is_category:
+            parent = self.categories.get(
+                position.account_number[:position.level - 1])
+        else:
+            parent = self.functions.get(getattr(position, 'function', None))
+        return None if parent is position else parent
 
     def check(self):
         # Check is only upper
@@ -1991,33 +1991,38 @@ class OutgoingOrder(Order):
         return (f"{self.nr} {self.contract.associate.company}, {self.date}, "
                 f"{self.description}")
 
-    def save(self, *args, **kwargs):
-        if not self.header:
-            # no header given, fill in city specific header
-
-            # building / "Objekt"
-            building = (
-                f"{self.address.stn_label} {self.address.adr_number}"
-            ) if self.address else ''
-            building_notes = (
-                ', ' + self.address.notes
-            ) if self.address and self.address.notes else ''
-
-            # recipient_short_name
-            recipient_short_name = (
-                f", {self.recipient.short_name}" if self.recipient else '')
-
-            # build
-            template = self.category.header or ''
-            self.header = template.format_map(SafeDict(
-                building=building,
-                building_notes=building_notes,
-                description=self.header_description or '',
-                recipient_short_name=recipient_short_name,
-                start=format_date(self.start) if self.start else '',
-                end=format_date(self.end) if self.end else ''
-            ))
+    def fill_header(self):
+        ''' no header given, fill in city specific header;
+            call it before bulk_create as save is bypassed
+        '''
+        if self.header:
+            return
+
+        # building / "Objekt"
+        building = (
+            f"{self.address.stn_label} {self.address.adr_number}"
+        ) if self.address else ''
+        building_notes = (
+            ', ' + self.address.notes
+        ) if self.address and self.address.notes else ''
+
+        # recipient_short_name
+        recipient_short_name = (
+            f", {self.recipient.short_name}" if self.recipient else '')
+
+        # build
+        template = self.category.header or ''
+        self.header = template.format_map(SafeDict(
+            building=building,
+            building_notes=building_notes,
+            description=self.header_description or '',
+            recipient_short_name=recipient_short_name,
+            start=format_date(self.start) if self.start else '',
+            end=format_date(self.end) if self.end else ''
+        ))
 
+    def save(self, *args, **kwargs):
+        self.fill_header()
         super().save(*args, **kwargs)
 
     class Meta:
@@ -2123,6 +2128,105 @@ class Element(AcctApp):
         verbose_name_plural = _("Report - Elements")
 
 
+# Sync to cashCtrl ---------------------------------------------------------
+class SyncOutbox(models.Model):
+    '''
+    Pending cashCtrl sync operations
+    Rows are written by signals_cash_ctrl within the transaction of the save
+    and drained by "python manage.py process_accounting sync_outbox"
+    '''
+    class OP(models.TextChoices):
+        CREATE = 'create', _('Create')
+        UPDATE = 'update', _('Update')
+        DELETE = 'delete', _('Delete')
+
+    class STATUS(models.TextChoices):
+        PENDING = 'pending', _('Pending')
+        PROCESSING = 'processing', _('Processing')
+        DONE = 'done', _('Done')
+        FAILED = 'failed', _('Failed')
+
+    tenant = models.ForeignKey(
+        Tenant, verbose_name=_('tenant'), on_delete=models.CASCADE,
+        related_name='%(class)s_tenant',
+        help_text=_('assignment of tenant / client'))
+    entity = models.CharField(
+        _('Entity'), max_length=100,
+        help_text=_('model label, e.g. accounting.account'))
+    connector = models.CharField(
+        _('Connector'), max_length=50,
+        help_text=_('class name in connector_cash_ctrl, e.g. Account'))
+    object_id = models.PositiveBigIntegerField(
+        _('Object id'), help_text=_('primary key of the record'))
+    c_id = models.PositiveIntegerField(
+        _('CashCtrl id'), null=True, blank=True,
+        help_text=_('needed for deletes, record is gone when processed'))
+    op = models.CharField(
+        _('Operation'), max_length=10, choices=OP.choices)
+    payload_hash = models.CharField(
+        _('Payload hash'), max_length=64, null=True, blank=True,
+        help_text=_('hash of the local data, used to skip duplicates'))
+    attempts = models.PositiveSmallIntegerField(_('Attempts'), default=0)
+    status = models.CharField(
+        _('Status'), max_length=20, choices=STATUS.choices,
+        default=STATUS.PENDING)
+    message = models.TextField(
+        _('Message'), null=True, blank=True,
+        help_text=_('last error message'))
+    created_at = models.DateTimeField(_('created at'), auto_now_add=True)
+    processed_at = models.DateTimeField(
+        _('processed at'), null=True, blank=True)
+    claimed_at = models.DateTimeField(
+        _('claimed at'), null=True, blank=True,
+        help_text=_('set when a worker starts processing, used to reclaim '
+                    'rows of crashed workers'))
+    next_attempt_at = models.DateTimeField(
+        _('next attempt at'), null=True, blank=True,
+        help_text=_('failed rows are retried not before this time'))
+
+    def __str__(self):
+        return f"{self.op} {self.entity} {self.object_id}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['tenant', 'status', 'id']),
+            models.Index(fields=['entity', 'object_id', 'status']),
+        ]
+        ordering = ['id']
+        verbose_name = _("Sync - Outbox")
+        verbose_name_plural = _("Sync - Outbox")
+
+
+class TenantSetupStep(models.Model):
+    '''
+    Checkpoint of the accounting setup of a tenant, see bootstrap.py
+    Finished steps are skipped if the setup is run again after a failure.
+    '''
+    tenant = models.ForeignKey(
+        Tenant, verbose_name=_('tenant'), on_delete=models.CASCADE,
+        related_name='%(class)s_tenant',
+        help_text=_('assignment of tenant / client'))
+    step = models.CharField(
+        _('Step'), max_length=50, help_text=_('name of the setup step'))
+    duration = models.FloatField(
+        _('Duration'), help_text=_('seconds needed for the step'))
+    finished_at = models.DateTimeField(_('finished at'), auto_now=True)
+
+    def __str__(self):
+        return f"{self.tenant_id} {self.step}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['tenant', 'step'],
+                name='unique_tenant_setup_step'
+            )
+        ]
+        ordering = ['id']
+        verbose_name = _("Sync - Setup Step")
+        verbose_name_plural = _("Sync - Setup Steps")
+
+
 # scerp entities with foreign key to Ledger ---------------------------------
 class Ledger(AcctApp):
     '''
@@ -2210,6 +2314,13 @@ class LedgerAccount(AcctApp):
         _('Balance last update'), null=True, blank=True,
         help_text=_('Date and time of last update of balance'))
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        ''' keep loaded values, ledger.LedgerRollUp needs the change '''
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
     @property
     def hrm_category(self):
         ''' return matching HRM_CATEGORY '''
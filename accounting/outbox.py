@@ -0,0 +1,380 @@
+'''
+accounting/outbox.py
+
+Outbox for cashCtrl sync
+
+Signal handlers do not call cashCtrl anymore but write a SyncOutbox row in
+the transaction of the save. The worker drains the outbox, in parallel for
+tenants, in order within a tenant:
+
+    python manage.py process_accounting sync_outbox --workers=4
+
+Set settings.CASH_CTRL_SYNC_ASYNC = False (or use inline()) to sync
+immediately as before.
+'''
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from threading import local
+import hashlib
+import json
+import logging
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.forms.models import model_to_dict
+from django.utils import timezone
+
+from . import connector_cash_ctrl as conn
+from .models import SyncOutbox
+
+
+logger = logging.getLogger(__name__)
+
+DECODE = 'utf-8'
+MAX_ATTEMPTS = 5  # afterwards the row is set to FAILED
+BACKOFF_SECONDS = 60  # wait before retry, doubled with every attempt
+STALE_CLAIM = timedelta(minutes=30)  # PROCESSING rows older are reclaimed
+WORKERS = 4  # tenants processed in parallel
+
+_state = local()
+
+
+# Mode
+def is_async():
+    if getattr(_state, 'inline', False):
+        return False
+    return getattr(settings, 'CASH_CTRL_SYNC_ASYNC', True)
+
+
+@contextmanager
+def inline():
+    ''' sync immediately within the block, e.g. if c_id is needed at once '''
+    previous = getattr(_state, 'inline', False)
+    _state.inline = True
+    try:
+        yield
+    finally:
+        _state.inline = previous
+
+
+@contextmanager
+def collect():
+    ''' collect ids of the rows enqueued within the block, e.g. for a
+        bootstrap step that uploads its own rows only
+    '''
+    previous = getattr(_state, 'collected', None)
+    _state.collected = ids = []
+    try:
+        yield ids
+    finally:
+        _state.collected = previous
+
+
+def add_collected(*ids):
+    collected = getattr(_state, 'collected', None)
+    if collected is not None:
+        collected.extend(x for x in ids if x)
+
+
+# Enqueue
+def get_payload_hash(connector, instance):
+    data = model_to_dict(instance, exclude=getattr(connector, 'exclude', []))
+    data_str = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(data_str.encode(DECODE)).hexdigest()
+
+
+def enqueue_save(connector, model, instance, created=None):
+    '''
+    add save of instance to outbox
+    A pending row of the same record is replaced by a new row at the end of
+    the queue so that dependencies saved in between get uploaded first.
+    '''
+    entity = model._meta.label_lower
+    payload_hash = get_payload_hash(connector, instance)
+    op = SyncOutbox.OP.CREATE if created else SyncOutbox.OP.UPDATE
+
+    # Coalesce with pending rows
+    pending = SyncOutbox.objects.filter(
+        entity=entity, object_id=instance.pk,
+        status=SyncOutbox.STATUS.PENDING
+    ).exclude(op=SyncOutbox.OP.DELETE)
+    previous = list(pending.values_list('id', 'op', 'payload_hash'))
+    if previous:
+        if previous[-1][2] == payload_hash:
+            add_collected(previous[-1][0])
+            return None  # nothing changed since last enqueue
+        if any(x[1] == SyncOutbox.OP.CREATE for x in previous):
+            op = SyncOutbox.OP.CREATE
+        pending.delete()
+
+    row = SyncOutbox.objects.create(
+        tenant_id=instance.tenant_id,
+        entity=entity,
+        connector=connector.__name__,
+        object_id=instance.pk,
+        c_id=instance.c_id,
+        op=op,
+        payload_hash=payload_hash
+    )
+    add_collected(row.id)
+    return row
+
+
+def enqueue_upsert(connector, model, instance, created=None):
+    '''
+    keep one pending row per record, moved to the end of the queue; unlike
+    enqueue_save the row is written even if the data of instance did not
+    change, e.g. for a person whose addresses changed
+    return row (None if a delete is pending) and True if coalesced
+    '''
+    entity = model._meta.label_lower
+    pending = SyncOutbox.objects.filter(
+        entity=entity, object_id=instance.pk,
+        status=SyncOutbox.STATUS.PENDING)
+    ops = set(pending.values_list('op', flat=True))
+    if SyncOutbox.OP.DELETE in ops:
+        return None, True  # record is being deleted
+    if ops:
+        pending.delete()
+
+    row = SyncOutbox.objects.create(
+        tenant_id=instance.tenant_id,
+        entity=entity,
+        connector=connector.__name__,
+        object_id=instance.pk,
+        c_id=instance.c_id,
+        op=(
+            SyncOutbox.OP.CREATE if created or SyncOutbox.OP.CREATE in ops
+            else SyncOutbox.OP.UPDATE),
+        payload_hash=get_payload_hash(connector, instance)
+    )
+    add_collected(row.id)
+    return row, bool(ops)
+
+
+def enqueue_bulk(connector, model, instances, created=None):
+    '''
+    add saves of many instances to outbox with one insert, e.g. for imports;
+    order of instances is kept, pending rows of the instances are replaced
+    '''
+    if not instances:
+        return []
+
+    entity = model._meta.label_lower
+    pending = SyncOutbox.objects.filter(
+        entity=entity, object_id__in=[x.pk for x in instances],
+        status=SyncOutbox.STATUS.PENDING
+    ).exclude(op=SyncOutbox.OP.DELETE)
+    pending_created = set(pending.filter(
+        op=SyncOutbox.OP.CREATE).values_list('object_id', flat=True))
+    pending.delete()
+
+    rows = SyncOutbox.objects.bulk_create([
+        SyncOutbox(
+            tenant_id=instance.tenant_id,
+            entity=entity,
+            connector=connector.__name__,
+            object_id=instance.pk,
+            c_id=instance.c_id,
+            op=(
+                SyncOutbox.OP.CREATE
+                if created or instance.pk in pending_created
+                else SyncOutbox.OP.UPDATE),
+            payload_hash=get_payload_hash(connector, instance)
+        ) for instance in instances
+    ])
+    add_collected(*[row.id for row in rows])  # if the db returns ids
+    return rows
+
+
+def enqueue_delete(connector, model, instance):
+    ''' add delete of instance to outbox, c_id is stored as record is gone '''
+    entity = model._meta.label_lower
+    SyncOutbox.objects.filter(
+        entity=entity, object_id=instance.pk,
+        status=SyncOutbox.STATUS.PENDING
+    ).delete()
+
+    row = SyncOutbox.objects.create(
+        tenant_id=instance.tenant_id,
+        entity=entity,
+        connector=connector.__name__,
+        object_id=instance.pk,
+        c_id=instance.c_id,
+        op=SyncOutbox.OP.DELETE
+    )
+    add_collected(row.id)
+    return row
+
+
+def save(connector, model, instance, created=None):
+    ''' called by signals_cash_ctrl instead of api.save '''
+    if is_async():
+        enqueue_save(connector, model, instance, created)
+    else:
+        api = connector(model)
+        api.save(instance, created)
+
+
+def delete(connector, model, instance):
+    ''' called by signals_cash_ctrl instead of api.delete '''
+    if is_async():
+        enqueue_delete(connector, model, instance)
+    else:
+        api = connector(model)
+        api.delete(instance)
+
+
+# Process
+def get_backoff(attempts):
+    ''' delay before the next attempt: 1, 2, 4, 8 ... minutes '''
+    return timedelta(seconds=BACKOFF_SECONDS * 2 ** max(attempts - 1, 0))
+
+
+def reclaim_stale(tenant_id=None):
+    '''
+    reset PROCESSING rows of crashed or killed workers to PENDING;
+    a row is stale if it was claimed longer than STALE_CLAIM ago
+    '''
+    queryset = SyncOutbox.objects.filter(
+        Q(claimed_at__lt=timezone.now() - STALE_CLAIM)
+        | Q(claimed_at__isnull=True),
+        status=SyncOutbox.STATUS.PROCESSING)
+    if tenant_id:
+        queryset = queryset.filter(tenant_id=tenant_id)
+    count = queryset.update(status=SyncOutbox.STATUS.PENDING, claimed_at=None)
+    if count:
+        logger.warning(f"tenant {tenant_id}: {count} stale rows reclaimed")
+    return count
+
+
+def report(model, object_id, message=None):
+    ''' show outcome in AcctApp fields, no signals '''
+    fields = {'message': message[:200] if message else None}
+    if not message:
+        fields['sync_to_accounting'] = False
+    model.objects.filter(pk=object_id).update(**fields)
+
+
+def process_row(row, force=False):
+    ''' upload row, return True if successful
+    force: send updates even if cashCtrl has the same data already
+    '''
+    model = apps.get_model(row.entity)
+    api = getattr(conn, row.connector)(model)
+
+    try:
+        if row.op == SyncOutbox.OP.DELETE:
+            # record does not exist anymore, use transient instance
+            instance = model(tenant_id=row.tenant_id, c_id=row.c_id)
+            api.delete(instance)
+        else:
+            instance = model.objects.filter(pk=row.object_id).first()
+            if instance is None:
+                row.message = 'record deleted before sync'
+            else:
+                api.save(
+                    instance, row.op == SyncOutbox.OP.CREATE, force=force)
+                report(model, row.object_id)
+        row.status = SyncOutbox.STATUS.DONE
+        success = True
+    except Exception as e:
+        row.attempts += 1
+        row.message = str(e)
+        row.status = (
+            SyncOutbox.STATUS.FAILED if row.attempts >= MAX_ATTEMPTS
+            else SyncOutbox.STATUS.PENDING)
+        row.next_attempt_at = timezone.now() + get_backoff(row.attempts)
+        if row.op != SyncOutbox.OP.DELETE:
+            report(model, row.object_id, str(e))
+        logger.error(f"{row}: {e}")
+        success = False
+
+    row.processed_at = timezone.now()
+    row.claimed_at = None
+    row.save(update_fields=[
+        'attempts', 'message', 'status', 'processed_at', 'claimed_at',
+        'next_attempt_at'])
+    return success
+
+
+def process_tenant(
+        tenant_id, max_count=None, close=True, force=False, ids=None):
+    '''
+    process pending rows of one tenant in order; after a failure further
+    rows of the same record are skipped to keep their order, same if a
+    row waits for its next attempt (backoff)
+    close: close db connection at the end, set False in the main thread
+    force: send unchanged data, see process_row
+    ids: process these rows only and at once, see collect()
+    '''
+    count = {'done': 0, 'failed': 0, 'skipped': 0}
+    failed = set()
+    try:
+        reclaim_stale(tenant_id)
+        now = timezone.now()
+        queryset = SyncOutbox.objects.filter(
+            tenant_id=tenant_id, status=SyncOutbox.STATUS.PENDING
+        ).order_by('id')
+        if ids is not None:
+            queryset = queryset.filter(id__in=ids)
+        if max_count:
+            queryset = queryset[:max_count]
+
+        for row in list(queryset):
+            key = (row.entity, row.object_id)
+            if key in failed:
+                count['skipped'] += 1
+                continue
+            if ids is None and row.next_attempt_at and (
+                    row.next_attempt_at > now):
+                failed.add(key)  # keep order of the record
+                count['skipped'] += 1
+                continue
+
+            # Claim row, another worker may be faster
+            claimed = SyncOutbox.objects.filter(
+                pk=row.pk, status=SyncOutbox.STATUS.PENDING
+            ).update(
+                status=SyncOutbox.STATUS.PROCESSING,
+                claimed_at=timezone.now())
+            if not claimed:
+                continue
+
+            if process_row(row, force):
+                count['done'] += 1
+            else:
+                count['failed'] += 1
+                failed.add(key)
+    finally:
+        if close:
+            connection.close()  # thread owns its connection
+
+    logger.info(f"tenant {tenant_id}: {count}")
+    return count
+
+
+def drain(workers=WORKERS, max_count=None, tenant_ids=None, force=False):
+    ''' process all pending rows that are due, tenants in parallel '''
+    reclaim_stale()
+    queryset = SyncOutbox.objects.filter(
+        Q(next_attempt_at__isnull=True)
+        | Q(next_attempt_at__lte=timezone.now()),
+        status=SyncOutbox.STATUS.PENDING)
+    if tenant_ids:
+        queryset = queryset.filter(tenant_id__in=tenant_ids)
+    tenant_ids = list(queryset.order_by('tenant_id').values_list(
+        'tenant_id', flat=True).distinct())
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            lambda tenant_id: process_tenant(
+                tenant_id, max_count, force=force),
+            tenant_ids)
+        results = dict(zip(tenant_ids, results))
+
+    logger.info(f"custom field cache: {conn.custom_field_cache_stats()}")
+    return results
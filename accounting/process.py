@@ -3,38 +3,281 @@ accounting/process.py
 
 usage:
    python manage.py process_accounting sync --org_name=test167 --ledger_id=1 --category=ic --max_count=100
+   python manage.py process_accounting refresh --org_name=test167 --entity=account
+   python manage.py process_accounting order_status --org_name=test167
+   python manage.py process_accounting sync_outgoing_order --days_back=5 --workers=4
 
 '''
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from datetime import timedelta
+from time import monotonic, sleep
+
+from django.db import connection, transaction
 from django.utils.timezone import now
 
-from .models import OutgoingOrder
+from core.models import Person, Tenant
+from . import api_cash_ctrl, connector_cash_ctrl as conn, outbox
+from .models import Account, IncomingOrder, OutgoingOrder
 
 
 logger = logging.getLogger(__name__)
 
+# entity: connector, model, create records not existing yet
+# orders are created in scerp, we only update them
+REFRESH = {
+    'account': (conn.Account, Account, True),
+    'person': (conn.Person, Person, True),
+    'incoming_order': (conn.IncomingOrder, IncomingOrder, False),
+    'outgoing_order': (conn.OutgoingOrder, OutgoingOrder, False),
+}
+
+
+def refresh(tenant, created_by, entities=None):
+    '''
+    incremental download of records changed in cashCtrl
+    returns {entity: {'created': n, 'updated': n, 'unchanged': n}}
+    '''
+    result = {}
+    for entity in entities or REFRESH:
+        connector, model, create = REFRESH[entity]
+        result[entity] = connector(model).get_changed(
+            tenant, created_by, create=create)
+    return result
+
 
-def sync_outgoing_order(days_back=5):
+class OutgoingOrderSync:
     '''
-    Set is_enabled_sync to True and save to trigger post_save.
+    upload unsynced outgoing orders; tenants in parallel, orders of a
+    tenant one by one in date order (the rate limiter is per tenant)
+
+    Every order is committed on its own, uploads to cashCtrl cannot be
+    rolled back. A failed attempt is rolled back and retried after a
+    delay, outside of any transaction; a c_id received meanwhile is
+    committed at once so the retry updates the order in cashCtrl instead
+    of creating it again.
     '''
-    start_date = now() - timedelta(days=days_back)
-    
-    queryset = OutgoingOrder.objects.filter(
-        date__gte=start_date,
-        is_enabled_sync=False
-    ).order_by('tenant', 'date')
+    WORKERS = 4  # tenants in parallel
+    TRIES = 3  # per order
+    RETRY_DELAY = 1  # seconds before the first retry, doubled afterwards
+
+    def __init__(
+            self, days_back=5, workers=WORKERS, tries=TRIES,
+            retry_delay=RETRY_DELAY):
+        self.days_back = days_back
+        self.workers = workers
+        self.tries = tries
+        self.retry_delay = retry_delay
 
-    count = queryset.count()
-    logger.info(
-        f"Found {count} unsynced OutgoingOrders from the past {days_back} "
-        "days.")
+    def get_orders(self):
+        ''' return {tenant_id: [order ids]} '''
+        start_date = now() - timedelta(days=self.days_back)
+        queryset = OutgoingOrder.objects.filter(
+            date__gte=start_date,
+            is_enabled_sync=False
+        ).order_by('tenant', 'date', 'id')
 
-    for instance in queryset:
+        orders = {}
+        for pk, tenant_id in queryset.values_list('id', 'tenant_id'):
+            orders.setdefault(tenant_id, []).append(pk)
+        return orders
+
+    @staticmethod
+    def upload(instance):
+        ''' save triggers the upload in post_save, inline to get errors '''
         instance.is_enabled_sync = True
-        instance.sync_accounting = True
-        instance.save()
-        logger.info(f"{instance} synched.")
+        instance.sync_to_accounting = True
+        with outbox.inline():
+            instance.save()
+
+    def process_order(self, pk, count):
+        ''' upload order pk, errors are counted, not raised '''
+        try:
+            instance = OutgoingOrder.objects.get(pk=pk)
+        except OutgoingOrder.DoesNotExist:
+            count['failed'] += 1
+            logger.error(f"OutgoingOrder {pk}: deleted before sync")
+            return
+
+        for attempt in range(self.tries):
+            c_id = instance.c_id
+            try:
+                with transaction.atomic():  # commit per order
+                    self.upload(instance)
+                count['done'] += 1
+                return
+            except Exception as e:
+                error = e
+                if instance.c_id and instance.c_id != c_id:
+                    # created in cashCtrl before the error, autocommit
+                    OutgoingOrder.objects.filter(pk=pk).update(
+                        c_id=instance.c_id, nr=instance.nr)
+                if attempt + 1 < self.tries:
+                    count['retries'] += 1
+                    sleep(self.retry_delay * 2 ** attempt)  # backoff
+
+        count['failed'] += 1
+        OutgoingOrder.objects.filter(pk=pk).update(message=str(error)[:200])
+        logger.error(f"{instance}: {error}")
+
+    def process_tenant(self, tenant_id, pks):
+        ''' runs in thread, return count '''
+        count = {'orders': len(pks), 'done': 0, 'failed': 0, 'retries': 0}
+        start = monotonic()
+        try:
+            for pk in pks:
+                try:
+                    self.process_order(pk, count)
+                except Exception as e:
+                    # e.g. database error, go on with the next order
+                    count['failed'] += 1
+                    logger.error(f"OutgoingOrder {pk}: {e}")
+        finally:
+            connection.close()  # thread owns its connection
+
+        seconds = monotonic() - start
+        count['seconds'] = round(seconds, 2)
+        count['per_minute'] = (
+            round(count['done'] * 60 / seconds, 1) if seconds else None)
+        logger.info(f"tenant {tenant_id}: {count}")
+        return count
+
+    def run(self):
+        ''' return {tenant_id: count} '''
+        orders = self.get_orders()
+        logger.info(
+            f"Found {sum(len(x) for x in orders.values())} unsynced "
+            f"OutgoingOrders from the past {self.days_back} days.")
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = executor.map(
+                lambda item: self.process_tenant(*item), orders.items())
+            return dict(zip(orders, results))
+
+
+SUMMARY_COLUMNS = (
+    'tenant', 'orders', 'done', 'failed', 'retries', 'seconds', 'per_minute')
+
+
+def make_summary(result):
+    ''' lines of a table of {tenant_id: count} '''
+    rows = [SUMMARY_COLUMNS] + [
+        (tenant_id, *(count[x] for x in SUMMARY_COLUMNS[1:]))
+        for tenant_id, count in result.items()
+    ]
+    return [''.join(f"{str(x):>12}" for x in row) for row in rows]
+
+
+def sync_outgoing_order(days_back=5, workers=OutgoingOrderSync.WORKERS):
+    '''
+    Upload unsynced outgoing orders, return {tenant_id: count}
+    '''
+    result = OutgoingOrderSync(days_back, workers).run()
+    for line in make_summary(result):
+        logger.info(line)
+    return result
+
+
+class OrderStatusSync:
+    '''
+    update status of orders from cashCtrl
+    the order list of every category is read page by page (includes the
+    status), orders not found there are read one by one in parallel;
+    status are written with bulk_update, i.e. without signals
+    '''
+    WORKERS = 4  # parallel reads, paced by the rate limiter
+    BATCH_SIZE = 500
+
+    def __init__(self, model, tenant, workers=WORKERS):
+        self.model = model
+        self.tenant = tenant
+        self.workers = workers
+        self.api = api_cash_ctrl.Order(
+            tenant.cash_ctrl_org_name, tenant.cash_ctrl_api_key)
+
+    @staticmethod
+    def get_status_map(category):
+        ''' {cashCtrl status id: status}, status_data is in STATUS order '''
+        return {
+            data['id']: status
+            for data, status in zip(
+                category.status_data or [], category._meta.model.STATUS)
+        }
+
+    def read_status(self, c_id):
+        ''' runs in thread, no db access '''
+        try:
+            return self.api.read(c_id).get('status_id')
+        except Exception as e:
+            logger.warning(f"order {c_id}: {e}")
+            return None
+
+    def get_status_ids(self, categories, c_ids):
+        ''' return {c_id: status id} '''
+        status_ids = {}
+        for category in categories:
+            try:
+                orders = self.api.list_paged({'categoryId': category.c_id})
+            except Exception as e:
+                logger.warning(f"{category}: list failed, {e}")
+                continue
+            status_ids.update({x['id']: x.get('status_id') for x in orders})
+
+        # Fallback
+        missing = [x for x in c_ids if status_ids.get(x) is None]
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                status_ids.update(
+                    zip(missing, executor.map(self.read_status, missing)))
+        return status_ids
+
+    def run(self, queryset=None):
+        ''' return {'updated': n, 'unchanged': n, 'failed': n} '''
+        if queryset is None:
+            queryset = self.model.objects.filter(tenant=self.tenant)
+        orders = list(
+            queryset.exclude(c_id=None).select_related('category'))
+        categories = {x.category_id: x.category for x in orders}
+        status_maps = {
+            pk: self.get_status_map(category)
+            for pk, category in categories.items()
+        }
+        status_ids = self.get_status_ids(
+            categories.values(), [x.c_id for x in orders])
+
+        count = {'updated': 0, 'unchanged': 0, 'failed': 0}
+        updates = []
+        for order in orders:
+            status = status_maps[order.category_id].get(
+                status_ids.get(order.c_id))
+            if status is None:
+                count['failed'] += 1
+            elif status == order.status:
+                count['unchanged'] += 1
+            else:
+                order.status = status
+                updates.append(order)
+
+        self.model.objects.bulk_update(
+            updates, ['status'], batch_size=self.BATCH_SIZE)
+        count['updated'] = len(updates)
+        logger.info(f"{self.tenant} {self.model.__name__} status: {count}")
+        return count
+
+
+def sync_order_status(org_names=None, workers=OrderStatusSync.WORKERS):
+    '''
+    update status of all orders of all tenants with cashCtrl, e.g. before
+    dunning; returns {(tenant, model name): count}
+    '''
+    tenants = Tenant.objects.exclude(cash_ctrl_org_name=None).exclude(
+        cash_ctrl_org_name='')
+    if org_names:
+        tenants = tenants.filter(cash_ctrl_org_name__in=org_names)
 
-    return count
+    result = {}
+    for tenant in tenants:
+        for model in (IncomingOrder, OutgoingOrder):
+            result[(tenant.cash_ctrl_org_name, model.__name__)] = (
+                OrderStatusSync(model, tenant, workers).run())
+    return result
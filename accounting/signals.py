@@ -2,10 +2,11 @@
 accounting/signals_cash_ctrl.py
 '''
 from django.conf import settings
-from django.db.models.signals import post_save, pre_save, pre_delete
+from django.db.models.signals import (
+    post_delete, post_save, pre_save, pre_delete)
 from django.dispatch import receiver
 
-from .ledger import Ledger
+from .ledger import Ledger, LedgerIndex, LedgerRollUp
 from .models import LedgerBalance, LedgerPL, LedgerIC
 
 
@@ -45,3 +46,22 @@ def ledger_ic_pre_save(sender, instance, **kwargs):
     if instance.sync_to_accounting:
         ledger = Ledger(sender, instance, **kwargs)
         instance = ledger.update()
+
+
+# Hierarchy index and category totals, all ledgers
+@receiver(post_save, sender=LedgerBalance)
+@receiver(post_save, sender=LedgerPL)
+@receiver(post_save, sender=LedgerIC)
+def ledger_post_save(sender, instance, created, **kwargs):
+    '''Signal handler for post_save signals on ledger positions '''
+    LedgerIndex.update(sender, instance)
+    LedgerRollUp(sender).update(instance, created=created)
+
+
+@receiver(post_delete, sender=LedgerBalance)
+@receiver(post_delete, sender=LedgerPL)
+@receiver(post_delete, sender=LedgerIC)
+def ledger_post_delete(sender, instance, **kwargs):
+    '''Signal handler for post_delete signals on ledger positions '''
+    LedgerIndex.update(sender, instance, deleted=True)
+    LedgerRollUp(sender).update(instance, deleted=True)
@@ -1,7 +1,9 @@
 '''
 accounting/signals_cash_ctrl.py
 '''
+from collections import Counter
 from decimal import Decimal
+from functools import partial
 import logging
 import time
 
@@ -20,27 +22,16 @@ from core.models import (
     PersonBankAccount
 )
 
-from scerp.mixins import read_yaml_file
 from . import connector_cash_ctrl as conn
-from . import models
+from . import models, outbox
+from .bootstrap import TenantBootstrap
 from .ledger import LedgerBalanceUpdate, LedgerPLUpdate, LedgerICUpdate
 
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
-
-ACCOUNT_SETUP_YAML = 'init_tenant.yaml'
-
 # Helpers
-def setup_data_add_logging(tenant, data):
-    ''' Add logging data to cashCtrl instances '''
-    data.update({
-        'created_by': tenant.created_by,
-        'sync_to_accounting': True,  # send to cashCtrl
-    })
-
-
 def sync(instance):
     return (
         instance.is_enabled_sync and instance.sync_to_accounting
@@ -76,146 +67,9 @@ def tenant_accounting_post_save(sender, instance, created=False, **kwargs):
         raise ValueError("Tenant has no cashCtrl api key")
         return
 
-    # Intro ---------------------------------------------------------------
-    tenant = instance
-
-    # shift core data to accounting
-    core_models = (
-        Title,
-        PersonCategory,
-        #Person,
-        Unit,
-        AssetCategory,
-        #Device
-    )
-    for model in core_models:
-        queryset = model.objects.filter(tenant=tenant, is_enabled_sync=False)
-        for obj in queryset.all():
-            obj.is_enabled_sync = True
-            obj.sync_to_accounting = True
-            obj.save()
-            logger.info(f"saved {obj}")
-
-    # Open yaml
-    init_data = read_yaml_file('accounting', ACCOUNT_SETUP_YAML)
-
-    # Create CustomFieldGroups
-    for data in init_data['CustomFieldGroup']:
-        setup_data_add_logging(tenant, data)
-        _obj, _created = models.CustomFieldGroup.objects.update_or_create(
-            tenant=tenant, code=data.pop('code'), defaults=data)
-    logger.info(f"saved CustomFieldGroups")
-
-    # Create CustomFields
-    for data in init_data['CustomField']:
-        data['group'] = models.CustomFieldGroup.objects.filter(
-            tenant=tenant, code=data.get('group_ref')).first()
-        if not data['group']:
-            raise ValueError(f"{data}: no group given")
-        setup_data_add_logging(tenant, data)
-        _obj, _created = models.CustomField.objects.update_or_create(
-            tenant=tenant, code=data.pop('code'), defaults=data)
-    logger.info(f"saved CustomFieldGroups")
-
-    # Create ArticleCategory
-    for data in init_data['ArticleCategory']:
-        setup_data_add_logging(tenant, data)
-        _obj, _created = models.ArticleCategory.objects.update_or_create(
-            tenant=tenant, code=data.pop('code'), defaults=data)
-    logger.info(f"saved CustomFieldGroups")
-
-    # Create FileCategory
-    for data in init_data['FileCategory']:
-        setup_data_add_logging(tenant, data)
-        _obj, _created = models.FileCategory.objects.update_or_create(
-            tenant=tenant, code=data.pop('code'), defaults=data)
-    logger.info(f"saved FileCategory")
-
-    # Create Order Layout
-    for data in init_data['OrderLayout']:
-        setup_data_add_logging(tenant, data)
-        _obj, _created = models.OrderLayout.objects.update_or_create(
-            tenant=tenant, name=data.pop('name'), defaults=data)
-    logger.info(f"saved OrderLayout")
-
-    # Get data from cashCtrl
-    # for the get we use delete_not_existing=False not to accidentially
-    # delete data
-
-    # Get Location
-    api = conn.Location(models.Location)
-    api.get(tenant, tenant.created_by, delete_not_existing=False)
-
-    # Get FiscalPeriod
-    api = conn.FiscalPeriod(models.FiscalPeriod)
-    api.get(tenant, tenant.created_by, delete_not_existing=False)
-
-    # Get Currency
-    api = conn.Currency(models.Currency)
-    api.get(tenant, tenant.created_by, delete_not_existing=False)
-
-    # Get SequenceNumber
-    api = conn.SequenceNumber(models.SequenceNumber)
-    api.get(tenant, tenant.created_by, delete_not_existing=False)
-
-    # Get CostCenterCategory
-    api = conn.CostCenterCategory(models.CostCenterCategory)
-    api.get(tenant, tenant.created_by, delete_not_existing=False)
-
-    # Get CostCenter
-    api = conn.CostCenter(models.CostCenter)
-    api.get(tenant, tenant.created_by, delete_not_existing=False)
-
-    # Get AccountCategory
-    api = conn.AccountCategory(models.AccountCategory)
-    api.get(tenant, tenant.created_by, delete_not_existing=False)
-
-    # Get Account
-    api = conn.Account(models.Account)
-    api.get(tenant, tenant.created_by, delete_not_existing=False)
-
-    # Get Rounding
-    api = conn.Rounding(models.Rounding)
-    api.get(tenant, tenant.created_by, delete_not_existing=False)
-
-    # Get Setting
-    api = conn.Setting(models.Setting)
-    api.get(tenant, tenant.created_by)
-
-    # Get Tax
-    api = conn.Tax(models.Tax)
-    api.get(tenant, tenant.created_by, delete_not_existing=False)
-
-    # Get BankAccount
-    api = conn.BankAccount(models.BankAccount)
-    api.get(tenant, tenant.created_by, delete_not_existing=False)
-
-    # Create AccountCategory, ER / IR categories like 3.1, 4.1 etc.
-    for data in init_data['AccountCategory']:
-        setup_data_add_logging(tenant, data)
-        data['parent'] = models.AccountCategory.objects.filter(
-            number=data.pop('parent_number')).first()
-        _obj, _created = models.AccountCategory.objects.update_or_create(
-            tenant=tenant, number=data.pop('number'), defaults=data)
-    logger.info(f"saved AccountCategory")
-
-    # Create Reporting
-    for data in init_data['Collection']:
-        setup_data_add_logging(tenant, data)
-        _obj, _created = models.Collection.objects.update_or_create(
-            tenant=tenant, code=data.pop('code'), defaults=data)
-    logger.info(f"saved Collection")
-
-    # Create Elements
-    for data in init_data['Element']:
-        data['collection'] = models.Collection.objects.filter(
-            tenant=tenant, code=data.pop('collection_ref')).first()
-        if not data['collection']:
-            raise ValueError(f"{data}: no collection given")
-        setup_data_add_logging(tenant, data)
-        _obj, _created = models.Element.objects.update_or_create(
-            tenant=tenant, code=data.pop('code'), defaults=data)
-    logger.info(f"saved Elements")
+    # Setup, continues after last finished step if run again
+    bootstrap = TenantBootstrap(instance)
+    bootstrap.run()
 
     # Update tenant
     instance.is_initialized_accounting = True
@@ -229,16 +83,14 @@ def tenant_accounting_post_save(sender, instance, created=False, **kwargs):
 def title_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on Title. '''
     if sync(instance):
-        api = conn.Title(sender)
-        api.save(instance, created)
+        outbox.save(conn.Title, sender, instance, created)
 
 
 @receiver(pre_delete, sender=Title)
 def title_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on Title. '''
     if sync_delete(instance):
-        api = conn.Title()
-        api.delete(instance)
+        outbox.delete(conn.Title, sender, instance)
 
 
 # PersonCategory
@@ -247,16 +99,14 @@ def person_category_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on PersonCategory. '''
     # BUG: seems not be synced !!!
     if sync(instance):
-        api = conn.PersonCategory(sender)
-        api.save(instance, created)
+        outbox.save(conn.PersonCategory, sender, instance, created)
 
 
 @receiver(pre_delete, sender=PersonCategory)
 def person_category_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on PersonCategory. '''
     if sync_delete(instance):
-        api = conn.PersonCategory()
-        api.delete(instance)
+        outbox.delete(conn.PersonCategory, sender, instance)
 
 
 # Person
@@ -268,48 +118,60 @@ def person_post_save(sender, instance, created, **kwargs):
     manytomany fields are done
     '''
     if sync(instance):
-        api = conn.Person(sender)
-        api.save(instance, created)
+        person_sync(instance, created)
 
 
 @receiver(pre_delete, sender=Person)
 def person_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on Person. '''
     if sync_delete(instance):
-        api = conn.Person()
-        api.delete(instance)
+        outbox.delete(conn.Person, sender, instance)
         instance._predeleted = True
 
 
 # Person-related entities
-def person_save(instance, created=None):
-    # Gets called whenever something changes with person
-    instance.sync_to_accounting = True
-    if sync(instance):
-        api = conn.Person(instance)
-        api.save(instance, created)
-
-
-def person_related_delete(instance):
-    # Gets called whenever some deletes are in action
-    person_id = instance.person_id  # still valid
-
-    def sync_if_person_exists():
-        try:
-            person = Person.objects.get(pk=person_id)
-        except Person.DoesNotExist:
-            return  # Person was deleted, do nothing
+'''
+Saving a person with addresses, contacts and bank accounts in one admin form
+fires one signal per row. Each of them upserts the one pending outbox row of
+the person in the transaction of the save, so the person is uploaded once
+with the committed data; a rollback drops the row with everything else.
+'''
+person_sync_counter = Counter()  # requested, saved
+
+
+def person_sync(person, created=None):
+    ''' enqueue upload of person, one pending row per person '''
+    person_sync_counter['requested'] += 1
+    row, coalesced = outbox.enqueue_upsert(
+        conn.Person, Person, person, created)
+    if coalesced:
+        person_sync_counter['saved'] += 1
+    if row and not outbox.is_async():
+        # upload after commit, a failed upload stays in the outbox
+        transaction.on_commit(partial(
+            outbox.process_tenant, person.tenant_id, close=False,
+            ids=[row.id]))
+
+
+def person_related_save(related):
+    # Gets called whenever an address, contact or bank account is saved
+    person = Person.objects.filter(
+        pk=related.person_id).select_related('tenant').first()
+    if person:
         person.sync_to_accounting = True
         if sync(person):
-            api = conn.Person(person)
-            api.save(person)
+            person_sync(person)
+
 
-    transaction.on_commit(sync_if_person_exists)
+def person_related_delete(related):
+    # Gets called whenever some deletes are in action, the person is gone
+    # or has a pending delete if it is deleted itself
+    person_related_save(related)
 
 
 @receiver(post_save, sender=PersonAddress)
 def person_address_post_save(sender, instance, created, **kwargs):
-    person_save(instance.person)
+    person_related_save(instance)
 
 
 @receiver(post_delete, sender=PersonAddress)
@@ -319,7 +181,7 @@ def person_address_post_delete(sender, instance, **kwargs):
 
 @receiver(post_save, sender=PersonContact)
 def person_contact_post_save(sender, instance, created, **kwargs):
-    person_save(instance.person)
+    person_related_save(instance)
 
 
 @receiver(post_delete, sender=PersonContact)
@@ -330,7 +192,7 @@ def person_contact_post_delete(sender, instance, **kwargs):
 
 @receiver(post_save, sender=PersonBankAccount)
 def person_bank_account_post_save(sender, instance, created, **kwargs):
-    person_save(instance.person)
+    person_related_save(instance)
 
 
 @receiver(post_delete, sender=PersonBankAccount)
@@ -345,16 +207,14 @@ def person_bank_account_post_delete(sender, instance, **kwargs):
 def unit_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on Unit. '''
     if sync(instance):
-        api = conn.Unit(sender)
-        api.save(instance, created)
+        outbox.save(conn.Unit, sender, instance, created)
 
 
 @receiver(pre_delete, sender=Unit)
 def unit_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on Unit. '''
     if sync_delete(instance):
-        api = conn.Unit(sender)
-        api.delete(instance)
+        outbox.delete(conn.Unit, sender, instance)
 
 
 # AssetCategory
@@ -362,16 +222,14 @@ def unit_pre_delete(sender, instance, **kwargs):
 def asset_category_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on AssetCategory. '''
     if sync(instance):
-        api = conn.AssetCategory(sender)
-        api.save(instance, created)
+        outbox.save(conn.AssetCategory, sender, instance, created)
 
 
 @receiver(pre_delete, sender=AssetCategory)
 def asset_category_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on AssetCategory. '''
     if sync_delete(instance):
-        api = conn.AssetCategory(sender)
-        api.delete(instance)
+        outbox.delete(conn.AssetCategory, sender, instance)
 
 
 # Device
@@ -381,16 +239,14 @@ def device_post_save(sender, instance, created, **kwargs):
     return
     # disabeld for now
     if sync(instance):
-        api = conn.Asset(sender)
-        api.save(instance, created)
+        outbox.save(conn.Asset, sender, instance, created)
 
 
 @receiver(pre_delete, sender=Device)
 def device_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on Device. '''
     if sync_delete(instance):
-        api = conn.Asset(sender)
-        api.delete(instance)
+        outbox.delete(conn.Asset, sender, instance)
 
 
 # accounting.models ----------------------------------------------------------
@@ -403,33 +259,31 @@ Note that instances only get synced if saved in scerp (
 def custom_field_group_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on CustomFieldGroup. '''
     if sync(instance):
-        api = conn.CustomFieldGroup(sender)
-        api.save(instance, created)
+        outbox.save(conn.CustomFieldGroup, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.CustomFieldGroup)
 def custom_field_group_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on CustomFieldGroup. '''
     if sync_delete(instance):
-        api = conn.CustomFieldGroup(sender)
-        api.delete(instance)
+        outbox.delete(conn.CustomFieldGroup, sender, instance)
 
 
 # CustomField
 @receiver(post_save, sender=models.CustomField)
 def custom_field_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on CustomField. '''
+    conn.invalidate_custom_fields(instance.tenant_id)
     if sync(instance):
-        api = conn.CustomField(sender)
-        api.save(instance, created)
+        outbox.save(conn.CustomField, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.CustomField)
 def custom_field_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on CustomField. '''
+    conn.invalidate_custom_fields(instance.tenant_id)
     if sync_delete(instance):
-        api = conn.CustomField(sender)
-        api.delete(instance)
+        outbox.delete(conn.CustomField, sender, instance)
 
 
 # FileCategory
@@ -437,16 +291,14 @@ def custom_field_pre_delete(sender, instance, **kwargs):
 def file_category_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on FileCategory. '''
     if sync(instance):
-        api = conn.FileCategory(sender)
-        api.save(instance, created)
+        outbox.save(conn.FileCategory, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.FileCategory)
 def file_category_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on FileCategory. '''
     if sync_delete(instance):
-        api = conn.FileCategory(sender)
-        api.delete(instance)
+        outbox.delete(conn.FileCategory, sender, instance)
 
 
 # FiscalPeriod
@@ -454,8 +306,7 @@ def file_category_pre_delete(sender, instance, **kwargs):
 def fiscal_period_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on FiscalPeriod. '''
     if sync(instance):
-        api = conn.FiscalPeriod(sender)
-        api.save(instance, created)
+        outbox.save(conn.FiscalPeriod, sender, instance, created)
 
 
 
@@ -464,16 +315,14 @@ def fiscal_period_post_save(sender, instance, created, **kwargs):
 def currency_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on Currency. '''
     if sync(instance):
-        api = conn.Currency(sender)
-        api.save(instance, created)
+        outbox.save(conn.Currency, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.Currency)
 def currency_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on Currency. '''
     if sync_delete(instance):
-        api = conn.Currency(sender)
-        api.delete(instance)
+        outbox.delete(conn.Currency, sender, instance)
 
 
 # CostCenterCategory
@@ -481,8 +330,7 @@ def currency_pre_delete(sender, instance, **kwargs):
 def cost_center_category_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on CostCenterCategory. '''
     if sync(instance):
-        api = conn.CostCenterCategory(sender)
-        api.save(instance, created)
+        outbox.save(conn.CostCenterCategory, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.CostCenterCategory)
@@ -495,8 +343,7 @@ def cost_center_category_pre_delete(sender, instance, **kwargs):
 
     # Send the external API request
     if sync_delete(instance):
-        api = conn.CostCenterCategory(sender)
-        api.delete(instance)
+        outbox.delete(conn.CostCenterCategory, sender, instance)
 
 
 # CostCenter
@@ -504,16 +351,14 @@ def cost_center_category_pre_delete(sender, instance, **kwargs):
 def cost_center_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on CostCenter. '''
     if sync(instance):
-        api = conn.CostCenter(sender)
-        api.save(instance, created)
+        outbox.save(conn.CostCenter, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.CostCenter)
 def cost_center_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on CostCenter. '''
     if sync_delete(instance):
-        api = conn.CostCenter(sender)
-        api.delete(instance)
+        outbox.delete(conn.CostCenter, sender, instance)
 
 
 # AccountCategory
@@ -521,8 +366,7 @@ def cost_center_pre_delete(sender, instance, **kwargs):
 def account_category_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on AccountCategory. '''
     if sync(instance):
-        api = conn.AccountCategory(sender)
-        api.save(instance, created)
+        outbox.save(conn.AccountCategory, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.AccountCategory)
@@ -539,8 +383,7 @@ def account_category_pre_delete(sender, instance, **kwargs):
 
     # Send the external API request
     if sync_delete(instance):
-        api = conn.AccountCategory(sender)
-        api.delete(instance)
+        outbox.delete(conn.AccountCategory, sender, instance)
 
 
 # Account
@@ -548,16 +391,14 @@ def account_category_pre_delete(sender, instance, **kwargs):
 def account_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on Account. '''
     if sync(instance):
-        api = conn.Account(sender)
-        api.save(instance, created)
+        outbox.save(conn.Account, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.Account)
 def account_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on Account. '''
     if sync_delete(instance):
-        api = conn.Account(sender)
-        api.delete(instance)
+        outbox.delete(conn.Account, sender, instance)
 
 
 # BankAccount
@@ -565,16 +406,14 @@ def account_pre_delete(sender, instance, **kwargs):
 def bank_account_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on Bank Account. '''
     if sync(instance):
-        api = conn.BankAccount(sender)
-        api.save(instance, created)
+        outbox.save(conn.BankAccount, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.BankAccount)
 def bank_account_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on Bank Account. '''
     if sync_delete(instance):
-        api = conn.BankAccount(sender)
-        api.delete(instance)
+        outbox.delete(conn.BankAccount, sender, instance)
 
 
 # Rounding
@@ -582,16 +421,14 @@ def bank_account_pre_delete(sender, instance, **kwargs):
 def rounding_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on Rounding. '''
     if sync(instance):
-        api = conn.Rounding(sender)
-        api.save(instance, created)
+        outbox.save(conn.Rounding, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.Rounding)
 def rounding_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on Rounding. '''
     if sync_delete(instance):
-        api = conn.Rounding(sender)
-        api.delete(instance)
+        outbox.delete(conn.Rounding, sender, instance)
 
 
 # Tax
@@ -599,16 +436,14 @@ def rounding_pre_delete(sender, instance, **kwargs):
 def tax_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on Tax. '''
     if sync(instance):
-        api = conn.Tax(sender)
-        api.save(instance, created)
+        outbox.save(conn.Tax, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.Tax)
 def tax_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on Tax. '''
     if sync_delete(instance):
-        api = conn.Tax(sender)
-        api.delete(instance)
+        outbox.delete(conn.Tax, sender, instance)
 
 
 # SequenceNumber
@@ -616,16 +451,14 @@ def tax_pre_delete(sender, instance, **kwargs):
 def sequence_number_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on SequenceNumber. '''
     if sync(instance):
-        api = conn.SequenceNumber(sender)
-        api.save(instance, created)
+        outbox.save(conn.SequenceNumber, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.SequenceNumber)
 def sequence_number_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on SequenceNumber. '''
     if sync_delete(instance):
-        api = conn.SequenceNumber(sender)
-        api.delete(instance)
+        outbox.delete(conn.SequenceNumber, sender, instance)
 
 
 # Journal
@@ -633,16 +466,14 @@ def sequence_number_pre_delete(sender, instance, **kwargs):
 def journal_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on Journal. '''
     if sync(instance):
-        api = conn.Journal(sender)
-        api.save(instance, created)
+        outbox.save(conn.Journal, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.Journal)
 def journal_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on Journal. '''
     if sync_delete(instance):
-        api = conn.Journal(sender)
-        api.delete(instance)
+        outbox.delete(conn.Journal, sender, instance)
 
 
 # ArticleCategory
@@ -650,16 +481,14 @@ def journal_pre_delete(sender, instance, **kwargs):
 def article_category_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on ArticleCategory. '''
     if sync(instance):
-        api = conn.ArticleCategory(sender)
-        api.save(instance, created)
+        outbox.save(conn.ArticleCategory, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.ArticleCategory)
 def article_category_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on ArticleCategory. '''
     if sync_delete(instance):
-        api = conn.ArticleCategory(sender)
-        api.delete(instance)
+        outbox.delete(conn.ArticleCategory, sender, instance)
 
 
 # Article
@@ -667,16 +496,14 @@ def article_category_pre_delete(sender, instance, **kwargs):
 def article_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on Article. '''
     if sync(instance):
-        api = conn.Article(sender)
-        api.save(instance, created)
+        outbox.save(conn.Article, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.Article)
 def article_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on Article. '''
     if sync_delete(instance):
-        api = conn.Article(sender)
-        api.delete(instance)
+        outbox.delete(conn.Article, sender, instance)
 
 
 # OrderLayout
@@ -684,16 +511,14 @@ def article_pre_delete(sender, instance, **kwargs):
 def order_layout_contract_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on OrderLayout. '''
     if sync(instance):
-        api = conn.OrderLayout(sender)
-        api.save(instance, created)
+        outbox.save(conn.OrderLayout, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.OrderLayout)
 def order_layout_contract_post_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on OrderLayout. '''
     if sync_delete(instance):
-        api = conn.OrderLayout(sender)
-        api.delete(instance)
+        outbox.delete(conn.OrderLayout, sender, instance)
 
 
 # OrderCategoryContract
@@ -706,16 +531,14 @@ def order_category_contract_post_save(sender, instance, created, **kwargs):
         instance.block_update = False  # reset
         instance.save()
     elif sync(instance):
-        api = conn.OrderCategoryContract(sender)
-        api.save(instance, created)
+        outbox.save(conn.OrderCategoryContract, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.OrderCategoryContract)
 def order_category_contract_post_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on OrderCategoryContract. '''
     if sync_delete(instance):
-        api = conn.OrderCategoryContract(sender)
-        api.delete(instance)
+        outbox.delete(conn.OrderCategoryContract, sender, instance)
 
 
 # OrderCategoryIncoming
@@ -728,16 +551,14 @@ def order_category_incoming_post_save(sender, instance, created, **kwargs):
         instance.block_update = False  # reset
         instance.save()
     elif sync(instance):
-        api = conn.OrderCategoryIncoming(sender)
-        api.save(instance, created)
+        outbox.save(conn.OrderCategoryIncoming, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.OrderCategoryIncoming)
 def order_category_incoming_post_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on OrderCategoryIncoming. '''
     if sync_delete(instance):
-        api = conn.OrderCategoryIncoming(sender)
-        api.delete(instance)
+        outbox.delete(conn.OrderCategoryIncoming, sender, instance)
 
 
 # OrderCategoryOutgoing
@@ -750,16 +571,14 @@ def order_category_outgoing_post_save(sender, instance, created, **kwargs):
         instance.block_update = False  # reset
         instance.save()
     elif sync(instance):
-        api = conn.OrderCategoryOutgoing(sender)
-        api.save(instance, created)
+        outbox.save(conn.OrderCategoryOutgoing, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.OrderCategoryOutgoing)
 def order_category_outgoing_post_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on OrderCategoryOutgoing. '''
     if sync_delete(instance):
-        api = conn.OrderCategoryOutgoing(sender)
-        api.delete(instance)
+        outbox.delete(conn.OrderCategoryOutgoing, sender, instance)
 
 
 # ContractOrder
@@ -767,16 +586,14 @@ def order_category_outgoing_post_pre_delete(sender, instance, **kwargs):
 def order_contract_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on OrderContract. '''
     if sync(instance):
-        api = conn.OrderContract(sender)
-        api.save(instance, created)
+        outbox.save(conn.OrderContract, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.OrderContract)
 def order_contract_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on OrderContract. '''
     if sync_delete(instance):
-        api = conn.OrderContract(sender)
-        api.delete(instance)
+        outbox.delete(conn.OrderContract, sender, instance)
 
 
 # Incomingitem, related to IncomingOrder
@@ -784,8 +601,8 @@ def incoming_order_save(instance, created=None):
     # Gets called whenever something changes with IncomingOrder
     instance.sync_to_accounting = True
     if sync(instance):
-        api = conn.IncomingOrder(instance)
-        api.save(instance, created)
+        outbox.save(
+            conn.IncomingOrder, models.IncomingOrder, instance, created)
 
 
 def incoming_order_related_delete(instance):
@@ -799,8 +616,7 @@ def incoming_order_related_delete(instance):
             return  # IncomingOrder was deleted, do nothing
         order.sync_to_accounting = True
         if sync(order):
-            api = conn.IncomingOrder(order)
-            api.save(order)
+            outbox.save(conn.IncomingOrder, models.IncomingOrder, order)
 
     transaction.on_commit(sync_if_order_exists)
 
@@ -820,16 +636,14 @@ def incoming_item_post_delete(sender, instance, **kwargs):
 def incoming_order_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on IncomingOrder. '''
     if sync(instance):
-        api = conn.IncomingOrder(sender)
-        api.save(instance, created)
+        outbox.save(conn.IncomingOrder, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.IncomingOrder)
 def incoming_order_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on IncomingOrder. '''
     if sync_delete(instance):
-        api = conn.IncomingOrder(sender)
-        api.delete(instance)
+        outbox.delete(conn.IncomingOrder, sender, instance)
 
 
 # OutgoingOrder
@@ -840,16 +654,14 @@ def outgoing_order_post_save(sender, instance, created, **kwargs):
     OutgoingItem gets own signal (see below)
     '''
     if sync(instance):
-        api = conn.OutgoingOrder(sender)
-        api.save(instance, created)
+        outbox.save(conn.OutgoingOrder, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.OutgoingOrder)
 def outgoing_order_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on OutgoingOrder. '''
     if sync_delete(instance):
-        api = conn.OutgoingOrder(sender)
-        api.delete(instance)
+        outbox.delete(conn.OutgoingOrder, sender, instance)
 
 
 # OutgoingItem, related to OutgoingOrder
@@ -857,8 +669,8 @@ def outgoing_order_save(instance, created=None):
     # Gets called whenever something changes with OutgoingOrder
     instance.sync_to_accounting = True
     if sync(instance):
-        api = conn.OutgoingOrder(instance)
-        api.save(instance, created)
+        outbox.save(
+            conn.OutgoingOrder, models.OutgoingOrder, instance, created)
 
 
 def outgoing_order_related_delete(instance):
@@ -872,8 +684,7 @@ def outgoing_order_related_delete(instance):
             return  # OutgoingOrder was deleted, do nothing
         order.sync_to_accounting = True
         if sync(order):
-            api = conn.OutgoingOrder(order)
-            api.save(order)
+            outbox.save(conn.OutgoingOrder, models.OutgoingOrder, order)
 
     transaction.on_commit(sync_if_order_exists)
 
@@ -893,32 +704,28 @@ def outgoing_item_post_delete(sender, instance, **kwargs):
 def collection_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on Collection. '''
     if sync(instance):
-        api = conn.Collection(sender)
-        api.save(instance, created)
+        outbox.save(conn.Collection, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.Collection)
 def collection_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on Collection. '''
     if sync_delete(instance):
-        api = conn.Collection(sender)
-        api.delete(instance)
+        outbox.delete(conn.Collection, sender, instance)
 
 
 @receiver(post_save, sender=models.Element)
 def element_post_save(sender, instance, created, **kwargs):
     '''Signal handler for post_save signals on Element. '''
     if sync(instance):
-        api = conn.Element(sender)
-        api.save(instance, created)
+        outbox.save(conn.Element, sender, instance, created)
 
 
 @receiver(pre_delete, sender=models.Element)
 def element_pre_delete(sender, instance, **kwargs):
     '''Signal handler for pre_delete signals on Element. '''
     if sync_delete(instance):
-        api = conn.Element(sender)
-        api.delete(instance)
+        outbox.delete(conn.Element, sender, instance)
 
 
 # Ledger ------------------------------------------------------------------
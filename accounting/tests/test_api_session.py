@@ -0,0 +1,102 @@
+# accounting/tests/test_api_session.py
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from .. import api_cash_ctrl as api
+from ..api_rate_limit import RateLimiter, BACKOFF_MAX
+
+
+class FakeResponse:
+    status_code = 200
+    ok = True
+
+    def __init__(self, content, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return self.content
+
+    def raise_for_status(self):
+        pass
+
+
+class SessionTests(SimpleTestCase):
+    '''
+    python manage.py test accounting.tests.test_api_session
+    '''
+    def setUp(self):
+        api.reset_request_counter()
+
+    def tearDown(self):
+        api.close_sessions()
+
+    def test_session_shared_per_org(self):
+        account = api.Account('org-a', 'key')
+        category = api.AccountCategory('org-a', 'key')
+        other = api.Account('org-b', 'key')
+        self.assertIs(account.session, category.session)
+        self.assertIsNot(account.session, other.session)
+
+    def test_get_sent_once(self):
+        ctrl = api.Account('org-a', 'key')
+        response = FakeResponse({'data': [{'id': 1, 'number': 1000}]})
+        with mock.patch.object(
+                ctrl.session, 'request', return_value=response) as request:
+            ctrl.list()
+
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(api.request_counter['GET account/list.json'], 1)
+
+    def test_post_counted(self):
+        ctrl = api.Account('org-a', 'key')
+        response = FakeResponse({'success': True, 'insertId': 7})
+        with mock.patch.object(
+                ctrl.session, 'request', return_value=response):
+            result = ctrl.create({'number': 1000})
+
+        self.assertEqual(result['insert_id'], 7)
+        self.assertEqual(api.request_counter['POST account/create.json'], 1)
+
+
+class RateLimiterTests(SimpleTestCase):
+    '''
+    python manage.py test accounting.tests.test_api_session.RateLimiterTests
+    '''
+    def tearDown(self):
+        api.close_sessions()
+
+    def test_retry_after(self):
+        limiter = RateLimiter('org-a')
+        self.assertEqual(limiter.backoff(0, '3'), 3)
+        self.assertEqual(limiter.metrics()['retries'], 1)
+
+    def test_backoff_with_jitter(self):
+        limiter = RateLimiter('org-a')
+        for attempt in range(10):
+            wait = limiter.backoff(attempt)
+            self.assertLessEqual(wait, BACKOFF_MAX)
+            self.assertGreater(wait, 0)
+
+    def test_bucket_paces_requests(self):
+        limiter = RateLimiter('org-a', rate=1000, burst=2)
+        with mock.patch('accounting.api_rate_limit.sleep') as sleep:
+            for _ in range(5):
+                limiter.acquire()
+        self.assertEqual(limiter.metrics()['requests'], 5)
+        self.assertTrue(sleep.called)  # 3 requests beyond the burst
+
+    def test_get_retries_on_429(self):
+        ctrl = api.Account('org-c', 'key')
+        responses = [
+            FakeResponse({}, status_code=429, headers={'Retry-After': '0'}),
+            FakeResponse({'data': []})
+        ]
+        with mock.patch.object(
+                ctrl.session, 'request', side_effect=responses) as request:
+            self.assertEqual(ctrl.list(), [])
+
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual(ctrl.limiter.metrics()['retries'], 1)
@@ -0,0 +1,71 @@
+# accounting/tests/test_custom_field_cache.py
+from types import SimpleNamespace
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from .. import connector_cash_ctrl as conn
+
+
+class Model:
+    CUSTOM = [('function', 'function'), ('hrm', 'hrm')]
+
+    class _meta:
+        label_lower = 'accounting.test'
+
+
+CUSTOM_FIELDS = [
+    SimpleNamespace(code='function', custom_field_key='customField30'),
+    SimpleNamespace(code='hrm', custom_field_key='customField31'),
+]
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CustomFieldCacheTests(SimpleTestCase):
+    '''
+    python manage.py test accounting.tests.test_custom_field_cache
+    '''
+    def setUp(self):
+        cache.clear()
+        conn.custom_field_cache_counter.clear()
+        self.instance = SimpleNamespace(tenant_id=1)
+
+    def test_one_query_per_tenant_and_model(self):
+        api = conn.CashCtrl(Model)
+        with mock.patch.object(
+                conn.models.CustomField.objects, 'filter',
+                return_value=CUSTOM_FIELDS) as query:
+            for __ in range(10):
+                custom = api._init_custom_fields(self.instance)
+
+        self.assertEqual(query.call_count, 1)
+        self.assertEqual(
+            custom, {'function': 'customField30', 'hrm': 'customField31'})
+        self.assertEqual(conn.custom_field_cache_stats()['hit_rate'], 0.9)
+
+    def test_invalidate(self):
+        api = conn.CashCtrl(Model)
+        with mock.patch.object(
+                conn.models.CustomField.objects, 'filter',
+                return_value=CUSTOM_FIELDS) as query, \
+                mock.patch.object(
+                    conn.apps, 'get_models', return_value=[Model]), \
+                mock.patch.object(conn.transaction, 'on_commit'):
+            api._init_custom_fields(self.instance)
+            conn.invalidate_custom_fields(1)
+            api._init_custom_fields(self.instance)
+
+        self.assertEqual(query.call_count, 2)
+
+    def test_missing_not_cached(self):
+        api = conn.CashCtrl(Model)
+        with mock.patch.object(
+                conn.models.CustomField.objects, 'filter',
+                return_value=CUSTOM_FIELDS[:1]):
+            with self.assertRaises(ValueError):
+                api._init_custom_fields(self.instance)
+
+        key = conn.get_custom_field_cache_key(1, Model)
+        self.assertIsNone(cache.get(key))
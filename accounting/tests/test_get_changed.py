@@ -0,0 +1,96 @@
+# accounting/tests/test_get_changed.py
+from datetime import datetime, timezone
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from core.models import Tenant
+from .. import connector_cash_ctrl as conn
+from ..models import AccountCategory
+
+
+def make_data(c_id, number, last_updated, parent_id=None):
+    return {
+        'id': c_id,
+        'number': number,
+        'name': {'de': f"Kategorie {number}"},
+        'parent_id': parent_id,
+        'last_updated': last_updated,
+    }
+
+
+class GetChangedTests(TestCase):
+    '''
+    python manage.py test accounting.tests.test_get_changed
+    '''
+    T1 = datetime(2025, 1, 1, 10, 0, tzinfo=timezone.utc)
+    T2 = datetime(2025, 1, 2, 10, 0, tzinfo=timezone.utc)
+
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.tenant = Tenant.objects.create(
+            name='test', code='test', created_by=self.user)
+        self.connector = conn.AccountCategory(AccountCategory)
+        self.api = mock.MagicMock()
+        self.connector._get_api = mock.MagicMock(return_value=self.api)
+
+    def get_changed(self, data_list):
+        self.api.list.return_value = data_list
+        return self.connector.get_changed(self.tenant, self.user)
+
+    def make_category(self, c_id, number, last_updated):
+        return AccountCategory.objects.create(
+            tenant=self.tenant, created_by=self.user, c_id=c_id,
+            number=number, name={'de': 'alt'}, c_last_updated=last_updated)
+
+    def test_watermark_filter(self):
+        self.make_category(1, 3, self.T1)
+        self.get_changed([])
+
+        params = self.api.list.call_args.args[0]
+        self.assertEqual(params['filter'][0]['comparison'], 'ge')
+        self.assertEqual(params['filter'][0]['field'], 'lastUpdated')
+        self.assertEqual(self.connector.get_watermark(self.tenant), self.T1)
+
+    def test_compare_timestamps(self):
+        self.make_category(1, 3, self.T1)
+        self.make_category(2, 4, self.T1)
+
+        count = self.get_changed([
+            make_data(1, 3, self.T1),  # at watermark, already stored
+            make_data(2, 4, self.T2),
+        ])
+
+        self.assertEqual(
+            count, {'created': 0, 'updated': 1, 'unchanged': 1})
+        self.assertEqual(
+            AccountCategory.objects.get(c_id=1).name, {'de': 'alt'})
+        self.assertEqual(
+            AccountCategory.objects.get(c_id=2).name, {'de': 'Kategorie 4'})
+
+    def test_link_created(self):
+        # child comes before its parent, both new
+        count = self.get_changed([
+            make_data(11, 31, self.T2, parent_id=10),
+            make_data(10, 3, self.T2),
+        ])
+
+        self.assertEqual(count['created'], 2)
+        child = AccountCategory.objects.get(c_id=11)
+        self.assertEqual(child.parent.c_id, 10)
+
+    def test_preload_related(self):
+        self.make_category(1, 3, self.T1)
+        data_list = [
+            make_data(10 + nr, 30 + nr, self.T2, parent_id=1)
+            for nr in range(5)
+        ]
+        self.api.list.return_value = data_list
+
+        # watermark, existing, parents, insert and link_created
+        with self.assertNumQueries(9):
+            self.connector.get_changed(self.tenant, self.user)
+
+        self.assertEqual(
+            AccountCategory.objects.filter(parent__c_id=1).count(), 5)
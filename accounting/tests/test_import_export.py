@@ -0,0 +1,189 @@
+# accounting/tests/test_import_export.py
+from decimal import Decimal
+from io import BytesIO
+from unittest import mock
+
+import openpyxl
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+
+from core.models import Tenant
+from ..import_export import LedgerBalanceImportExport
+from ..models import (
+    Account, AccountCategory, FiscalPeriod, Ledger, LedgerBalance, SyncOutbox)
+
+
+ROWS = [
+    ('1', 'Aktiven', None, None),
+    ('10', 'Finanzvermögen', None, None),
+    ('100', 'Flüssige Mittel', None, None),
+    ('1000.01', 'Kasse', 100, 120),
+    ('1001.01', 'Post', 200, 180),
+    ('2', 'Passiven', None, None),
+    ('20', 'Fremdkapital', None, None),
+    ('2000.01', 'Kreditoren', 50, 60),
+]
+
+
+def make_workbook(rows):
+    wb = openpyxl.Workbook()
+    sheet = wb.active
+    sheet.append(['hrm', 'name', 'opening_balance', 'closing_balance'])
+    for row in rows:
+        sheet.append(row)
+    excel_file = BytesIO()
+    wb.save(excel_file)
+    excel_file.seek(0)
+    return excel_file
+
+
+@override_settings(CASH_CTRL_SYNC_ASYNC=True)
+class LedgerBalanceImportTests(TestCase):
+    '''
+    python manage.py test accounting.tests.test_import_export
+    '''
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.tenant = Tenant.objects.create(
+            name='test', code='test', created_by=self.user,
+            cash_ctrl_org_name='org', cash_ctrl_api_key='key')
+        period = FiscalPeriod.objects.create(
+            tenant=self.tenant, created_by=self.user, name='2025')
+        self.ledger = Ledger.objects.create(
+            tenant=self.tenant, created_by=self.user, code='2025',
+            period=period)
+        for number in (1, 2):
+            AccountCategory.objects.create(
+                tenant=self.tenant, created_by=self.user, c_id=number,
+                number=number, name={'de': f"Top {number}"})
+
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+        self.request._messages = CookieStorage(self.request)
+
+    def import_rows(self, rows):
+        handler = LedgerBalanceImportExport(
+            self.ledger, self.request, language='de')
+        return handler.update_or_get(make_workbook(rows))
+
+    def get_position(self, hrm):
+        return LedgerBalance.objects.select_related(
+            'parent', 'category__parent', 'account__category'
+        ).get(ledger=self.ledger, hrm=hrm)
+
+    def test_parents(self):
+        count = self.import_rows(ROWS)
+
+        self.assertEqual(count, {'created': 8, 'updated': 0})
+        parents = {
+            '1': None, '10': '1', '100': '10', '1000.01': '100',
+            '1001.01': '100', '2': None, '20': '2', '2000.01': '20'}
+        for hrm, parent in parents.items():
+            position = self.get_position(hrm)
+            self.assertEqual(
+                position.parent.hrm if position.parent else None, parent)
+        self.assertEqual(
+            self.get_position('1000.01').type, LedgerBalance.TYPE.ACCOUNT)
+        self.assertEqual(
+            self.get_position('100').type, LedgerBalance.TYPE.CATEGORY)
+
+    def test_numbering(self):
+        self.import_rows(ROWS)
+
+        # top categories are reused, below: function.side
+        position = self.get_position('1')
+        self.assertEqual(position.category.number, 1)
+        categories = {'10': ('10.1', 1), '100': ('100.1', '10.1'),
+                      '20': ('20.2', 2)}
+        for hrm, (number, parent) in categories.items():
+            category = self.get_position(hrm).category
+            self.assertEqual(category.number, Decimal(number))
+            self.assertEqual(category.parent.number, Decimal(parent))
+
+        accounts = {'1000.01': '100.1', '1001.01': '100.1',
+                    '2000.01': '20.2'}
+        for hrm, category in accounts.items():
+            account = self.get_position(hrm).account
+            self.assertEqual(account.number, Decimal(hrm))
+            self.assertEqual(account.category.number, Decimal(category))
+
+        self.assertEqual(AccountCategory.objects.count(), 5)
+        self.assertEqual(Account.objects.count(), 3)
+        self.assertTrue(all(LedgerBalance.objects.values_list(
+            'is_enabled_sync', flat=True)))
+
+    def test_totals(self):
+        self.import_rows(ROWS)
+
+        # categories are the totals of the accounts, no signals on import
+        totals = dict(LedgerBalance.objects.filter(
+            type=LedgerBalance.TYPE.CATEGORY
+        ).values_list('hrm', 'opening_balance'))
+        self.assertEqual(totals, {
+            '1': 300, '10': 300, '100': 300, '2': 50, '20': 50})
+
+    def test_outbox(self):
+        self.import_rows(ROWS)
+
+        rows = list(SyncOutbox.objects.order_by('id'))
+        self.assertEqual(
+            [x.entity for x in rows],
+            ['accounting.accountcategory'] * 3 + ['accounting.account'] * 3)
+        self.assertTrue(all(x.op == SyncOutbox.OP.CREATE for x in rows))
+        self.assertTrue(all(
+            x.status == SyncOutbox.STATUS.PENDING for x in rows))
+
+        # parents are uploaded first
+        numbers = [
+            AccountCategory.objects.get(pk=x.object_id).number
+            for x in rows[:3]]
+        self.assertLess(numbers.index(Decimal('10.1')),
+                        numbers.index(Decimal('100.1')))
+
+    def test_reimport_updates(self):
+        self.import_rows(ROWS)
+        ids = dict(LedgerBalance.objects.values_list('hrm', 'id'))
+
+        rows = [
+            ('1000.01', 'Kasse Hauptsitz', 110, 120) if x[0] == '1000.01'
+            else x for x in ROWS
+        ]
+        count = self.import_rows(rows)
+
+        self.assertEqual(count, {'created': 0, 'updated': 8})
+        self.assertEqual(
+            dict(LedgerBalance.objects.values_list('hrm', 'id')), ids)
+        self.assertEqual(AccountCategory.objects.count(), 5)
+        self.assertEqual(Account.objects.count(), 3)
+
+        position = self.get_position('1000.01')
+        self.assertEqual(position.opening_balance, Decimal(110))
+        self.assertEqual(position.account.name['de'], 'Kasse Hauptsitz')
+
+        # pending rows are replaced, not added
+        rows = SyncOutbox.objects.all()
+        self.assertEqual(rows.count(), 6)
+        self.assertTrue(all(x.op == SyncOutbox.OP.CREATE for x in rows))
+
+    def test_db_without_returned_ids(self):
+        # e.g. MySQL, bulk_create does not set the ids of created rows
+        with mock.patch.object(
+                type(connection.features), 'can_return_rows_from_bulk_insert',
+                False):
+            count = self.import_rows(ROWS)
+
+        self.assertEqual(count, {'created': 8, 'updated': 0})
+        self.assertEqual(AccountCategory.objects.count(), 5)
+        for hrm, category in {'1000.01': '100.1', '2000.01': '20.2'}.items():
+            account = self.get_position(hrm).account
+            self.assertEqual(account.number, Decimal(hrm))
+            self.assertEqual(account.category.number, Decimal(category))
+        self.assertEqual(
+            self.get_position('100').category.parent.number, Decimal('10.1'))
+        self.assertEqual(
+            sorted(SyncOutbox.objects.filter(
+                entity='accounting.account').values_list(
+                    'object_id', flat=True)),
+            sorted(Account.objects.values_list('id', flat=True)))
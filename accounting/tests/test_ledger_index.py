@@ -0,0 +1,115 @@
+# accounting/tests/test_ledger_index.py
+import logging
+import time
+
+from django.test import SimpleTestCase
+
+from scerp.mixins import (
+    PrefixTrie, find_first_match_in_nested_dict, index_nested_dict)
+
+logger = logging.getLogger(__name__)
+
+
+def make_report(size, width=10):
+    '''
+    synthetic cashCtrl report tree with size nodes, categories with
+    id 'category-<n>' and items, accounts with accountId
+    '''
+    count = 0
+
+    def node(level):
+        nonlocal count
+        count += 1
+        number = count
+        if level == 3 or count >= size:
+            return {
+                'accountId': number, 'endAmount': number,
+                'text': f'account {number}'}
+        items = []
+        for __ in range(width):
+            if count >= size:
+                break
+            items.append(node(level + 1))
+        return {
+            'id': f'category-{number}', 'endAmount': number, 'items': items}
+
+    return {'data': [node(0) for __ in range(width) if count < size]}, count
+
+
+class ReportIndexTests(SimpleTestCase):
+    '''
+    python manage.py test accounting.tests.test_ledger_index
+    '''
+    def test_same_result_as_search(self):
+        data, __ = make_report(500)
+        index = index_nested_dict(data, ['accountId', 'id'])
+        for key, values in index.items():
+            for value, node in values.items():
+                self.assertIs(
+                    node, find_first_match_in_nested_dict(data, key, value))
+
+    def test_first_match_wins(self):
+        data = {'items': [
+            {'accountId': 1, 'endAmount': 'first'},
+            {'items': [{'accountId': 1, 'endAmount': 'second'}]}
+        ]}
+        index = index_nested_dict(data, ['accountId'])
+        self.assertEqual(index['accountId'][1]['endAmount'], 'first')
+
+    def test_missing(self):
+        index = index_nested_dict({'items': []}, ['accountId', 'id'])
+        self.assertIsNone(index['accountId'].get(None))
+
+    def test_benchmark_5k_nodes(self):
+        data, size = make_report(5000)
+        index = index_nested_dict(data, ['accountId', 'id'])
+        lookups = [('accountId', x) for x in index['accountId']] + [
+            ('id', x) for x in index['id']]
+        self.assertEqual(len(lookups), size)
+
+        start = time.perf_counter()
+        index = index_nested_dict(data, ['accountId', 'id'])
+        found = [index[key].get(value) for key, value in lookups]
+        indexed = time.perf_counter() - start
+
+        # search a sample only, searching all takes seconds
+        sample = lookups[-200:]
+        start = time.perf_counter()
+        for key, value in sample:
+            find_first_match_in_nested_dict(data, key, value)
+        searched = (time.perf_counter() - start) * len(lookups) / len(sample)
+
+        self.assertTrue(all(found))
+        self.assertLess(indexed, searched)
+        logger.info(
+            f"{size} nodes: index {indexed:.4f}s, "
+            f"search (extrapolated) {searched:.4f}s")
+
+
+class PrefixTrieTests(SimpleTestCase):
+    '''
+    python manage.py test accounting.tests.test_ledger_index.PrefixTrieTests
+    '''
+    def setUp(self):
+        self.functions = ['0', '01', '011', '0110', '012', '02', '1', '10']
+        self.trie = PrefixTrie((x, x) for x in self.functions)
+
+    def test_parent_same_as_scan(self):
+        for code in self.functions + ['0111', '03', '2']:
+            expected = None
+            for function in self.functions:
+                if code.startswith(function) and len(function) < len(code):
+                    if not expected or len(function) > len(expected):
+                        expected = function
+            self.assertEqual(self.trie.longest_prefix(code), expected)
+
+    def test_descendants(self):
+        self.assertEqual(
+            sorted(self.trie.descendants('01')), ['011', '0110', '012'])
+        self.assertEqual(self.trie.descendants('2'), [])
+
+    def test_remove(self):
+        self.trie.remove('011')
+        self.assertIsNone(self.trie.get('011'))
+        self.assertEqual(self.trie.longest_prefix('0110'), '01')
+        self.assertEqual(self.trie.get('0110'), '0110')
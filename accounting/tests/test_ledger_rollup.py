@@ -0,0 +1,134 @@
+# accounting/tests/test_ledger_rollup.py
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+
+from core.models import Tenant
+from ..ledger import LedgerIndex, LedgerRollUp
+from ..models import FiscalPeriod, Ledger, LedgerBalance
+
+
+class LedgerRollUpTests(TestCase):
+    '''
+    python manage.py test accounting.tests.test_ledger_rollup
+
+    tree: 1 > 10 > 1000.01 (100), 1 > 11 > 1100.01 (50)
+    '''
+    def setUp(self):
+        LedgerIndex._indexes.clear()  # ids are reused after rollback
+        cache.clear()
+        self.user = User.objects.create(username='test')
+        self.tenant = Tenant.objects.create(
+            name='test', code='test', created_by=self.user)
+        period = FiscalPeriod.objects.create(
+            tenant=self.tenant, created_by=self.user, name='2025')
+        self.ledger = Ledger.objects.create(
+            tenant=self.tenant, created_by=self.user, code='2025',
+            period=period)
+
+        top = self.make_category('1')
+        self.make_category('10', top)
+        self.make_category('11', top)
+        self.make_account('1000.01', '10', 100)
+        self.make_account('1100.01', '11', 50)
+
+    def make_category(self, function, parent=None):
+        return LedgerBalance.objects.create(
+            tenant=self.tenant, created_by=self.user, ledger=self.ledger,
+            type=LedgerBalance.TYPE.CATEGORY, function=function, hrm=function,
+            name={'de': function}, parent=parent)
+
+    def make_account(self, hrm, function, opening_balance):
+        return LedgerBalance.objects.create(
+            tenant=self.tenant, created_by=self.user, ledger=self.ledger,
+            type=LedgerBalance.TYPE.ACCOUNT, function=function, hrm=hrm,
+            name={'de': hrm}, parent=self.get(function),
+            opening_balance=opening_balance)
+
+    def get(self, hrm):
+        return LedgerBalance.objects.get(ledger=self.ledger, hrm=hrm)
+
+    def get_totals(self):
+        return {
+            hrm: value or 0
+            for hrm, value in LedgerBalance.objects.filter(
+                ledger=self.ledger, type=LedgerBalance.TYPE.CATEGORY
+            ).values_list('hrm', 'opening_balance')
+        }
+
+    def assertTotals(self, expected):
+        self.assertEqual(self.get_totals(), {
+            key: Decimal(value) for key, value in expected.items()})
+
+    def test_created(self):
+        self.assertTotals({'1': 150, '10': 100, '11': 50})
+
+    def test_value_changed(self):
+        account = self.get('1000.01')
+        account.opening_balance = 130
+        with mock.patch.object(LedgerRollUp, 'rebuild') as rebuild:
+            account.save()
+            account.opening_balance = 120  # saved twice, e.g. LedgeUpdate
+            account.save()
+
+        rebuild.assert_not_called()
+        self.assertTotals({'1': 170, '10': 120, '11': 50})
+
+    def test_moved(self):
+        account = self.get('1000.01')
+        account.parent = self.get('11')
+        account.save()
+
+        self.assertTotals({'1': 150, '10': 0, '11': 150})
+
+    def test_category_moved(self):
+        category = self.get('11')
+        category.parent = self.get('10')
+        category.save()
+
+        self.assertTotals({'1': 150, '10': 150, '11': 50})
+
+    def test_deleted(self):
+        self.get('1000.01').delete()
+
+        self.assertTotals({'1': 50, '10': 0, '11': 50})
+
+    def test_deferred_rebuilds(self):
+        account = LedgerBalance.objects.only(
+            'ledger', 'type', 'parent', 'closing_balance').get(
+                ledger=self.ledger, hrm='1000.01')
+        account.closing_balance = 80
+
+        with mock.patch.object(
+                LedgerRollUp, 'rebuild', autospec=True,
+                side_effect=LedgerRollUp.rebuild) as rebuild:
+            account.save()
+
+        rebuild.assert_called_once_with(mock.ANY, self.ledger.id)
+        self.assertEqual(self.get('10').closing_balance, 80)
+        self.assertEqual(self.get('1').closing_balance, 80)
+
+    def test_rebuild_same_as_update(self):
+        account = self.get('1000.01')
+        account.opening_balance = 30
+        account.save()
+        self.make_account('1001.01', '10', 7)
+        account = self.get('1100.01')
+        account.parent = self.get('10')
+        account.save()
+        self.get('1001.01').delete()
+        incremental = self.get_totals()
+
+        LedgerBalance.objects.filter(
+            ledger=self.ledger, type=LedgerBalance.TYPE.CATEGORY
+        ).update(opening_balance=999)
+        updated = LedgerRollUp(LedgerBalance).rebuild(self.ledger.id)
+
+        self.assertEqual(updated, 3)
+        self.assertEqual(self.get_totals(), incremental)
+        self.assertTotals({'1': 80, '10': 80, '11': 0})
+        self.assertEqual(
+            LedgerRollUp(LedgerBalance).rebuild(self.ledger.id), 0)
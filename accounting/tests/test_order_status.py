@@ -0,0 +1,38 @@
+# accounting/tests/test_order_status.py
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from ..models import IncomingOrder, OrderCategoryIncoming
+from ..process import OrderStatusSync
+
+
+class OrderStatusSyncTests(SimpleTestCase):
+    '''
+    python manage.py test accounting.tests.test_order_status
+    '''
+    def setUp(self):
+        tenant = SimpleNamespace(
+            cash_ctrl_org_name='org', cash_ctrl_api_key='key')
+        self.sync = OrderStatusSync(IncomingOrder, tenant)
+        self.sync.api = mock.MagicMock()
+
+    def test_status_map(self):
+        category = OrderCategoryIncoming(
+            status_data=[{'id': 10 + nr} for nr in range(3)])
+        status_map = self.sync.get_status_map(category)
+        status = list(OrderCategoryIncoming.STATUS)
+        self.assertEqual(
+            status_map, {10: status[0], 11: status[1], 12: status[2]})
+
+    def test_read_missing_only(self):
+        self.sync.api.list_paged.return_value = [
+            {'id': 1, 'status_id': 10}, {'id': 2, 'status_id': 11}]
+        self.sync.api.read.return_value = {'id': 3, 'status_id': 12}
+        category = SimpleNamespace(c_id=5)
+
+        status_ids = self.sync.get_status_ids([category], [1, 2, 3])
+
+        self.assertEqual(status_ids, {1: 10, 2: 11, 3: 12})
+        self.sync.api.read.assert_called_once_with(3)
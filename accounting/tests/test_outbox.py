@@ -0,0 +1,67 @@
+# accounting/tests/test_outbox.py
+from datetime import timedelta
+from unittest import mock
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from .. import outbox
+from ..models import SyncOutbox
+
+
+class OutboxRetryTests(SimpleTestCase):
+    '''
+    python manage.py test accounting.tests.test_outbox
+    '''
+    def make_row(self, attempts=0):
+        row = SyncOutbox(
+            tenant_id=1, entity='accounting.account', connector='Account',
+            object_id=1, op=SyncOutbox.OP.UPDATE, attempts=attempts,
+            status=SyncOutbox.STATUS.PROCESSING, claimed_at=timezone.now())
+        row.save = mock.MagicMock()
+        return row
+
+    def test_backoff(self):
+        self.assertEqual(outbox.get_backoff(1), timedelta(minutes=1))
+        self.assertEqual(outbox.get_backoff(3), timedelta(minutes=4))
+
+    @mock.patch.object(outbox, 'apps')
+    @mock.patch.object(outbox, 'report')
+    @mock.patch.object(outbox, 'conn')
+    def test_failure_sets_next_attempt(self, conn, report, apps):
+        conn.Account.return_value.save.side_effect = Exception('timeout')
+        row = self.make_row()
+
+        self.assertFalse(outbox.process_row(row))
+
+        self.assertEqual(row.status, SyncOutbox.STATUS.PENDING)
+        self.assertEqual(row.attempts, 1)
+        self.assertIsNone(row.claimed_at)
+        self.assertGreater(row.next_attempt_at, timezone.now())
+
+    @mock.patch.object(outbox, 'apps')
+    @mock.patch.object(outbox, 'report')
+    @mock.patch.object(outbox, 'conn')
+    def test_last_attempt_fails(self, conn, report, apps):
+        conn.Account.return_value.save.side_effect = Exception('timeout')
+        row = self.make_row(attempts=outbox.MAX_ATTEMPTS - 1)
+
+        outbox.process_row(row)
+
+        self.assertEqual(row.status, SyncOutbox.STATUS.FAILED)
+
+
+class OutboxCollectTests(SimpleTestCase):
+    '''
+    python manage.py test accounting.tests.test_outbox
+    '''
+    def test_collect(self):
+        outbox.add_collected(1)  # outside, ignored
+        with outbox.collect() as ids:
+            outbox.add_collected(2, None, 3)
+            with outbox.collect() as inner:
+                outbox.add_collected(4)
+            outbox.add_collected(5)
+
+        self.assertEqual(ids, [2, 3, 5])
+        self.assertEqual(inner, [4])
@@ -0,0 +1,122 @@
+# accounting/tests/test_outgoing_order_sync.py
+import datetime
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+
+from core.models import Person, PersonCategory, Tenant
+from .. import connector_cash_ctrl as conn
+from .. import process
+from ..models import (
+    Account, AccountCategory, BankAccount, Location, OrderCategoryContract,
+    OrderCategoryOutgoing, OrderContract, OutgoingOrder)
+from ..process import OutgoingOrderSync, make_summary
+
+
+class OutgoingOrderSyncTests(TestCase):
+    '''
+    python manage.py test accounting.tests.test_outgoing_order_sync
+    '''
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.tenant = Tenant.objects.create(
+            name='test', code='test', created_by=self.user)
+        logging = {'tenant': self.tenant, 'created_by': self.user}
+
+        person_category = PersonCategory.objects.create(
+            code='private', name={'de': 'Privat'}, **logging)
+        person = Person.objects.create(
+            category=person_category, last_name='Muster', **logging)
+        category = AccountCategory.objects.create(number=1, **logging)
+        account = Account.objects.create(
+            category=category, number=1100, **logging)
+        bank_account = BankAccount.objects.create(
+            account=account, bic='POFICHBEXXX', iban='CH9300762011623852957',
+            **logging)
+        order_category = OrderCategoryOutgoing.objects.create(
+            code='water', debit_account=account, bank_account=bank_account,
+            responsible_person=person, header='Wasser', **logging)
+        location = Location.objects.create(name='Gemeinde', **logging)
+        contract_category = OrderCategoryContract.objects.create(
+            code='water', org_location=location, **logging)
+        contract = OrderContract.objects.create(
+            category=contract_category, associate=person,
+            date=datetime.date.today(), contract_date=datetime.date.today(),
+            **logging)
+        self.order = OutgoingOrder.objects.create(
+            category=order_category, contract=contract, associate=person,
+            date=datetime.date.today(), is_enabled_sync=False, **logging)
+
+        # sync from now on, fixtures are not uploaded
+        Tenant.objects.filter(pk=self.tenant.pk).update(
+            cash_ctrl_org_name='org', cash_ctrl_api_key='key')
+
+        self.calls = []
+        for target, name in [
+                (conn, 'OutgoingOrder'), (process, 'sleep'),
+                (process, 'connection')]:  # keep the test transaction
+            patcher = mock.patch.object(target, name)
+            setattr(self, name.lower(), patcher.start())
+            self.addCleanup(patcher.stop)
+        self.outgoingorder.return_value.save.side_effect = self.save
+
+    def save(self, instance, created=None):
+        ''' cashCtrl creates the order, then the connection fails once '''
+        self.calls.append(instance.c_id)
+        if len(self.calls) == 1:
+            instance.c_id, instance.nr = 77, 'R-77'
+            raise Exception('timeout')
+
+    def test_retry(self):
+        count = OutgoingOrderSync().process_tenant(
+            self.tenant.id, [self.order.id])
+
+        self.assertEqual(
+            {key: count[key] for key in ('orders', 'done', 'failed',
+                                         'retries')},
+            {'orders': 1, 'done': 1, 'failed': 0, 'retries': 1})
+        self.sleep.assert_called_once_with(OutgoingOrderSync.RETRY_DELAY)
+
+        # the retry updates the order created before the error
+        self.assertEqual(self.calls, [None, 77])
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.c_id, self.order.nr), (77, 'R-77'))
+        self.assertTrue(self.order.is_enabled_sync)
+
+        lines = make_summary({self.tenant.id: count})
+        self.assertEqual(lines[0].split(), list(process.SUMMARY_COLUMNS))
+        self.assertEqual(
+            lines[1].split()[:5], [str(self.tenant.id), '1', '1', '0', '1'])
+
+    def test_failed(self):
+        self.outgoingorder.return_value.save.side_effect = Exception('down')
+
+        count = OutgoingOrderSync(tries=3).process_tenant(
+            self.tenant.id, [self.order.id])
+
+        self.assertEqual((count['failed'], count['retries']), (1, 2))
+        self.assertEqual(
+            [x.args[0] for x in self.sleep.call_args_list],
+            [OutgoingOrderSync.RETRY_DELAY, OutgoingOrderSync.RETRY_DELAY * 2])
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.message, 'down')
+        self.assertFalse(self.order.is_enabled_sync)
+
+    def test_sleep_outside_transaction(self):
+        depth = len(connection.atomic_blocks)  # of the test case
+        self.sleep.side_effect = lambda seconds: self.assertEqual(
+            len(connection.atomic_blocks), depth)
+
+        OutgoingOrderSync().process_tenant(self.tenant.id, [self.order.id])
+
+        self.sleep.assert_called_once()
+
+    def test_deleted_order(self):
+        count = OutgoingOrderSync().process_tenant(
+            self.tenant.id, [0, self.order.id])
+
+        self.assertEqual((count['failed'], count['done']), (1, 1))
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.c_id, 77)
@@ -0,0 +1,55 @@
+# accounting/tests/test_payload_hash.py
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from .. import connector_cash_ctrl as conn
+
+
+class Record:
+    objects = mock.MagicMock()
+
+    def __init__(self, **data):
+        self.data = data
+        self.pk = 1
+        self.c_id = 7
+        self.c_payload_hash = None
+        self.tenant = SimpleNamespace(
+            cash_ctrl_org_name='org', cash_ctrl_api_key='key')
+        self.tenant_id = 1
+
+
+class PayloadHashTests(SimpleTestCase):
+    '''
+    python manage.py test accounting.tests.test_payload_hash
+    '''
+    def setUp(self):
+        self.api = conn.CashCtrl()
+        self.api.exclude = []
+        self.api.api_class = mock.MagicMock()
+        patcher = mock.patch.object(
+            conn, 'model_to_dict', side_effect=lambda x, **kwargs: dict(x.data))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_unchanged_not_sent(self):
+        instance = Record(name='a', number=1000)
+        self.api.save(instance)
+        self.api.save(instance)
+        self.assertEqual(self.api.api.update.call_count, 1)
+
+        instance.data['name'] = 'b'
+        self.api.save(instance)
+        self.assertEqual(self.api.api.update.call_count, 2)
+
+    def test_force(self):
+        instance = Record(name='a')
+        self.api.save(instance)
+        self.api.save(instance, force=True)
+        self.assertEqual(self.api.api.update.call_count, 2)
+
+    def test_hash_normalized(self):
+        self.assertEqual(
+            conn.get_payload_hash({'a': 1, 'b': [1, 2]}),
+            conn.get_payload_hash({'b': [1, 2], 'a': 1}))
@@ -0,0 +1,100 @@
+# accounting/tests/test_person_batch.py
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.test import TestCase, override_settings
+
+from core.models import Person, PersonCategory, PersonContact, Tenant
+from .. import connector_cash_ctrl as conn
+from .. import signals_cash_ctrl as signals
+from ..models import SyncOutbox
+
+
+@override_settings(CASH_CTRL_SYNC_ASYNC=True)
+class PersonSyncTests(TestCase):
+    '''
+    python manage.py test accounting.tests.test_person_batch
+    '''
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.tenant = Tenant.objects.create(
+            name='test', code='test', created_by=self.user,
+            cash_ctrl_org_name='org', cash_ctrl_api_key='key')
+        self.logging = {'tenant': self.tenant, 'created_by': self.user}
+        self.category = PersonCategory.objects.create(
+            code='private', name={'de': 'Privat'}, **self.logging)
+
+    def make_person(self):
+        person = Person.objects.create(
+            category=self.category, last_name='Muster',
+            sync_to_accounting=True, **self.logging)
+        for address in ('a@example.com', 'b@example.com'):
+            PersonContact.objects.create(
+                person=person, type='EMAIL_WORK', address=address,
+                **self.logging)
+        return person
+
+    def get_rows(self):
+        return list(SyncOutbox.objects.filter(
+            entity='core.person').values_list('object_id', 'op', 'status'))
+
+    def test_one_row_per_person(self):
+        counter = signals.person_sync_counter.copy()
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                person = self.make_person()
+                # written in the transaction, not after commit
+                self.assertEqual(len(self.get_rows()), 1)
+
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.get_rows(), [
+            (person.pk, SyncOutbox.OP.CREATE, SyncOutbox.STATUS.PENDING)])
+        self.assertEqual(
+            signals.person_sync_counter['saved'] - counter['saved'], 2)
+
+    def test_related_change_enqueued(self):
+        person = self.make_person()
+        SyncOutbox.objects.update(status=SyncOutbox.STATUS.DONE)
+
+        PersonContact.objects.create(
+            person=person, type='EMAIL_WORK', address='c@example.com',
+            **self.logging)
+
+        self.assertIn(
+            (person.pk, SyncOutbox.OP.UPDATE, SyncOutbox.STATUS.PENDING),
+            self.get_rows())
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.make_person()
+                raise ValueError('form invalid')
+
+        self.assertEqual(self.get_rows(), [])
+
+    def test_deleted_person(self):
+        person = self.make_person()
+        Person.objects.filter(pk=person.pk).update(c_id=5)
+        SyncOutbox.objects.update(status=SyncOutbox.STATUS.DONE)
+
+        Person.objects.get(pk=person.pk).delete()  # contacts cascade
+
+        pending = SyncOutbox.objects.filter(
+            status=SyncOutbox.STATUS.PENDING)
+        self.assertEqual(
+            list(pending.values_list('op', 'c_id')),
+            [(SyncOutbox.OP.DELETE, 5)])
+
+    @override_settings(CASH_CTRL_SYNC_ASYNC=False)
+    @mock.patch.object(conn, 'Person')
+    def test_inline_upload_once_after_commit(self, connector):
+        connector.__name__ = 'Person'
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                person = self.make_person()
+                connector.return_value.save.assert_not_called()
+
+        connector.return_value.save.assert_called_once()
+        self.assertEqual(self.get_rows(), [
+            (person.pk, SyncOutbox.OP.CREATE, SyncOutbox.STATUS.DONE)])
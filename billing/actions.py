@@ -16,7 +16,7 @@ from scerp.mixins import primary_language, read_excel, safe_round
 
 from . import forms
 from .calc import (
-    PeriodCalc, RouteCounterExport,
+    PeriodCalc, MeasurementConsumption, RouteCounterExport,
     RouteCounterImport, RouteCounterInvoicing,
     Measurement, MeasurementAnalyse, convert_str_to_datetime
 )
@@ -52,12 +52,12 @@ def export_counter_data_json(modeladmin, request, queryset, data):
 
         key = 3 if data['key_enabled'] else None
         filename = data['filename']
-        print("*filename", filename)
         # Make and download json
         export = RouteCounterExport(
             modeladmin, request, route, data['responsible_user'].user,
             data['route_date'], key)
-        response = export.make_export_file(filename)
+        response = export.make_export_file(
+            filename, stream=data.get('stream', False))
 
         return response
 
@@ -72,9 +72,12 @@ def import_counter_data_json(modeladmin, request, queryset, data):
 
         # Import
         route_import = RouteCounterImport(modeladmin, request, route)
-        count = route_import.process(data['json_file'])
+        report = route_import.process(data['json_file'])
 
-        messages.info(request, _("%s counters updated.") % count)
+        messages.info(request, _("%s counters updated.") % report['created'])
+        if report['skipped']:
+            messages.info(
+                request, _("%s counters skipped.") % len(report['skipped']))
         messages.info(request, _("File uploaded and stored as attachment."))
 
 
@@ -126,17 +129,16 @@ def route_billing(modeladmin, request, queryset, data):
         invoice = RouteCounterInvoicing(
             modeladmin, request, route, data['status'], data['date'],
             is_enabled_sync)
-        count = 0
-        for subscription in subscriptions:
-            invoice_obj = invoice.bill(
-                subscription, route, data['check_measurement'])
-            if invoice_obj:
-                count += 1
+        invoices = invoice.bill_all(
+            subscriptions, data['check_measurement'], data.get('dry_run'))
 
         # output
+        if data.get('dry_run'):
+            msg = _("Dry run: {count} bills from {len} records possible.")
+        else:
+            msg = _("{count} bills from {len} records created.")
         messages.info(
-            request, _("{count} bills from {len} records created.").format(
-                count=count, len=len(subscriptions)))
+            request, msg.format(count=len(invoices), len=len(subscriptions)))
 
 
 @action_with_form(
@@ -239,12 +241,12 @@ def anaylse_measurent_excel(modeladmin, request, queryset, data):
 @admin.action(description=_("Calc Consumption"))
 def measurement_calc_consumption(modeladmin, request, queryset):
     if action_check_nr_selected(request, queryset, min_count=1):
-        for measurement in queryset.all():
-            measurement.save_consumption()
-            if measurement.consumption is None:
-                msg = _("{counter_id}: cannot retrieve consumption")
-                msg = msg.format(counter_id=measurement.counter.code)
-                messages.warning(request, msg)
+        count, missing = MeasurementConsumption(queryset).calc()
+        for _id, counter_code in missing:
+            msg = _("{counter_id}: cannot retrieve consumption")
+            msg = msg.format(counter_id=counter_code)
+            messages.warning(request, msg)
+        messages.info(request, _("{count} updated").format(count=count))
 
 
 @admin.action(description=_("Invoiced"))
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.admin.views.main import ChangeList
-from django.db.models import Count, Sum
+from django.db.models import Count, OuterRef, Prefetch, Subquery, Sum
 from django.utils.translation import gettext_lazy as _
 
 from core.admin import AttachmentInline
@@ -96,6 +96,10 @@ class RouteAdmin(TenantFilteringAdmin, BaseAdmin):
     # Safeguards
     protected_foreigns = ['tenant', 'version', 'period']
     protected_many_to_many = ['comparison_periods', 'asset_categories']
+    protected_prefetches = ['attachments']
+    protected_annotations = {
+        'subscription_count': Count('subscriptions', distinct=True)
+    }
 
     # Display these fields in the list view
     list_display = (
@@ -167,17 +171,20 @@ class RouteAdmin(TenantFilteringAdmin, BaseAdmin):
     def display_end(self, obj):
         return obj.get_end()
 
-    @admin.display(description=_('Number of Subscriptions'))
+    @admin.display(
+        description=_('Number of Subscriptions'),
+        ordering='subscription_count')
     def display_subscription_count(self, obj):
-        return obj.subscriptions.count()
+        return obj.subscription_count
 
 
 @admin.register(Measurement, site=admin_site)
 class MeasurementAdmin(TenantFilteringAdmin, BaseAdmin):
     # Safeguards
     protected_foreigns = [
-        'tenant', 'version', 'counter', 'route', 'address', 'period',
-        'subscription']
+        'tenant', 'version', 'counter', 'route__period', 'address__area',
+        'period', 'subscription', 'subscription__subscriber',
+        'invoice__contract__associate']
 
     # Display these fields in the list view
     list_display = (
@@ -353,6 +360,25 @@ class SubscriptionAdmin(TenantFilteringAdmin, BaseAdmin):
     protected_foreigns = [
         'tenant', 'version', 'dossier', 'subscriber', 'partner',
         'recipient', 'address', 'counter']
+    protected_prefetches = ['attachments']
+    protected_object_prefetches = [
+        'subscriber__personaddress_address__address',
+        'recipient__personaddress_address__address',
+        Prefetch(
+            'measurement_subscriber',
+            queryset=Measurement.objects.select_related(
+                'invoice', 'address', 'route__period', 'counter')),
+    ]
+    protected_annotations = {
+        'last_measurement_datetime': Subquery(
+            Measurement.objects.filter(
+                subscription=OuterRef('pk')
+            ).order_by('-datetime').values('datetime')[:1]),
+        'last_measurement_consumption': Subquery(
+            Measurement.objects.filter(
+                subscription=OuterRef('pk')
+            ).order_by('-datetime').values('consumption')[:1]),
+    }
     help_text = _(
         "A subscription has one counter and one unique address, "
         "one subscriber, possibly with partner and invoice company")
@@ -439,15 +465,16 @@ class SubscriptionAdmin(TenantFilteringAdmin, BaseAdmin):
     def display_counters(self, obj):
         return ','.join([x.__str__() for x in obj.counters.order_by('nr')])
 
-    @admin.display(description=_('Last Route / Measurement'))
+    @admin.display(
+        description=_('Last Route / Measurement'),
+        ordering='last_measurement_datetime')
     def last_measurement(self, obj):
-        measurement = obj.measurements.last()
-        if measurement and measurement.consumption:
-            return measurement.datetime.date()
+        if obj.last_measurement_consumption:
+            return obj.last_measurement_datetime.date()
 
     @admin.display(description=_('Measurements'))
     def display_measurements(self, obj):
-        return ', '.joins([f"{x}" for x in obj.measurements])
+        return ', '.join([f"{x}" for x in obj.measurements])
 
     def get_search_results(self, request, queryset, search_term):
         if search_term.startswith("S-" or search_term.startswith("s-")):
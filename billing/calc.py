@@ -6,21 +6,34 @@ import io
 import json
 import logging
 import openpyxl
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import Decimal
+from itertools import islice
 from openpyxl import Workbook
 from openpyxl.utils import get_column_letter
 from openpyxl.styles import Font, numbers
 
+try:
+    import ijson  # streaming json parser, optional
+except ImportError:
+    ijson = None
+
 from django.contrib import messages
-from django.db import transaction
-from django.db.models import Count, Sum, Min, Max, Q
-from django.http import HttpResponse
+from django.db import connection, transaction
+from django.core.cache import cache
+from django.db.models import (
+    BooleanField, Case, Count, Exists, F, Sum, Min, Max, Q, OuterRef,
+    Prefetch, Subquery, Value, When)
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils import timezone
 from django.utils.translation import gettext as _
 
+from accounting import connector_cash_ctrl as conn
+from accounting import outbox
 from accounting.models import Article, OutgoingOrder, OutgoingItem
-from asset.models import Device
+from asset.models import AssetCategory, Device
 from core.models import (
     TenantSetup, Area, AddressMunicipal, PersonAddress, Attachment)
 from scerp.admin import ExportExcel
@@ -34,6 +47,8 @@ logger = logging.getLogger(__name__)
 
 # Defaults
 CUSTOM_NUMBER_FORMAT = "#'##0"
+STATISTICS_CACHE_PREFIX = 'period_statistics'
+STATISTICS_CACHE_TIMEOUT = 24 * 60 * 60  # seconds, key changes with data
 CUSTOM_NUMBER_FORMAT_SMALL = "# ##0"
 
 # GFT Template
@@ -173,7 +188,53 @@ class PeriodCalc:
                 max_length + 2
             )
 
-    def create_statistics(self):
+    @staticmethod
+    def _get_generation_key(period_id):
+        ''' a lost key restarts at the current time, not at a generation
+            used before
+        '''
+        key = f"{STATISTICS_CACHE_PREFIX}:{period_id}:generation"
+        cache.add(key, time.time_ns(), None)  # no-op if the key exists
+        return key
+
+    @classmethod
+    def invalidate(cls, *period_ids):
+        ''' drop cached statistics of periods, called by the measurement
+            signals and after bulk writes
+        '''
+        for period_id in set(period_ids):
+            cache.incr(cls._get_generation_key(period_id))
+
+    def _get_version(self):
+        ''' generation of the period, changed by invalidate; changes of
+            areas or counter categories show after STATISTICS_CACHE_TIMEOUT
+        '''
+        return cache.get(self._get_generation_key(self.period.id))
+
+    @staticmethod
+    def _add_totals(totals, rows, get_code):
+        for row in rows:
+            totals[get_code(row)] = {
+                'count': row['count'],
+                'total': row['total'] or 0
+            }
+
+    def create_statistics(self, use_cache=True):
+        ''' statistics of period, calculated by the database;
+            cached until a measurement of the period changes
+        '''
+        # Get measurements
+        measurements = Measurement.objects.filter(route__period=self.period)
+
+        # Cache
+        key = (
+            f"{STATISTICS_CACHE_PREFIX}:{self.period.id}:"
+            f"{self._get_version()}")
+        if use_cache:
+            statistics = cache.get(key)
+            if statistics is not None:
+                return statistics
+
         # Init
         statistics = self._init_statistics()
         consumption = {
@@ -187,79 +248,110 @@ class PeriodCalc:
             'total_per_period': {},
             'measurements': []
         }
+        not_available = _('n/a')
 
-        # Get measurements
-        measurements = Measurement.objects.filter(
-            route__period=self.period
-        ).order_by('counter__code')
-
-        for measurement in measurements:
-            # Init
-            consumption['all']['count'] += 1
-            if measurement.consumption is None:
-                consumption['no_value']['count'] += 1
-            else:
-                consumption['all']['total'] += measurement.consumption
-
-            # Unit
-            if not consumption['unit']:
-                language = TenantSetup.objects.filter(
-                    tenant=self.period.tenant).first().language
-                consumption['unit'] = (
-                    measurement.counter.category.unit.name.get(language))
-
-            # Adress area
-            if measurement.address:
-                code = measurement.address.area.code
+        # Totals
+        totals = measurements.aggregate(
+            count=Count('id'),
+            total=Sum('consumption'),
+            no_value=Count('id', filter=Q(consumption=None))
+        )
+        consumption['all'] = {
+            'count': totals['count'], 'total': totals['total'] or 0}
+        consumption['no_value']['count'] = totals['no_value']
+
+        # Unit
+        unit = measurements.filter(
+            counter__category__unit__isnull=False
+        ).order_by('counter__code').values_list(
+            'counter__category__unit__name', flat=True).first()
+        if unit:
+            language = TenantSetup.objects.filter(
+                tenant=self.period.tenant).values_list(
+                    'language', flat=True).first()
+            consumption['unit'] = unit.get(language)
+
+        # Adress area
+        rows = measurements.values(
+            'address__area__code', 'address__area__name'
+        ).annotate(
+            count=Count('id'), total=Sum('consumption')
+        ).order_by('address__area__code')
+        per_area = {}
+        for row in rows:
+            if row['address__area__code']:
+                code = row['address__area__code']
                 consumption['areas'].setdefault(
-                    code, measurement.address.area.name)
-            else:
-                code = _('n/a')
-            consumption['total_per_area'].setdefault(code, self._init_count())
-            consumption['total_per_area'][code]['count'] += 1
-            consumption['total_per_area'][code]['total'] += (
-                measurement.consumption or 0)
-
-            # Counter code
-            if measurement.counter:
-                code = measurement.counter.category.code
-                consumption['codes'].setdefault(
-                    code, measurement.counter.category.name)
-            else:
-                code = _('n/a')
-            consumption['total_per_code'].setdefault(code, self._init_count())
-            consumption['total_per_code'][code]['count'] += 1
-            consumption['total_per_code'][code]['total'] += (
-                measurement.consumption or 0)
-
-            # Total per period
-            if measurement.value == measurement.consumption:
-                code = 'new'
-                consumption['codes'].setdefault(
-                    code, _("Counters added"))   
+                    code, row['address__area__name'])
             else:
-                code = 'existing'
-                consumption['codes'].setdefault(
-                    code, _("Counters already existing"))
-                
-            consumption['total_per_period'].setdefault(code, self._init_count())
-            consumption['total_per_period'][code]['count'] += 1
-            consumption['total_per_period'][code]['total'] += (
-                measurement.consumption or 0)
-
-            # Add Measurement
-            consumption['measurements'].append({
-                'counter_code': measurement.counter.code,
-                'date': measurement.datetime.date(),
-                'value': measurement.value,
-                'consumption': measurement.consumption,
-                'route':  f"{measurement.route}",
-                'period':  f"{measurement.route.period}"
-            })
+                code = not_available
+            total = per_area.setdefault(code, self._init_count())
+            total['count'] += row['count']
+            total['total'] += row['total'] or 0
+        consumption['total_per_area'] = per_area
+
+        # Counter code
+        rows = measurements.values('counter__category_id').annotate(
+            count=Count('id'), total=Sum('consumption')
+        ).order_by('counter__category__code')
+        categories = AssetCategory.objects.in_bulk(
+            [x['counter__category_id'] for x in rows])
+        for row in rows:
+            category = categories.get(row['counter__category_id'])
+            if category:
+                consumption['codes'].setdefault(category.code, category.name)
+        self._add_totals(
+            consumption['total_per_code'], rows,
+            lambda row: (
+                categories[row['counter__category_id']].code
+                if row['counter__category_id'] else not_available))
+
+        # Total per period
+        codes = {
+            'new': _("Counters added"),
+            'existing': _("Counters already existing")
+        }
+        rows = measurements.annotate(
+            is_new=Case(
+                When(Q(value=F('consumption'))
+                     | Q(value=None, consumption=None), then=Value(True)),
+                default=Value(False),
+                output_field=BooleanField())
+        ).values('is_new').annotate(
+            count=Count('id'), total=Sum('consumption')
+        ).order_by('-is_new')
+        self._add_totals(
+            consumption['total_per_period'], rows,
+            lambda row: 'new' if row['is_new'] else 'existing')
+        for code in consumption['total_per_period']:
+            consumption['codes'].setdefault(code, codes[code])
+
+        # Add Measurement
+        routes = {
+            route.id: f"{route}" for route in Route.objects.filter(
+                period=self.period).select_related('period')
+        }
+        period = f"{self.period}"
+        rows = measurements.order_by('counter__code').values_list(
+            'counter__code', 'datetime', 'value', 'consumption', 'route_id'
+        ).iterator(chunk_size=2000)
+        consumption['measurements'] = [
+            {
+                'counter_code': counter_code,
+                'date': measured_at.date(),
+                'value': value,
+                'consumption': measurement_consumption,
+                'route': routes.get(route_id),
+                'period': period
+            }
+            for (counter_code, measured_at, value, measurement_consumption,
+                 route_id) in rows
+        ]
 
         statistics.update({
             'consumption': consumption
         })
+        cache.set(key, statistics, STATISTICS_CACHE_TIMEOUT)
 
         return statistics
 
@@ -372,6 +464,83 @@ class PeriodCalc:
         return response
 
 
+class MeasurementConsumption:
+    '''
+    Recalculate consumption = value - previous value of the counter for
+    many measurements at once, same result as Measurement.save_consumption;
+    the measurements of the counters are read in one query ordered by
+    counter and datetime, the changes written with bulk_update; an UPDATE
+    with a subquery on the same table is not supported by MySQL
+
+    queryset: measurements to update, e.g. of a route, period or tenant
+    '''
+    BATCH_SIZE = 1000
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+    @classmethod
+    def scope(cls, tenant_id=None, period_id=None, route_id=None):
+        queryset = Measurement.objects.all()
+        if tenant_id:
+            queryset = queryset.filter(tenant__id=tenant_id)
+        if period_id:
+            queryset = queryset.filter(route__period__id=period_id)
+        if route_id:
+            queryset = queryset.filter(route__id=route_id)
+        return cls(queryset)
+
+    def get_previous_values(self):
+        ''' yield measurements of the counters with the value of the
+            latest measurement with an earlier datetime (None if none);
+            previous measurements may be outside the scope
+        '''
+        rows = Measurement.objects.filter(
+            counter__in=self.queryset.values('counter_id')
+        ).order_by('tenant_id', 'counter_id', 'datetime', 'id').values_list(
+            'tenant_id', 'counter_id', 'datetime', 'id', 'counter__code',
+            'value', 'consumption', 'route__period_id'
+        ).iterator(chunk_size=2000)
+
+        counter = datetime_group = None
+        value_previous = value_last = None
+        for tenant_id, counter_id, measured_at, *row in rows:
+            if (tenant_id, counter_id) != counter:
+                counter = (tenant_id, counter_id)
+                datetime_group = value_last = None
+            if measured_at != datetime_group:
+                # equal datetimes do not precede each other
+                datetime_group = measured_at
+                value_previous = value_last
+            value_last = row[2]
+            yield (*row, value_previous)
+
+    def calc(self):
+        ''' return number of updated measurements and measurements
+            without consumption (id, counter code)
+        '''
+        ids = set(self.queryset.values_list('id', flat=True))
+
+        updates, missing, period_ids = [], [], set()
+        for (id, counter_code, value, consumption, period_id,
+                value_previous) in self.get_previous_values():
+            if id not in ids:
+                continue
+            if value is None or value_previous is None:
+                if consumption is None:
+                    missing.append((id, counter_code))
+                continue
+            if consumption != value - value_previous:
+                updates.append(
+                    Measurement(id=id, consumption=value - value_previous))
+                period_ids.add(period_id)
+
+        Measurement.objects.bulk_update(
+            updates, ['consumption'], batch_size=self.BATCH_SIZE)
+        PeriodCalc.invalidate(*period_ids)  # bulk_update keeps modified_at
+        return len(updates), missing
+
+
 class RouteManagement:
     '''
     base class to handle Route management
@@ -472,19 +641,57 @@ class RouteCounterExport(RouteManagement):
         self.route_date = route_date
         self.key = key  # encryption
 
+        # dates
+        if route_date:
+            self.current_date = convert_datetime_to_date(route_date)
+        else:
+            self.current_date = None
+
+        if route.period_previous:
+            self.previous_date = convert_datetime_to_date(
+                route.period_previous.end)
+        else:
+            self.previous_date = None
+
     def _get_energy_type(self, counter):
         return 'W'  # only water supported for now
 
-    def _make_gft_meter(self, subscription):
-        ''' make meter dict for json / excel export
-        if excel we optimize data to our needs
-        redo !!!
+    def get_subscriptions(self):
+        ''' subscriptions of route with all data needed for the meters,
+            is_measured: measurement of route already exists (anti-join)
         '''
+        if self.route.subscriptions.exists():
+            queryset = self.route.subscriptions.all()
+        else:
+            queryset = Subscription.objects.filter(
+                tenant=self.tenant, is_inactive=False)
+
+        return queryset.select_related(
+            'subscriber', 'partner', 'address', 'counter__category'
+        ).annotate(
+            is_measured=Exists(Measurement.objects.filter(
+                route=self.route, counter=OuterRef('counter')))
+        ).order_by('address__zip', 'address__address_label', 'description')
+
+    def get_previous_measurements(self, counter_ids):
+        ''' last measurement of previous period per counter, one query '''
+        queryset = Measurement.objects.filter(
+            tenant=self.tenant,
+            counter_id__in=counter_ids,
+            period=self.route.period_previous
+        ).only(
+            'counter_id', 'datetime', 'value', 'consumption'
+        ).order_by('counter_id', 'datetime')
+
+        # later ones overwrite earlier ones
+        return {x.counter_id: x for x in queryset}
+
+    def _make_gft_meter(self, subscription, previous_measurement=None):
+        ''' make meter dict for json / excel export, no db access '''
         # Init
         counter = subscription.counter
 
         # last consumption
-        previous_measurement = self.get_previous_measurement(counter)
         if previous_measurement:
             value = previous_measurement.value or 0
             consumption_previous = previous_measurement.consumption or 0
@@ -505,34 +712,14 @@ class RouteCounterExport(RouteManagement):
 
         # address
         address = subscription.address
-        if address:
-            street = address.stn_label or ''
-            nr = address.adr_number or ''
-        else:    
-            street = ''
-            nr = ''
-            msg = _("subscription {subscription} has no address.")
-            msg = msg.format(subscription=subscription)
-            messages.warning(self.request, msg)            
-
-        # current date
-        if self.route_date:
-            current_date = convert_datetime_to_date(self.route_date)
-        else:
-            current_date = None
-
-        # previous date
-        if self.route.period_previous:
-            previous_date = convert_datetime_to_date(
-                self.route.period_previous.end)
-        else:
-            previous_date = None
+        street = (address.stn_label or '') if address else ''
+        nr = (address.adr_number or '') if address else ''
 
         # encryption
         if self.key:
             name = shift_encode(name, self.key)
-            nr = shift_encode(street, self.key)
-            street = shift_encode(nr, self.key)
+            street = shift_encode(street, self.key)
+            nr = shift_encode(nr, self.key)
 
         meter = {
             'id': counter.number,
@@ -542,8 +729,8 @@ class RouteCounterExport(RouteManagement):
             'address': {
                 'street': street,
                 'housenr': nr,
-                'city': address.city,
-                'zip': address.zip,
+                'city': address.city if address else '',
+                'zip': address.zip if address else '',
                 'hint': subscription.description or ''
             },
             'subscriber': {
@@ -552,64 +739,77 @@ class RouteCounterExport(RouteManagement):
             },
             'value': {
                 'obiscode': counter.category.code,
-                'dateOld': previous_date,
+                'dateOld': self.previous_date,
                 'old': round(value, 1),
                 'min': round(min, 1),
                 'max': round(max, 1),
-                'dateCur': current_date
+                'dateCur': self.current_date
             }
         }
 
         return meter
 
     def _init_json(self):
-        data = dict(METER.TEMPLATE)
+        data = copy.deepcopy(METER.TEMPLATE)
         data['billing_mde']['route'].update({
             'name': self.name,
             'user': self.username
         })
         return data
 
+    def make_response_json_stream(self, data, meters, filename):
+        ''' stream json, meters is an iterable of meter dicts '''
+        def generate():
+            head = json.dumps(data, ensure_ascii=False)
+            prefix, suffix = head.rsplit('[]', 1)  # meter list is empty
+            yield prefix + '['
+            for nr, meter in enumerate(meters):
+                yield (',' if nr else '') + json.dumps(
+                    meter, ensure_ascii=False)
+            yield ']' + suffix
+
+        response = StreamingHttpResponse(
+            generate(), content_type='application/json; charset=utf-8')
+        response['Content-Disposition'] = (
+            f'attachment; filename="{filename}"')
+        return response
+
     # Methods, main
-    def make_export_file(self, filename, file_type='json'):
-        '''called to generate the json data for the export to GFT software
-        excel: output to excel, creates a much simpler meter data
-        show_multiple: show if a subscriber has multiple counters
+    def get_meters(self):
+        ''' check subscriptions and return list of (subscription, previous
+            measurement); number of queries does not depend on route size
         '''
-        data = self._init_json()
-        count = 0
-
-        # get subscriptions
-        if self.route.subscriptions.exists():
-            query_subscriptions = self.route.subscriptions.all()
-        else:
-            query_subscriptions = Subscription.objects.filter(
-                tenant=self.tenant, is_inactive=False).all()
-        query_subscriptions = query_subscriptions.order_by(
-            'address__zip', 'address__address_label', 'description')
-
-        for subscription in query_subscriptions:
-            if subscription.counter:
-                # Check if measurement already existing
-                queryset = Measurement.objects.filter(
-                    route=self.route, counter=subscription.counter)
-                if queryset.exists():
-                    msg = _("subscription {subscription}; already measured.")
-                    msg = msg.format(subscription=subscription)
-                    messages.warning(self.request, msg)
-                else:
-                    meter = self._make_gft_meter(subscription)
-                    if meter:
-                        data['billing_mde']['meter'].append(meter)
-                        count += 1
-            else:
+        subscriptions = []
+        for subscription in self.get_subscriptions():
+            if not subscription.counter:
                 messages.warning(
                     self.request, _(f"subscription {subscription}; no counter"))
+            elif subscription.is_measured:
+                msg = _("subscription {subscription}; already measured.")
+                msg = msg.format(subscription=subscription)
+                messages.warning(self.request, msg)
+            else:
+                if not subscription.address:
+                    msg = _("subscription {subscription} has no address.")
+                    msg = msg.format(subscription=subscription)
+                    messages.warning(self.request, msg)
+                subscriptions.append(subscription)
+
+        previous = self.get_previous_measurements(
+            [x.counter_id for x in subscriptions])
+        return [(x, previous.get(x.counter_id)) for x in subscriptions]
+
+    def make_export_file(self, filename, file_type='json', stream=False):
+        '''called to generate the json data for the export to GFT software
+        stream: stream the json response, meters are serialized on the fly
+        '''
+        # get meters
+        data = self._init_json()
+        meters = self.get_meters()
+        count = len(meters)
 
         # Update route
-        # self.route.number_of_addresses = len(addresses)
         self.route.number_of_subscriptions = count  # only include valid ones
-        # self.route.number_of_counters = number_of_counters
         self.route.status = Route.STATUS.COUNTER_EXPORTED
         self.route.save()
 
@@ -617,9 +817,18 @@ class RouteCounterExport(RouteManagement):
             self.request, _(f"json files contains {count} records"))
 
         # return export_file
-        if file_type == 'json':
-            return self.make_response_json(data, filename)
-        return None
+        if file_type != 'json':
+            return None
+
+        meters = (
+            self._make_gft_meter(subscription, previous)
+            for subscription, previous in meters
+        )
+        if stream:
+            return self.make_response_json_stream(data, meters, filename)
+
+        data['billing_mde']['meter'] = list(meters)
+        return self.make_response_json(data, filename)
 
 
 class RouteCounterImport(RouteManagement):
@@ -639,49 +848,80 @@ class RouteCounterImport(RouteManagement):
         'value_latest': 'cur',
         'current_battery_level': 'batteryLevel',
     }
+    CHUNK_SIZE = 1000  # meters read and stored together
 
     def __init__(self, modeladmin, request, route):
-        super().__init__(modeladmin, request, route)        
-        self.counters = [
-            subscription.counter for subscription in route.subscriptions.all()
-        ] if route.subscriptions.exists() else []        
+        super().__init__(modeladmin, request, route)
+        self.counters = set(
+            route.subscriptions.values_list('counter_id', flat=True))
+        self.report = {'created': 0, 'skipped': []}
+
+    def skip(self, code, reason, msg):
+        ''' add meter to report, show msg '''
+        self.report['skipped'].append({'code': code, 'reason': reason})
+        messages.warning(self.request, msg)
+
+    @staticmethod
+    def read_meters(json_file):
+        ''' yield meters of file, streamed if ijson is installed;
+            raise ValueError if the file has no billing_mde.meter list
+        '''
+        found = []
 
-    def create_measurement(self, meter):
+        def check(events):
+            for prefix, event, value in events:
+                if prefix == 'billing_mde.meter' and event == 'start_array':
+                    found.append(prefix)
+                yield prefix, event, value
+
+        try:
+            if ijson:
+                events = check(ijson.parse(json_file, use_float=True))
+                yield from ijson.items(events, 'billing_mde.meter.item')
+            else:
+                meters = json.load(json_file)['billing_mde']['meter']
+                if isinstance(meters, list):
+                    found.append('billing_mde.meter')
+                    yield from meters
+        except Exception:
+            raise ValueError(_("Not a valid file"))
+        if not found:
+            raise ValueError(_("Not a valid file"))
+
+    def make_measurement(self, meter, counters, subscriptions):
+        ''' return unsaved Measurement or None '''
         # Get counter
         code = meter['id']
-        counter = Device.objects.filter(
-            tenant=self.tenant, code=code
-        ).first()
+        counter = counters.get(code)
         if not counter:
-            messages.warning(
-                self.request, _(f"counter {code} not found."))
+            self.skip(code, 'counter_not_found', _(f"counter {code} not found."))
             return None
 
         # Check data
         value = meter['value']
         if not value:
-            messages.warning(
-                self.request, _(f"counter {code} has no value."))
+            self.skip(code, 'no_value', _(f"counter {code} has no value."))
             return None
 
         # Check required keys
         if not all(k in value for k in ['key', 'dateKey', 'cur']):
-            messages.warning(
-                self.request, _(f"counter {code} has no measurement."))
+            self.skip(
+                code, 'no_measurement',
+                _(f"counter {code} has no measurement."))
             return None
 
         # Get Subscription
-        subscription = Subscription.objects.filter(
-            tenant=self.tenant, counter=counter).first()
+        subscription = subscriptions.get(counter.id)
         if not subscription:
-            messages.warning(
-                self.request, _(f"subscription for {code} not found."))
+            self.skip(
+                code, 'subscription_not_found',
+                _(f"subscription for {code} not found."))
             return None
-        if self.counters and counter not in self.counters:
-            messages.warning(
-                self.request, _(f"counter {code} not in route."))
-            return None            
-            
+        if self.counters and counter.id not in self.counters:
+            self.skip(
+                code, 'not_in_route', _(f"counter {code} not in route."))
+            return None
+
         # Check data
         reference_dt = convert_str_to_datetime(value['dateKey'])
         if not self.start <= reference_dt.date() <= self.end:
@@ -716,39 +956,70 @@ class RouteCounterImport(RouteManagement):
             'created_by': self.created_by,
         })
 
-        # Check if the record has been already imported
-        # So it is not possible that same measurement is assigend to two
-        # routes
-        if Measurement.objects.filter(
-                    tenant=self.tenant,
-                    counter=counter,
-                    datetime=data['datetime']
-                ).exists():
-            messages.warning(
-                self.request, _(f"counter {meter['id']} already measured."))
-            return None
-
-        # Store data
-        obj = Measurement.objects.create(
+        return Measurement(
             tenant=self.tenant,
             route=self.route,
             counter=counter,
             **data
         )
 
-        return obj
+    def get_counters(self, meters):
+        ''' counters and subscriptions of meters at once,
+            lowest id wins if a code or counter is given twice
+        '''
+        codes = {meter['id'] for meter in meters}
+        counters = {}
+        for counter in Device.objects.filter(
+                tenant=self.tenant, code__in=codes).order_by('id'):
+            counters.setdefault(counter.code, counter)
+        subscriptions = {}
+        for subscription in Subscription.objects.filter(
+                tenant=self.tenant, counter__in=counters.values()
+                ).select_related('address').order_by('id'):
+            subscriptions.setdefault(subscription.counter_id, subscription)
+        return counters, subscriptions
+
+    def store(self, meters, existing):
+        ''' store measurements of a chunk of meters, return count
+            existing: (counter_id, datetime) already stored, gets updated
+        '''
+        counters, subscriptions = self.get_counters(meters)
 
-    def process(self, json_file):
-        # Load file
-        file_data = json_file.read().decode('utf-8')
-        data = json.loads(file_data)
+        # Make measurements
+        measurements = [
+            measurement for meter in meters
+            if (measurement := self.make_measurement(
+                meter, counters, subscriptions))
+        ]
 
-        # Check file
-        try:
-            measurements = data['billing_mde']['meter']
-        except:
-            raise ValueError(_("Not a valid file"))
+        # Check if the record has been already imported
+        # So it is not possible that same measurement is assigend to two
+        # routes
+        existing.update(Measurement.objects.filter(
+            tenant=self.tenant,
+            counter__in=[x.counter for x in measurements],
+            datetime__in={x.datetime for x in measurements}
+        ).values_list('counter_id', 'datetime'))
+        new_measurements = []
+        for measurement in measurements:
+            key = (measurement.counter.id, measurement.datetime)
+            if key in existing:
+                code = measurement.counter.code
+                self.skip(
+                    code, 'already_measured',
+                    _(f"counter {code} already measured."))
+                continue
+            existing.add(key)  # duplicates in file
+            new_measurements.append(measurement)
+
+        Measurement.objects.bulk_create(new_measurements)
+        return len(new_measurements)
 
+    def process(self, json_file):
+        ''' import meters, return report with number of created
+            measurements and skipped meters (code, reason);
+            the file is read in chunks of CHUNK_SIZE meters
+        '''
         ''' next time
         # Assign route
         route_id = int(data['billing_mde']['route']['name'].split(',')[0])
@@ -762,37 +1033,49 @@ class RouteCounterImport(RouteManagement):
         self.start = self.route.period.start
         self.end = self.route.period.end
 
-        # get meter data
-        count = 0
-        for meter in measurements:
-            measurement = self.create_measurement(meter)
-            if measurement:
-                count += 1
-
-        # Create an Attachment instance
-        attachment = Attachment.objects.create(
-            tenant=self.tenant,  # Set the tenant
-            content_object=self.route,  # Set the associated route
-            file=json_file,  # Uploaded the file
-            created_by=self.created_by
-        )
+        with transaction.atomic():
+            # Store data
+            meters = self.read_meters(json_file)
+            existing = set()
+            while chunk := list(islice(meters, self.CHUNK_SIZE)):
+                self.report['created'] += self.store(chunk, existing)
+            json_file.seek(0)  # stored as attachment
+
+            # Create an Attachment instance
+            attachment = Attachment.objects.create(
+                tenant=self.tenant,  # Set the tenant
+                content_object=self.route,  # Set the associated route
+                file=json_file,  # Uploaded the file
+                created_by=self.created_by
+            )
 
-        # Add the attachment to the route's attachments
-        self.route.attachments.add(attachment)
+            # Add the attachment to the route's attachments
+            self.route.attachments.add(attachment)
 
-        # update route
-        self.route.status = Route.STATUS.COUNTER_IMPORTED
-        self.route.import_file_id = attachment.id
-        self.route.save()
+            # update route
+            self.route.status = Route.STATUS.COUNTER_IMPORTED
+            self.route.import_file_id = attachment.id
+            self.route.save()
 
-        return count
+        PeriodCalc.invalidate(self.route.period_id)
+        return self.report
 
 
 class RouteCounterInvoicing(RouteManagement):
     '''use this to invoice route data
 
     is_enabled_sync: set true for drafts, set false for others
+
+    Billing of many subscriptions (bill_all):
+    1. prefetch: measurements, articles, addresses in a few queries
+    2. get_invoice: calculate invoice and items, no db access
+    3. create: orders, items and measurements per chunk in a transaction,
+       upload to cashCtrl by the outbox or a pool of WORKERS threads
+    A rerun skips invoices already created (resume).
     '''
+    CHUNK_SIZE = 50  # invoices committed together
+    WORKERS = 4  # parallel uploads if outbox is not async
+
     def __init__(
             self, modeladmin, request, route, status, invoice_date,
             is_enabled_sync, language='de'):
@@ -801,6 +1084,14 @@ class RouteCounterInvoicing(RouteManagement):
         self.date = invoice_date
         self.is_enabled_sync = is_enabled_sync
 
+        # prefetched data
+        self.measurements = {}  # counter_id -> last measurement
+        self.comparisons = {}  # measurement id -> previous measurement
+        self.addresses = {}  # person_id -> [PersonAddress]
+        self.articles_daily = {}  # nr -> daily Article
+        self.existing = set()  # subscription ids invoiced in period
+        self.existing_descriptions = set()  # invoices without measurement
+
     def _get_quantity(
             self, measurement, article, quantity, rounding_digits,
             days=None):
@@ -820,8 +1111,98 @@ class RouteCounterInvoicing(RouteManagement):
         # No valid case
         return None  # could not be derived
 
-    def bill(self, subscription, route, check_measurement=True):
-        ''' get called from actions '''
+    def _get_invoice_address(self, person):
+        ''' same as Person.get_invoice_address but prefetched '''
+        addresses = self.addresses.get(person.id, [])
+        for address_type in (
+                PersonAddress.TYPE.INVOICE, PersonAddress.TYPE.MAIN):
+            for address in addresses:
+                if address.type == address_type:
+                    return address_type, address.address_full
+
+        # Return first
+        address = addresses[0]
+        return address.type, address.address_full
+
+    def prefetch(self, subscriptions):
+        ''' load all data needed for subscriptions, return subscriptions '''
+        subscriptions = list(subscriptions.select_related(
+            'subscriber__title', 'partner__title', 'recipient__title',
+            'address', 'counter'
+        ).prefetch_related(
+            Prefetch(
+                'subscriptionarticle_subscription',
+                queryset=SubscriptionArticle.objects.select_related(
+                    'article__unit').order_by('article__nr'))
+        ))
+
+        # Last measurement of period per counter, with its comparison
+        comparison = Measurement.objects.filter(
+            tenant=self.tenant,
+            counter=OuterRef('counter'),
+            datetime__lt=OuterRef('datetime')
+        ).order_by('-datetime').values('id')[:1]
+        measurements = Measurement.objects.filter(
+            tenant=self.tenant,
+            counter__in=[x.counter_id for x in subscriptions if x.counter_id],
+            period=self.route.period
+        ).select_related('period').annotate(
+            comparison_id=Subquery(comparison)).order_by('datetime')
+        self.measurements = {x.counter_id: x for x in measurements}
+
+        comparisons = Measurement.objects.in_bulk([
+            x.comparison_id for x in self.measurements.values()
+            if x.comparison_id
+        ])
+        self.comparisons = {
+            x.id: comparisons.get(x.comparison_id)
+            for x in self.measurements.values()
+        }
+
+        # Invoice addresses
+        self.addresses = {}
+        addresses = PersonAddress.objects.filter(
+            person__in=[
+                x.recipient_id or x.subscriber_id for x in subscriptions]
+        ).select_related('address')
+        for address in addresses:
+            self.addresses.setdefault(address.person_id, []).append(address)
+
+        # Daily articles
+        nrs = [
+            x.article.nr + ARTICLE_NR_POSTFIX_DAY
+            for subscription in subscriptions
+            for x in subscription.subscriptionarticle_subscription.all()
+        ]
+        self.articles_daily = {
+            x.nr: x for x in Article.objects.filter(
+                tenant=self.tenant, nr__in=nrs).select_related('unit')
+        }
+
+        # Invoices already created (resume), keyed by (subscription, period)
+        # via Measurement.invoice
+        self.existing = set(Measurement.objects.filter(
+            tenant=self.tenant,
+            subscription__in=[x.id for x in subscriptions],
+            period=self.route.period,
+            invoice__isnull=False
+        ).values_list('subscription_id', flat=True))
+
+        # Invoices without measurement have no such link
+        setup = self.route.setup
+        self.existing_descriptions = set(OutgoingOrder.objects.filter(
+            tenant=self.tenant,
+            category=setup.order_category,
+            date=self.date,
+            measurement_invoice__isnull=True
+        ).values_list('description', flat=True))
+
+        return subscriptions
+
+    def get_invoice(self, subscription, route, check_measurement=True):
+        ''' calculate invoice of subscription from prefetched data,
+            return dict with invoice, items, measurement or None
+        '''
         # init
         setup = route.setup
 
@@ -835,7 +1216,7 @@ class RouteCounterInvoicing(RouteManagement):
             'date': self.date,
             'status': self.status,
             'is_enabled_sync': self.is_enabled_sync,
-            'sync_to_accounting': True,  # immediately sync with cashCtrl
+            'sync_to_accounting': False,  # set after items are created
             'created_by': self.created_by
         }
 
@@ -864,7 +1245,7 @@ class RouteCounterInvoicing(RouteManagement):
             name += f"{partner.first_name} {partner.last_name}"
 
         # add address
-        type, address = associate.get_invoice_address()
+        type, address = self._get_invoice_address(associate)
         invoice['recipient_address'] = f"{name}\n{address}"
 
         # building
@@ -889,7 +1270,8 @@ class RouteCounterInvoicing(RouteManagement):
         counter_id = subscription.counter.code if subscription.counter else ''
 
         # Get actual measurement
-        measurement = self.get_last_measurement(subscription.counter)
+        measurement = self.measurements.get(subscription.counter_id)
+        start, end = self.start, self.end
         if measurement:
             # Check consumption
             if measurement.consumption is None:
@@ -901,7 +1283,7 @@ class RouteCounterInvoicing(RouteManagement):
                 return None
 
             # Check invoice
-            if measurement.invoice:
+            if measurement.invoice_id:
                 msg = _("{id}, {subscription}: invoice already created for {route}.")
                 msg = msg.format(
                     id=subscription.id,
@@ -931,14 +1313,11 @@ class RouteCounterInvoicing(RouteManagement):
             # Get comparison consumption
             value_new = round_to_zero(measurement.value, setup.rounding_digits)
             value_old = '-'
-            comparisons = self.get_comparison_measurements(
-                measurement, max=1)
-            if comparisons:
-                comparison = comparisons[0]
+            comparison = self.comparisons.get(measurement.id)
+            if comparison:
                 value_old = round_to_zero(
                     comparison.value, setup.rounding_digits)
             else:
-                comparison = None
                 msg = _("No comparison for {id}, {subscription}")
                 msg = msg.format(
                     id=subscription.id,
@@ -1012,31 +1391,41 @@ class RouteCounterInvoicing(RouteManagement):
         if subscription.tag:
             invoice['description'] += ', ' + subscription.tag
 
+        # Check if created in a previous run
+        if subscription.id in self.existing or (
+                not measurement
+                and invoice['description'] in self.existing_descriptions):
+            msg = _("{id}, {subscription}: invoice already created for {route}.")
+            msg = msg.format(
+                id=subscription.id,
+                subscription=subscription,
+                route=route)
+            messages.warning(self.request, msg)
+            return None
+
         # create article items
         items = []
-        sub_articles = SubscriptionArticle.objects.filter(
-            subscription=subscription
-        ).order_by('article__nr')
+        sub_articles = subscription.subscriptionarticle_subscription.all()
         for subscription_article in sub_articles:
-            article = copy.copy(subscription_article.article)  # Shallow Copy            
+            article = copy.copy(subscription_article.article)  # Shallow Copy
             quantity = subscription_article.quantity
 
             if unit_code == 'day' and article.unit.code == 'period':
                 # Replace article by daily
-                article = Article.objects.filter(
-                    tenant=article.tenant,
-                    nr=article.nr + ARTICLE_NR_POSTFIX_DAY,
-                ).first()
-                
+                article = self.articles_daily.get(
+                    article.nr + ARTICLE_NR_POSTFIX_DAY)
+
                 # Fill in days
                 description_daily = setup.description_daily.format_map(
-                    SafeDict(quantity=quantity, days=days))                                
+                    SafeDict(quantity=quantity, days=days))
             else:
                 description_daily = None
-                
-            quantity = self._get_quantity(
-                measurement, article, quantity, setup.rounding_digits, days)
-            if quantity is None:
+
+            if article:
+                quantity = self._get_quantity(
+                    measurement, article, quantity, setup.rounding_digits,
+                    days)
+            if not article or quantity is None:
                 msg = _("{subscription}: no valid measurement for {article}.")
                 msg = msg.format(subscription=subscription, article=article)
                 messages.error(self.request, msg)
@@ -1050,30 +1439,115 @@ class RouteCounterInvoicing(RouteManagement):
                 created_by=self.created_by
             ))
 
-        # No error, create objects
-        # Create invoice
-        invoice_obj = OutgoingOrder.objects.create(**invoice)
+        return {
+            'subscription': subscription,
+            'invoice': invoice,
+            'items': items,
+            'measurement': measurement
+        }
 
-        try:
-            for item in items:
-                item['order'] = invoice_obj
-                obj = OutgoingItem.objects.create(**item)
-        except Exception as e:
-            msg = _("{subscription}: Error creating OutgoingItem {e}.")
-            messages.error(
-                self.request, msg.format(subscription=subscription, e=e))
-            invoice_obj.delete()
-
-        # Update measurement, should be True except "Pauschal"
-        if measurement:
-            measurement.invoice = invoice_obj
-            measurement.save()
-        else:
-            msg = _("{subscription}: no measurement.")
-            messages.warning(
-                self.request, msg.format(subscription=subscription))
+    def create(self, invoices):
+        ''' create orders, items and link measurements in one transaction,
+            return orders
+        '''
+        with transaction.atomic():
+            orders = [OutgoingOrder(**x['invoice']) for x in invoices]
+            if connection.features.can_return_rows_from_bulk_insert:
+                for order in orders:
+                    order.fill_header()  # bulk_create bypasses save
+                orders = OutgoingOrder.objects.bulk_create(orders)
+            else:
+                for order in orders:
+                    order.save()  # we need the ids
+
+            items, measurements = [], []
+            for order, invoice in zip(orders, invoices):
+                items.extend(
+                    OutgoingItem(order=order, **item)
+                    for item in invoice['items'])
+                measurement = invoice['measurement']
+                if measurement:
+                    measurement.invoice = order
+                    measurements.append(measurement)
+                else:
+                    msg = _("{subscription}: no measurement.")
+                    messages.warning(self.request, msg.format(
+                        subscription=invoice['subscription']))
+
+            OutgoingItem.objects.bulk_create(items)
+            Measurement.objects.bulk_update(measurements, ['invoice'])
+
+            # Sync, items are complete now
+            if self.is_enabled_sync:
+                OutgoingOrder.objects.filter(
+                    id__in=[x.id for x in orders]
+                ).update(sync_to_accounting=True)
+                for order in orders:
+                    order.sync_to_accounting = True
+                if outbox.is_async():
+                    for order in orders:
+                        outbox.enqueue_save(
+                            conn.OutgoingOrder, OutgoingOrder, order, True)
+
+        return orders
+
+    def upload(self, orders):
+        ''' upload orders to cashCtrl in parallel, return number of errors '''
+        def upload_order(order):
+            try:
+                api = conn.OutgoingOrder(OutgoingOrder)
+                api.save(order, created=True)
+                outbox.report(OutgoingOrder, order.id)
+                return True
+            except Exception as e:
+                outbox.report(OutgoingOrder, order.id, str(e))
+                logger.error(f"{order.id}: {e}")
+                return False
+            finally:
+                connection.close()  # thread owns its connection
+
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+            results = list(executor.map(upload_order, orders))
+        return results.count(False)
 
-        return invoice_obj
+    def bill(self, subscription, route, check_measurement=True):
+        ''' bill one subscription '''
+        orders = self.bill_all(
+            Subscription.objects.filter(pk=subscription.pk),
+            check_measurement)
+        return orders[0] if orders else None
+
+    def bill_all(self, subscriptions, check_measurement=True, dry_run=False):
+        ''' get called from actions, return orders created
+            dry_run: calculate invoices only, return invoice data
+        '''
+        subscriptions = self.prefetch(subscriptions)
+        invoices = [
+            invoice for subscription in subscriptions
+            if (invoice := self.get_invoice(
+                subscription, self.route, check_measurement))
+        ]
+        if dry_run:
+            return invoices
+
+        orders = []
+        for index in range(0, len(invoices), self.CHUNK_SIZE):
+            chunk = invoices[index:index + self.CHUNK_SIZE]
+            try:
+                orders.extend(self.create(chunk))
+            except Exception as e:
+                msg = _("Error creating invoices, rerun to resume: {e}.")
+                messages.error(self.request, msg.format(e=e))
+                break
+
+        # Upload if not done by outbox
+        if self.is_enabled_sync and not outbox.is_async() and orders:
+            errors = self.upload(orders)
+            if errors:
+                msg = _("{count} invoices not uploaded to cashCtrl.")
+                messages.error(self.request, msg.format(count=errors))
+
+        return orders
 
 
 class MeasurementAnalyse:
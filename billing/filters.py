@@ -46,11 +46,12 @@ class MeasurementRouteFilter(admin.SimpleListFilter):
         '''Return categories filtered by tenant'''
         tenant_id = get_tenant_data(request).get('id')
 
-        categories = Route.objects.filter(
+        # label with period as route names repeat, one query
+        routes = Route.objects.filter(
             tenant_id=tenant_id  # Add tenant filtering here
-        ).values_list('id', 'name')
+        ).select_related('period')
 
-        return categories
+        return [(route.id, f"{route}") for route in routes]
 
     def queryset(self, request, queryset):
         tenant_id = get_tenant_data(request).get('id')
@@ -129,6 +129,12 @@ class RouteMeterExportJSONActionForm(AdminActionForm):
         initial=False,
         help_text=_("Generate Test Data"),
     )
+    stream = forms.BooleanField(
+        label=_('Stream'),
+        required=False,
+        initial=False,
+        help_text=_("Stream the file, use for large routes"),
+    )
 
     class Meta:
         list_objects = True
@@ -269,6 +275,12 @@ class RouteBillingForm(AdminActionForm):
         help_text=_(
             "Enable for draft invoices. Disable for hundreds of invoices")
     )
+    dry_run = forms.BooleanField(
+        label=_('Dry run'),
+        required=False,
+        help_text=_(
+            "Only check the invoices, nothing is created.")
+    )
 
     def __post_init__(self, modeladmin, request, queryset):
         route = queryset.first()
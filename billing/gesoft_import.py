@@ -1532,7 +1532,7 @@ def get_list_of_open_records(tenant_id):
     
     for subscription in subscriptions:   
         invoiced = len(subscription.invoices) > 0
-        ready = subscription.measurements.count() == 2
+        ready = len(subscription.measurements) == 2
         if ready and not invoiced:
             print(f"{subscription}")    
 
@@ -1548,7 +1548,7 @@ def get_list_of_do_again_records(tenant_id):
     
     for subscription in subscriptions:   
         invoiced = len(subscription.invoices) > 0
-        ready = subscription.measurements.count() == 2
+        ready = len(subscription.measurements) == 2
         if not invoiced and not ready:
             print(f"{subscription}")    
 
@@ -15,6 +15,7 @@
     python manage.py process_billing get_list_of_open_records --tenant_id=12
     python manage.py process_billing get_list_of_do_again_records --tenant_id=12
     python manage.py process_billing update_article_daily
+    python manage.py process_billing calc_consumption --tenant_id=12 --period_id=3
     
 '''
 import json
@@ -35,7 +36,7 @@ class Command(BaseCommand):
                 'rearrange_counters', 'delete_negative_counter',
                 'update_invoiced', 'correct_article_counts',
                 'get_list_of_open_records', 'get_list_of_do_again_records',
-                'update_article_daily'
+                'update_article_daily', 'calc_consumption'
             ],
             help='Specify the action: gesoft'
         )
@@ -51,6 +52,12 @@ class Command(BaseCommand):
             required=False,
             help='Route ID for the operation'
         )
+        parser.add_argument(
+            '--period_id',
+            type=int,
+            required=False,
+            help='Period ID for the operation'
+        )
         parser.add_argument(
             '--date',
             type=str,
@@ -183,5 +190,16 @@ class Command(BaseCommand):
             # Update
             update_article_daily()
 
+        elif action == 'calc_consumption':
+            # Import library
+            from billing.calc import MeasurementConsumption
+
+            # Update
+            calc = MeasurementConsumption.scope(
+                tenant_id, options.get('period_id'), route_id)
+            count, missing = calc.calc()
+            self.stdout.write(
+                f"{count} updated, {len(missing)} without consumption")
+
         else:
             raise ValueError("No valid action")
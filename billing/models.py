@@ -197,24 +197,20 @@ class Subscription(TenantAbstract):
 
     @property
     def invoice_address(self):
-        # Get Field
-        if self.recipient:
-            # First check point, usually empty
-            addresses = PersonAddress.objects.filter(person=self.recipient)
-        else:
-            # Take subscriber
-            addresses = PersonAddress.objects.filter(person=self.subscriber)
+        ''' invoice address of recipient if given else of subscriber,
+            uses prefetched personaddress_address if available
+        '''
+        person = self.recipient or self.subscriber
+        addresses = list(person.personaddress_address.all())
 
         # Get address
-        invoice = addresses.filter(type=PersonAddress.TYPE.INVOICE)
-        if invoice:
-            return invoice.first()
-
-        main = addresses.filter(type=PersonAddress.TYPE.MAIN)
-        if main:
-            return main.first()
+        for address_type in (
+                PersonAddress.TYPE.INVOICE, PersonAddress.TYPE.MAIN):
+            for address in addresses:
+                if address.type == address_type:
+                    return address
 
-        return addresses.first()
+        return addresses[0] if addresses else None
 
     @property
     def number(self):
@@ -222,18 +218,26 @@ class Subscription(TenantAbstract):
 
     @property
     def invoices(self):
-        invoices = [
+        ''' invoices of measurements, latest first '''
+        return [
             measurement.invoice
-            for measurement in Measurement.objects.filter(
-                subscription=self
-            ).exclude(invoice=None).order_by('-datetime')
+            for measurement in reversed(self.measurements)
+            if measurement.invoice_id
         ]
-        return invoices
 
     @property
     def measurements(self):
-        return Measurement.objects.filter(
-            subscription=self).order_by('datetime')
+        ''' list of measurements ordered by datetime,
+            uses prefetched measurement_subscriber if available
+        '''
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if 'measurement_subscriber' in prefetched:
+            return sorted(
+                prefetched['measurement_subscriber'],
+                key=lambda x: (x.datetime, x.id))
+        return list(Measurement.objects.filter(
+            subscription=self).select_related('invoice').order_by(
+                'datetime', 'id'))
 
     def __str__(self):
         name = f'{self.address}'
@@ -478,7 +482,7 @@ class Measurement(TenantAbstract):
             tenant=self.tenant,
             counter=self.counter,
             datetime__lt=self.datetime            
-        ).order_by('datetime').last()
+        ).order_by('datetime', 'id').last()
                     
         return measurement_previous
 
@@ -501,12 +505,8 @@ class Measurement(TenantAbstract):
             return  f"{self.route}, {self.counter}, {self.datetime} - Unassigned!"
 
     def save_consumption(self):
-        # get previous_measurement
-        previous_measurement = Measurement.objects.filter(
-                tenant=self.tenant,
-                counter=self.counter,
-                datetime__lt=self.datetime
-            ).order_by('datetime').last()
+        ''' single measurement, use calc.MeasurementConsumption for many '''
+        previous_measurement = self.previous
         if (previous_measurement
                 and self.value is not None
                 and previous_measurement.value is not None):
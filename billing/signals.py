@@ -0,0 +1,25 @@
+'''
+billing/signals.py
+'''
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .calc import PeriodCalc
+from .models import Measurement, Route
+
+
+# Measurement
+@receiver(post_save, sender=Measurement)
+@receiver(post_delete, sender=Measurement)
+def measurement_post_save(sender, instance, **kwargs):
+    '''Signal handler for post_save and post_delete signals on Measurement;
+    drop cached statistics of the period after commit, so that no reader
+    caches data of the open transaction under the new generation
+    '''
+    if instance.route_id:
+        period_ids = Route.objects.filter(
+            pk=instance.route_id).values_list('period_id', flat=True)
+        transaction.on_commit(partial(PeriodCalc.invalidate, *period_ids))
@@ -1,3 +1,695 @@
-from django.test import TestCase
+import datetime
+import json
+import tempfile
+from io import BytesIO
 
-# Create your tests here.
+import openpyxl
+
+from django.contrib.admin.templatetags.admin_list import results
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from accounting.models import (
+    Account, AccountCategory, Article, BankAccount, Location,
+    OrderCategoryContract, OrderCategoryOutgoing, OrderContract,
+    OutgoingItem, OutgoingOrder, SyncOutbox)
+from asset.models import AssetCategory, Device, Unit
+from core.models import (
+    Address, AddressMunicipal, Area, Attachment, Country, Tenant, Person, PersonAddress,
+    PersonCategory)
+from scerp.admin import ExportExcel, ExportJSON
+from scerp.admin_site import admin_site
+from .calc import (
+    MeasurementConsumption, PeriodCalc, RouteCounterExport,
+    RouteCounterImport, RouteCounterInvoicing)
+from .models import (
+    Period, Route, Setup, Subscription, SubscriptionArticle, Measurement)
+
+
+class BillingTestCase(TestCase):
+    ''' tenant with periods, setup and categories '''
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.tenant = Tenant.objects.create(
+            name='test', code='test', created_by=self.user)
+        self.logging = {'tenant': self.tenant, 'created_by': self.user}
+        self.period_previous = Period.objects.create(
+            code='previous', name='previous',
+            start=datetime.date(2024, 1, 1), end=datetime.date(2024, 12, 31),
+            **self.logging)
+        self.period = Period.objects.create(
+            code='current', name='current',
+            start=datetime.date(2025, 1, 1), end=datetime.date(2025, 12, 31),
+            **self.logging)
+        self.setup = Setup.objects.create(
+            code='water', name='water', **self.logging)
+        self.unit = Unit.objects.create(
+            code='m3', name={'de': 'm³'}, **self.logging)
+        self.asset_category = AssetCategory.objects.create(
+            code='W', name={'de': 'Wasser'}, unit=self.unit, **self.logging)
+        self.person_category = PersonCategory.objects.create(
+            code='private', name={'de': 'Privat'}, **self.logging)
+        self.count = 0
+
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+        self.request._messages = CookieStorage(self.request)
+
+    def make_route(self, size):
+        route = Route.objects.create(
+            name=f'route {size}', period=self.period, setup=self.setup,
+            period_previous=self.period_previous, **self.logging)
+        for __ in range(size):
+            self.count += 1
+            counter = Device.objects.create(
+                code=str(self.count), number=str(self.count),
+                category=self.asset_category,
+                date_added=self.period_previous.start, **self.logging)
+            person = Person.objects.create(
+                category=self.person_category, last_name=str(self.count),
+                **self.logging)
+            subscription = Subscription.objects.create(
+                subscriber=person, counter=counter,
+                description=str(self.count),
+                start=self.period_previous.start, **self.logging)
+            route.subscriptions.add(subscription)
+            Measurement.objects.create(
+                counter=counter, subscription=subscription,
+                period=self.period_previous,
+                datetime=datetime.datetime(
+                    2024, 12, 31, tzinfo=datetime.timezone.utc),
+                value=100, consumption=10, **self.logging)
+        return route
+
+
+class RouteCounterExportTests(BillingTestCase):
+    '''
+    python manage.py test billing.tests.RouteCounterExportTests
+    '''
+    def export(self, route):
+        export = RouteCounterExport(
+            None, self.request, route, route_date=datetime.date(2025, 3, 31))
+        with CaptureQueriesContext(connection) as context:
+            response = export.make_export_file('test.json')
+        return len(context.captured_queries), json.loads(response.content)
+
+    def test_queries_constant(self):
+        small, data_small = self.export(self.make_route(2))
+        large, data_large = self.export(self.make_route(20))
+
+        self.assertEqual(small, large)
+        self.assertEqual(len(data_small['billing_mde']['meter']), 2)
+        self.assertEqual(len(data_large['billing_mde']['meter']), 20)
+
+    def test_stream_equals_json(self):
+        route = self.make_route(3)
+        __, data = self.export(route)
+
+        export = RouteCounterExport(
+            None, self.request, route, route_date=datetime.date(2025, 3, 31))
+        response = export.make_export_file('test.json', stream=True)
+        streamed = json.loads(b''.join(response.streaming_content))
+
+        self.assertEqual(data, streamed)
+
+
+class ChangelistQueryBudgetTests(BillingTestCase):
+    '''
+    fails if a changelist page needs more queries than its budget or if the
+    number of queries grows with the number of rows
+
+    python manage.py test billing.tests.ChangelistQueryBudgetTests
+    '''
+    BUDGET = {
+        Measurement: 12,
+        Subscription: 12,
+        Route: 12,
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.user.is_superuser = True
+        self.user.is_staff = True
+        self.user.save()
+
+    def get_request(self, params=None):
+        request = RequestFactory().get('/', params or {})
+        request.user = self.user
+        request.session = {'tenant': {'id': self.tenant.id}}
+        return request
+
+    def changelist_queries(self, model, params=None):
+        ''' render all cells and filters of the first page,
+            return number of queries and rows
+        '''
+        request = self.get_request(params)
+        model_admin = admin_site._registry[model]
+
+        with CaptureQueriesContext(connection) as context:
+            changelist = model_admin.get_changelist_instance(request)
+            changelist.formset = None  # no list_editable
+            rows = [list(row) for row in results(changelist)]
+            filters = [
+                list(spec.choices(changelist))
+                for spec in changelist.filter_specs]
+        self.assertTrue(filters)
+        return len(context.captured_queries), len(rows)
+
+    def assertQueryBudget(self, model, params=None, assign=None):
+        ''' assign: called after adding rows, e.g. to match params '''
+        self.changelist_queries(model, params)  # warm up content type cache
+        small = self.changelist_queries(model, params)
+        self.make_route(20)
+        if assign:
+            assign()
+        large = self.changelist_queries(model, params)
+
+        self.assertGreater(large[1], small[1])
+        self.assertEqual(small[0], large[0], f"{model.__name__}: per row")
+        self.assertLessEqual(
+            large[0], self.BUDGET[model], f"{model.__name__}: over budget")
+
+    def test_measurement(self):
+        self.make_route(2)
+        self.assertQueryBudget(Measurement)
+
+    def test_measurement_filtered(self):
+        route = self.make_route(2)
+        assign = lambda: Measurement.objects.update(route=route)
+        assign()
+        self.assertQueryBudget(Measurement, {'route': route.id}, assign)
+
+    def test_subscription(self):
+        self.make_route(2)
+        self.assertQueryBudget(Subscription)
+
+    def test_subscription_properties(self):
+        self.make_route(3)
+        model_admin = admin_site._registry[Subscription]
+        request = self.get_request()
+
+        # list pages do not load measurements and addresses
+        subscription = model_admin.get_queryset(request).first()
+        self.assertNotIn(
+            'measurement_subscriber', subscription._prefetched_objects_cache)
+
+        # change view
+        subscription = model_admin.get_object(request, str(subscription.pk))
+        with self.assertNumQueries(0):
+            self.assertEqual(len(subscription.measurements), 1)
+            self.assertEqual(subscription.invoices, [])
+            self.assertIsNone(subscription.invoice_address)
+
+    def test_route(self):
+        self.make_route(2)
+        self.assertQueryBudget(Route)
+
+
+@override_settings(CASH_CTRL_SYNC_ASYNC=True)
+class RouteCounterInvoicingTests(BillingTestCase):
+    '''
+    python manage.py test billing.tests.RouteCounterInvoicingTests
+    '''
+    def setUp(self):
+        super().setUp()
+        contact = Person.objects.create(
+            category=self.person_category, last_name='Gemeinde',
+            **self.logging)
+        category = AccountCategory.objects.create(number=1, **self.logging)
+        account = Account.objects.create(
+            category=category, number=1100, **self.logging)
+        bank_account = BankAccount.objects.create(
+            account=account, bic='POFICHBEXXX', iban='CH9300762011623852957',
+            **self.logging)
+        location = Location.objects.create(name='Gemeinde', **self.logging)
+        self.setup.order_category = OrderCategoryOutgoing.objects.create(
+            code='water', debit_account=account, bank_account=bank_account,
+            responsible_person=contact, **self.logging)
+        self.setup.order_contract = OrderContract.objects.create(
+            category=OrderCategoryContract.objects.create(
+                code='water', org_location=location, **self.logging),
+            associate=contact, date=self.period.start,
+            contract_date=self.period.start, **self.logging)
+        self.setup.contact = contact
+        self.setup.save()
+
+        Country.objects.create(
+            alpha2='CH', alpha3='CHE', name={'de': 'Schweiz'},
+            is_default=True, created_by=self.user)
+        self.article = Article.objects.create(
+            nr='W1', name={'de': 'Wasser'}, unit=self.unit, **self.logging)
+        self.building = AddressMunicipal.objects.create(
+            com_fosnr=2578, com_name='Gunzgen', com_canton='SO', zip=4617,
+            city='Gunzgen', str_esid=1, stn_label='Markstrasse', bdg_egid=1,
+            adr_egaid=1, adr_number='12', adr_status='real',
+            adr_official=True, adr_modified=self.period.start,
+            adr_easting=2630000, adr_northing=1240000, **self.logging)
+
+        address = Address.objects.create(
+            address='Markstrasse 12', zip='4617', city='Gunzgen',
+            **self.logging)
+        self.route = self.make_route(3)
+        for subscription in self.route.subscriptions.all():
+            subscription.address = self.building
+            subscription.save()
+            PersonAddress.objects.create(
+                person=subscription.subscriber,
+                type=PersonAddress.TYPE.MAIN,
+                address=address, **self.logging)
+            SubscriptionArticle.objects.create(
+                subscription=subscription, article=self.article,
+                **self.logging)
+            Measurement.objects.create(
+                counter=subscription.counter, subscription=subscription,
+                period=self.period, route=self.route,
+                datetime=datetime.datetime(
+                    2025, 6, 30, tzinfo=datetime.timezone.utc),
+                value=120, consumption=20, **self.logging)
+
+    def bill_all(self, **kwargs):
+        handler = RouteCounterInvoicing(
+            None, self.request, self.route,
+            OrderCategoryOutgoing.STATUS.DRAFT, datetime.date(2025, 7, 1),
+            is_enabled_sync=True)
+        return handler.bill_all(self.route.subscriptions.all(), **kwargs)
+
+    def get_outbox(self):
+        return list(SyncOutbox.objects.filter(
+            entity='accounting.outgoingorder').values_list('object_id', 'op'))
+
+    def test_bill_all(self):
+        orders = self.bill_all()
+
+        self.assertEqual(len(orders), 3)
+        self.assertEqual(OutgoingOrder.objects.count(), 3)
+        for order in OutgoingOrder.objects.all():
+            self.assertTrue(order.sync_to_accounting)
+            self.assertIn('Markstrasse 12', order.header)
+            items = OutgoingItem.objects.filter(order=order)
+            self.assertEqual(
+                list(items.values_list('article', 'quantity')),
+                [(self.article.id, 20)])
+        self.assertEqual(
+            sorted(Measurement.objects.filter(period=self.period).values_list(
+                'invoice', flat=True)),
+            sorted(x.id for x in orders))
+        self.assertEqual(sorted(self.get_outbox()), sorted(
+            (x.id, SyncOutbox.OP.CREATE) for x in orders))
+
+    def test_rerun_creates_nothing(self):
+        self.bill_all()
+
+        self.assertEqual(self.bill_all(), [])
+        self.assertEqual(OutgoingOrder.objects.count(), 3)
+        self.assertEqual(OutgoingItem.objects.count(), 3)
+        self.assertEqual(len(self.get_outbox()), 3)
+
+    def test_rerun_without_measurement(self):
+        subscription = self.route.subscriptions.first()
+        Measurement.objects.filter(
+            period=self.period, subscription=subscription).delete()
+        SubscriptionArticle.objects.filter(
+            subscription=subscription).update(quantity=5)  # flat rate
+
+        self.assertEqual(len(self.bill_all(check_measurement=False)), 3)
+        self.assertEqual(self.bill_all(check_measurement=False), [])
+        self.assertEqual(OutgoingOrder.objects.count(), 3)
+
+    def test_dry_run(self):
+        invoices = self.bill_all(dry_run=True)
+
+        self.assertEqual(len(invoices), 3)
+        self.assertEqual(invoices[0]['items'][0]['quantity'], 20)
+        self.assertFalse(OutgoingOrder.objects.exists())
+        self.assertFalse(SyncOutbox.objects.exists())
+        self.assertFalse(Measurement.objects.filter(
+            invoice__isnull=False).exists())
+
+
+class PeriodCalcTests(BillingTestCase):
+    '''
+    python manage.py test billing.tests.PeriodCalcTests
+    '''
+    def setUp(self):
+        super().setUp()
+        cache.clear()  # ids are reused after rollback
+        self.route = self.make_route(4)
+        counters = [x.counter for x in self.route.subscriptions.all()]
+        area = Area.objects.create(
+            code='north', name='Nord', **self.logging)
+        address_area = self.make_address(1, area=area)
+        address = self.make_address(2)  # no area
+
+        # counter, address, value, consumption
+        for counter, address, value, consumption in [
+                (counters[0], address_area, 120, 20),  # existing
+                (counters[1], address_area, 130, 30),
+                (counters[2], address, 7, 7),  # new
+                (counters[3], None, None, None),  # no value
+                (None, None, 5, 5)]:  # archive, no counter
+            Measurement.objects.create(
+                counter=counter, address=address, period=self.period,
+                route=self.route, datetime=datetime.datetime(
+                    2025, 6, 30, tzinfo=datetime.timezone.utc),
+                value=value, consumption=consumption, **self.logging)
+
+    def make_address(self, number, **kwargs):
+        return AddressMunicipal.objects.create(
+            com_fosnr=2578, com_name='Gunzgen', com_canton='SO', zip=4617,
+            city='Gunzgen', str_esid=1, stn_label='Markstrasse',
+            bdg_egid=number, adr_egaid=number, adr_number=str(number),
+            adr_status='real', adr_official=True,
+            adr_modified=self.period.start, adr_easting=2630000,
+            adr_northing=1240000, **kwargs, **self.logging)
+
+    def calc_per_row(self):
+        ''' former implementation, one measurement at a time '''
+        consumption = {
+            'unit': None, 'areas': {}, 'codes': {},
+            'all': {'count': 0, 'total': 0},
+            'no_value': {'count': 0, 'total': 0},
+            'total_per_area': {}, 'total_per_code': {},
+            'total_per_period': {}, 'measurements': []
+        }
+        measurements = Measurement.objects.filter(
+            route__period=self.period).order_by('counter__code')
+        for measurement in measurements:
+            consumption['all']['count'] += 1
+            if measurement.consumption is None:
+                consumption['no_value']['count'] += 1
+            else:
+                consumption['all']['total'] += measurement.consumption
+
+            counter = measurement.counter
+            if not consumption['unit'] and counter and counter.category.unit:
+                consumption['unit'] = counter.category.unit.name.get('de')
+
+            totals = []
+            area = measurement.address and measurement.address.area
+            if area:
+                consumption['areas'].setdefault(area.code, area.name)
+            totals.append(('total_per_area', area.code if area else 'n/a'))
+            if counter:
+                consumption['codes'].setdefault(
+                    counter.category.code, counter.category.name)
+            totals.append((
+                'total_per_code', counter.category.code if counter else 'n/a'))
+            code = (
+                'new' if measurement.value == measurement.consumption
+                else 'existing')
+            consumption['codes'].setdefault(code, {
+                'new': 'Counters added',
+                'existing': 'Counters already existing'}[code])
+            totals.append(('total_per_period', code))
+            for key, code in totals:
+                total = consumption[key].setdefault(
+                    code, {'count': 0, 'total': 0})
+                total['count'] += 1
+                total['total'] += measurement.consumption or 0
+
+            consumption['measurements'].append({
+                'counter_code': counter.code if counter else None,
+                'date': measurement.datetime.date(),
+                'value': measurement.value,
+                'consumption': measurement.consumption,
+                'route': f"{measurement.route}",
+                'period': f"{measurement.route.period}"
+            })
+        return consumption
+
+    def test_equals_per_row(self):
+        statistics = PeriodCalc(self.period).create_statistics(
+            use_cache=False)
+
+        self.assertEqual(statistics['consumption'], self.calc_per_row())
+        self.assertEqual(
+            statistics['consumption']['total_per_period'], {
+                'new': {'count': 3, 'total': 12},
+                'existing': {'count': 2, 'total': 50}})
+
+    def test_cache_invalidated_by_save(self):
+        calc = PeriodCalc(self.period)
+        statistics = calc.create_statistics()
+        with self.assertNumQueries(0):
+            self.assertEqual(calc.create_statistics(), statistics)
+
+        measurement = Measurement.objects.filter(
+            route=self.route, consumption=20).get()
+        with self.captureOnCommitCallbacks(execute=True):
+            measurement.consumption = 25
+            measurement.save()
+
+        statistics = calc.create_statistics()
+        self.assertEqual(statistics['consumption']['all']['total'], 67)
+        self.assertEqual(statistics['consumption'], self.calc_per_row())
+
+
+class MeasurementConsumptionTests(BillingTestCase):
+    '''
+    compare with Measurement.save_consumption
+
+    python manage.py test billing.tests.MeasurementConsumptionTests
+    '''
+    def setUp(self):
+        super().setUp()
+        self.route = self.make_route(2)  # values of 2024 without route
+        self.route_other = Route.objects.create(
+            name='other', period=self.period, setup=self.setup,
+            **self.logging)
+        counter, counter_no_value = [
+            x.counter for x in self.route.subscriptions.order_by('id')]
+
+        for counter, route, day, value in [
+                (counter, self.route, (3, 31), 120),
+                (counter, self.route, (6, 30), 150),
+                (counter, self.route_other, (6, 30), 160),  # same datetime
+                (counter_no_value, self.route, (1, 31), None),
+                (counter_no_value, self.route, (3, 31), 140)]:
+            self.make_measurement(counter, route, day, value)
+
+        # other tenant, same counter codes
+        self.tenant_other = Tenant.objects.create(
+            name='other', code='other', created_by=self.user)
+        self.logging = {'tenant': self.tenant_other, 'created_by': self.user}
+        counter = Device.objects.create(
+            code='1', number='1', category=self.asset_category,
+            date_added=self.period_previous.start, **self.logging)
+        self.make_measurement(counter, None, (1, 31), 50)
+        self.make_measurement(counter, None, (2, 28), 80)
+
+    def make_measurement(self, counter, route, day, value):
+        Measurement.objects.create(
+            counter=counter, route=route, period=self.period,
+            datetime=datetime.datetime(
+                2025, *day, tzinfo=datetime.timezone.utc),
+            value=value, consumption=-1, **self.logging)
+
+    def get_consumptions(self):
+        return dict(Measurement.objects.values_list('id', 'consumption'))
+
+    def save_each(self, queryset):
+        ''' consumptions after save_consumption, then roll back '''
+        try:
+            with transaction.atomic():
+                for measurement in queryset:
+                    measurement.save_consumption()
+                consumptions = self.get_consumptions()
+                raise ValueError('rollback')
+        except ValueError:
+            return consumptions
+
+    def assertSameAsSave(self, calc):
+        expected = self.save_each(calc.queryset)
+        before = self.get_consumptions()
+
+        count, missing = calc.calc()
+
+        self.assertEqual(self.get_consumptions(), expected)
+        self.assertEqual(
+            count, sum(before[x] != expected[x] for x in expected))
+        return missing
+
+    def test_route(self):
+        # previous measurement of 2024 is outside the scope
+        self.assertSameAsSave(
+            MeasurementConsumption.scope(route_id=self.route.id))
+        self.assertEqual(
+            sorted(Measurement.objects.filter(
+                route=self.route).values_list('consumption', flat=True)),
+            [-1, -1, 20, 30])  # previous value None, no consumption
+
+    def test_period(self):
+        self.assertSameAsSave(
+            MeasurementConsumption.scope(period_id=self.period.id))
+        self.assertEqual(
+            Measurement.objects.get(route=self.route_other).consumption, 40)
+
+    def test_tenant(self):
+        self.assertSameAsSave(
+            MeasurementConsumption.scope(tenant_id=self.tenant_other.id))
+        self.assertEqual(
+            sorted(Measurement.objects.filter(
+                tenant=self.tenant_other).values_list(
+                    'consumption', flat=True)),
+            [-1, 30])
+        self.assertFalse(Measurement.objects.filter(
+            tenant=self.tenant, consumption__gte=0, route__isnull=False
+        ).exists())
+
+    def test_missing(self):
+        Measurement.objects.filter(value=None).update(consumption=None)
+        missing = self.assertSameAsSave(
+            MeasurementConsumption.scope(tenant_id=self.tenant.id))
+        self.assertEqual(
+            [code for __, code in missing],
+            [self.route.subscriptions.order_by('id')[1].counter.code])
+
+
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class RouteCounterImportTests(BillingTestCase):
+    '''
+    python manage.py test billing.tests.RouteCounterImportTests
+    '''
+    def setUp(self):
+        super().setUp()
+        self.route = self.make_route(4)  # counters 1 to 4
+
+    def make_meter(self, code, value=130):
+        return {'id': code, 'value': {
+            'key': value, 'dateKey': '2025-03-31', 'cur': value + 1,
+            'dateCur': '2025-04-02', 'old': 100, 'batteryLevel': 80}}
+
+    def process(self, data):
+        content = data if isinstance(data, bytes) else json.dumps(
+            data).encode()
+        json_file = SimpleUploadedFile('route.json', content)
+        handler = RouteCounterImport(None, self.request, self.route)
+        return handler.process(json_file)
+
+    def test_report(self):
+        counter = Device.objects.get(tenant=self.tenant, code='3')
+        Measurement.objects.create(
+            counter=counter, route=self.route, period=self.period,
+            datetime=timezone.make_aware(datetime.datetime(2025, 3, 31)),
+            value=125, **self.logging)  # already measured
+        meters = [
+            self.make_meter('1'),
+            self.make_meter('2'),
+            self.make_meter('2', 140),  # duplicate in file
+            self.make_meter('3'),
+            {'id': '4', 'value': {}},
+            self.make_meter('99'),  # unknown counter
+        ]
+
+        report = self.process({'billing_mde': {'meter': meters}})
+
+        self.assertEqual(report['created'], 2)
+        self.assertEqual(
+            sorted((x['code'], x['reason']) for x in report['skipped']), [
+                ('2', 'already_measured'), ('3', 'already_measured'),
+                ('4', 'no_value'), ('99', 'counter_not_found')])
+        measurements = Measurement.objects.filter(
+            route=self.route).order_by('counter__code')
+        self.assertEqual(
+            list(measurements.values_list(
+                'counter__code', 'value', 'consumption')),
+            [('1', 130, 30), ('2', 130, 30), ('3', 125, None)])
+        self.route.refresh_from_db()
+        self.assertEqual(self.route.status, Route.STATUS.COUNTER_IMPORTED)
+        self.assertEqual(self.route.attachments.count(), 1)
+
+    def test_invalid_file(self):
+        for data in [b'no json', {'billing_mde': {}}, {'meter': []},
+                     {'billing_mde': {'meter': {'id': '1'}}}]:
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    self.process(data)
+
+        self.assertFalse(Measurement.objects.filter(
+            route=self.route).exists())
+        self.assertFalse(self.route.attachments.exists())
+
+    def test_empty_list(self):
+        report = self.process({'billing_mde': {'meter': []}})
+
+        self.assertEqual(report, {'created': 0, 'skipped': []})
+
+
+class ExportTests(BillingTestCase):
+    '''
+    streamed and not streamed exports of a changelist are equal
+
+    python manage.py test billing.tests.ExportTests
+    '''
+    class RouteAdmin:
+        model = Route
+        list_display = ('name', 'period__name', 'display_attachment_icon')
+
+    def make_routes(self, count):
+        for __ in range(count):
+            route = Route.objects.create(
+                name=f"route {Route.objects.count() + 1}",
+                period=self.period, setup=self.setup, **self.logging)
+            if route.id % 2:
+                Attachment.objects.create(
+                    content_object=route, file='attachments/route.json',
+                    **self.logging)
+
+    def export(self, export_class, stream):
+        export = export_class(
+            self.RouteAdmin(), self.request,
+            Route.objects.filter(tenant=self.tenant).order_by('id'),
+            stream=stream)
+        with CaptureQueriesContext(connection) as context:
+            response = export.generate_response()
+            content = (
+                b''.join(response.streaming_content) if stream
+                else response.content)
+        return len(context.captured_queries), content
+
+    def read_excel(self, content):
+        ws = openpyxl.load_workbook(BytesIO(content)).active
+        return [list(row) for row in ws.iter_rows(values_only=True)]
+
+    def test_excel(self):
+        self.make_routes(3)
+        __, content = self.export(ExportExcel, False)
+        __, streamed = self.export(ExportExcel, True)
+
+        rows = self.read_excel(content)
+        self.assertEqual(rows, self.read_excel(streamed))
+        self.assertEqual(rows[0][1:], ['period__name', 'attachments'])
+        self.assertEqual(
+            rows[1:], [[f"route {nr}", 'current', bool(route_id % 2)]
+                       for nr, route_id in enumerate(Route.objects.order_by(
+                           'id').values_list('id', flat=True), start=1)])
+
+    def test_json(self):
+        self.make_routes(3)
+        __, content = self.export(ExportJSON, False)
+        __, streamed = self.export(ExportJSON, True)
+
+        data = json.loads(content)
+        self.assertEqual(data, json.loads(streamed))
+        self.assertEqual(len(data), 3)
+        self.assertEqual(data[0]['period__name'], 'current')
+
+    def test_queries_constant(self):
+        self.make_routes(2)
+        small = [
+            self.export(export_class, stream)[0]
+            for export_class in (ExportExcel, ExportJSON)
+            for stream in (False, True)]
+        self.make_routes(8)
+        large = [
+            self.export(export_class, stream)[0]
+            for export_class in (ExportExcel, ExportJSON)
+            for stream in (False, True)]
+
+        self.assertEqual(small, large)
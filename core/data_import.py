@@ -12,6 +12,7 @@ from django.conf import settings
 
 from scerp.mixins import get_admin
 from .models import Country, Tenant, TenantSetup, AddressMunicipal
+from .process import BuildingImport
 
 
 # Helper function to parse the date string into a datetime object
@@ -103,62 +104,13 @@ class ImportBuilding:
         logging.info(f"Got {self.zips} as zip")
 
     def load(self, file_name_csv):
-        # Initialize the dictionary
+        ''' one pass with bulk writes, see core.process.BuildingImport '''
         file_path = Path(
             settings.BASE_DIR) / 'core' / 'fixtures' / file_name_csv
-        admin = get_admin()
-
-        # Open the CSV file
-        with open(file_path, mode='r', encoding='utf-8-sig') as csv_file:
-            csv_reader = csv.DictReader(csv_file, delimiter=';')  # Use semicolon as delimiter
-
-            logger.info("Starting")
-
-            # Iterate over each row in the CSV
-            count = 0
-            for row in csv_reader:
-                # Prepare data dictionary with relevant fields
-                zip, label = row.pop('ZIP_LABEL').split(' ', 1)
-
-                # Check scope
-                if int(zip) not in self.zips:
-                    continue
-
-                address_data = {
-                    # import
-                    'zip': zip,
-                    'city': label,
-                    'com_fosnr': row['COM_FOSNR'],  # Include COM_FOSNR here
-                    'com_name': row['COM_NAME'],
-                    'com_canton': row['COM_CANTON'],
-                    'stn_label': row['STN_LABEL'],
-                    'adr_number': row['ADR_NUMBER'],
-                    'adr_status': row['ADR_STATUS'],
-                    'adr_official': (
-                        row['ADR_OFFICIAL'].strip().lower() == 'true'),
-                    'adr_modified': parse_date(row['ADR_MODIFIED'].strip()),
-                    'adr_easting': row['ADR_EASTING'],
-                    'adr_northing': row['ADR_NORTHING'],
-                    'bdg_egid': row['BDG_EGID'],
-                    'bdg_category': row['BDG_CATEGORY'],
-                    'bdg_name': (
-                        row['BDG_NAME'].strip()
-                        if row['BDG_NAME'].strip() else None),
-                    'adr_egaid': row['ADR_EGAID'],
-                    'str_esid': row['STR_ESID'],
-                    
-                    # custom
-                    'tenant': self.tenant,
-                    'created_by': admin
-                }
-
-                # AddressMunicipal
-                address, _created = (
-                    AddressMunicipal.objects.update_or_create(
-                        adr_egaid=address_data.pop('adr_egaid'),
-                        defaults=address_data
-                    )
-                )
-                count += 1
+        tenant_setups = TenantSetup.objects.filter(
+            tenant=self.tenant).select_related('tenant')
 
-        return count
+        logger.info("Starting")
+        building_import = BuildingImport(tenant_setups, egids=False)
+        created, updated = building_import.load(file_path)
+        return created + updated
@@ -7,6 +7,7 @@
     python manage.py process_core sync_person_again --tenant_id=4
     python manage.py process_core clear_company_addresses
     python manage.py process_core update_address_label
+    python manage.py process_core update_address_coordinates --tenant_id=4
 '''
 import logging
 from django.core.management.base import BaseCommand
@@ -15,7 +16,7 @@ from django.core.management import CommandError
 from core.process import (
     update_or_create_apps, update_or_create_countries, update_or_create_groups,
     update_or_create_base_buildings, sync_person_again, 
-    clear_company_addresses, update_address_label
+    clear_company_addresses, update_address_label, update_address_coordinates
 )
 
 # Set up logging
@@ -35,7 +36,8 @@ class Command(BaseCommand):
                 'update_or_create_base_buildings',
                 'sync_person_again',
                 'clear_company_addresses',
-                'update_address_label'
+                'update_address_label',
+                'update_address_coordinates'
             ],
             help='Specify the action: gesoft'
         )
@@ -110,3 +112,8 @@ class Command(BaseCommand):
             count = update_address_label()
             logger.info(f"{count} items updated.")
 
+        elif action == 'update_address_coordinates':
+            # back-fill lat / lon, e.g. after imports without coordinates
+            tenant_id = options.get('tenant_id', None)
+            count = update_address_coordinates(tenant_id)
+            logger.info(f"{count} items updated.")
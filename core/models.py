@@ -492,6 +492,12 @@ class AcctApp(TenantAbstract):
         help_text=(
             "This records needs to be synched to cashctr, if the cycle is "
             "over it gets reset to False"))
+    c_payload_hash = models.CharField(
+        _('CashCtrl payload hash'), max_length=64, null=True, blank=True,
+        editable=False,
+        help_text=_(
+            "Hash of the data last sent to cashCtrl, updates with the same "
+            "data are not sent again"))
 
     class Meta:
         abstract = True
@@ -675,13 +681,16 @@ class AddressMunicipal(TenantAbstract):
         verbose_name=_('Area'), related_name="%(class)s_area",
         help_text=_("Area"))
 
-    def save(self, *args, **kwargs):
-        # Calc address_label
+    def calc_address_label(self):
         self.address_label = self.stn_label or ''
         # append number to be sortable, e.g. '123'.rjust(5) → ' 123'
         length = 5 if self.adr_number and self.adr_number[-1].isalpha() else 4
         self.address_label += (self.adr_number or '').rjust(length)
 
+    def save(self, *args, **kwargs):
+        # Calc address_label
+        self.calc_address_label()
+
         # Automatically calculate latitude and longitude if missing
         if self.adr_easting and self.adr_northing and (
                 self.lat is None or self.lon is None):
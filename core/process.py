@@ -3,19 +3,25 @@ Init and Update Jobs
 '''
 import copy
 import csv
+import io
 import json
 import logging  # initialized at process_core --> no need to re-init
 import os
+import zipfile
 from datetime import datetime
 from pathlib import Path
 
+import numpy as np
+
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import User, Group, Permission
 from django.db import transaction
+from django.db.models import CharField, Q
 
-from scerp.mixins import get_admin, read_yaml_file
+from scerp.mixins import (
+    convert_ch1903_to_wgs84_batch, get_admin, read_yaml_file)
 from .models import App, Country, TenantSetup, Address, AddressMunicipal
 from .models import Person, PersonAddress
 
@@ -197,10 +203,210 @@ def update_or_create_groups(update=True):
     return created, updated, deleted
 
 
+def read_buildings(file_path):
+    ''' stream rows of the building csv, file may be the zip as well '''
+    if file_path.suffix == '.zip':
+        with zipfile.ZipFile(file_path) as archive:
+            name = next(
+                x for x in archive.namelist() if x.endswith('.csv'))
+            with archive.open(name) as binary_file:
+                csv_file = io.TextIOWrapper(binary_file, encoding='utf-8-sig')
+                yield from csv.DictReader(csv_file, delimiter=';')
+    else:
+        with open(file_path, mode='r', encoding='utf-8-sig') as csv_file:
+            yield from csv.DictReader(csv_file, delimiter=';')
+
+
+class BuildingImport:
+    '''
+    Load actual buildings for all tenants in one pass over the national
+    building csv (3+ mio rows); rows are assigned to the tenants by zip or
+    building id and written in chunks with bulk_create / bulk_update
+
+    :tenant_setups: TenantSetups to load
+    :update: update existing addresses, otherwise create only
+    :egids: load rows with bdg_egids of the tenant setup as well
+    '''
+    CHUNK_SIZE = 2000
+    FIELDS = [
+        'zip', 'city', 'com_fosnr', 'com_name', 'com_canton', 'stn_label',
+        'adr_number', 'adr_status', 'adr_official', 'adr_modified',
+        'adr_easting', 'adr_northing', 'bdg_egid', 'bdg_category',
+        'bdg_name', 'str_esid'
+    ]
+
+    def __init__(self, tenant_setups, update=True, egids=True):
+        self.update = update
+        self.admin = get_admin()
+        self.country = Country.objects.get(alpha3=COUNTRY_DEFAULT)
+        self.created, self.updated = 0, 0
+
+        # Maps for routing of rows
+        self.zips, self.egids = {}, {}
+        self.tenants = {}
+        for tenant_setup in tenant_setups:
+            tenant = tenant_setup.tenant
+            self.tenants[tenant.id] = tenant
+            for zip in tenant_setup.zips or []:
+                self.zips.setdefault(int(zip), set()).add(tenant.id)
+            for egid in (tenant_setup.bdg_egids or []) if egids else []:
+                self.egids.setdefault(int(egid), set()).add(tenant.id)
+        self.buffers = {tenant_id: [] for tenant_id in self.tenants}
+
+        # Convert csv values to db values once; an empty cell is None only
+        # if the field allows it or is not a text field, otherwise ''
+        fields = [
+            AddressMunicipal._meta.get_field(field)
+            for field in self.FIELDS + ['adr_egaid']
+        ]
+        self.to_python = {field.name: field.to_python for field in fields}
+        self.empty = {
+            field.name: (
+                None if field.null or not isinstance(field, CharField)
+                else '')
+            for field in fields
+        }
+
+    def make_data(self, row):
+        zip, city = row['ZIP_LABEL'].split(' ', 1)
+        data = {
+            # import
+            'zip': zip,
+            'city': city,
+            'com_fosnr': row['COM_FOSNR'],  # Include COM_FOSNR here
+            'com_name': row['COM_NAME'],
+            'com_canton': row['COM_CANTON'],
+            'stn_label': row['STN_LABEL'],
+            'adr_number': row['ADR_NUMBER'],
+            'adr_status': row['ADR_STATUS'],
+            'adr_official': (
+                row['ADR_OFFICIAL'].strip().lower() == 'true'),
+            'adr_modified': parse_date(row['ADR_MODIFIED'].strip()),
+            'adr_easting': row['ADR_EASTING'],
+            'adr_northing': row['ADR_NORTHING'],
+            'bdg_egid': row['BDG_EGID'],
+            'bdg_category': row['BDG_CATEGORY'],
+            'bdg_name': (
+                row['BDG_NAME'].strip()
+                if row['BDG_NAME'].strip() else None),
+            'adr_egaid': row['ADR_EGAID'],
+            'str_esid': row['STR_ESID'],
+        }
+        return {
+            key: self.to_python[key](value) if value != '' else self.empty[key]
+            for key, value in data.items()
+        }
+
+    def route(self, row):
+        ''' return tenant ids the row belongs to '''
+        zip = int(row['ZIP_LABEL'].split(' ', 1)[0])
+        tenant_ids = self.zips.get(zip, set())
+        if self.egids and row['BDG_EGID']:
+            tenant_ids = tenant_ids | self.egids.get(
+                int(row['BDG_EGID']), set())
+        return tenant_ids
+
+    def set_coordinates(self, addresses):
+        ''' convert coordinates of addresses in one batch '''
+        addresses = [x for x in addresses if x.adr_easting and x.adr_northing]
+        if addresses:
+            lats, lons = convert_ch1903_to_wgs84_batch(
+                [x.adr_easting for x in addresses],
+                [x.adr_northing for x in addresses])
+            for address, lat, lon in zip(addresses, lats, lons):
+                address.lat, address.lon = float(lat), float(lon)
+
+    def flush(self, tenant_id):
+        ''' write buffered rows of tenant '''
+        rows = self.buffers[tenant_id]
+        if not rows:
+            return
+        self.buffers[tenant_id] = []
+        tenant = self.tenants[tenant_id]
+
+        existing = {
+            x.adr_egaid: x for x in AddressMunicipal.objects.filter(
+                tenant=tenant, adr_egaid__in=[x['adr_egaid'] for x in rows])
+        }
+        to_create, to_update = [], []
+        for data in rows:
+            address = existing.get(data['adr_egaid'])
+            if address is None:
+                address = AddressMunicipal(
+                    tenant=tenant, created_by=self.admin, **data)
+                to_create.append(address)
+                existing[address.adr_egaid] = address  # csv duplicates
+            elif self.update:
+                changed = [
+                    field for field in self.FIELDS
+                    if getattr(address, field) != data[field]
+                ]
+                if not changed:
+                    continue
+                if {'adr_easting', 'adr_northing'} & set(changed):
+                    address.lat, address.lon = None, None
+                for field in changed:
+                    setattr(address, field, data[field])
+                to_update.append(address)
+
+        # Calc label and coordinates as save() does
+        for address in to_create + to_update:
+            address.calc_address_label()
+        self.set_coordinates([
+            x for x in to_create + to_update if x.lat is None or x.lon is None
+        ])
+
+        with transaction.atomic():
+            AddressMunicipal.objects.bulk_create(to_create)
+            AddressMunicipal.objects.bulk_update(
+                to_update,
+                self.FIELDS + ['address_label', 'lat', 'lon'])
+
+            # Address, we save it as well for further use
+            self.create_addresses(tenant, rows)
+
+        self.created += len(to_create)
+        self.updated += len(to_update)
+
+    def create_addresses(self, tenant, rows):
+        addresses = {
+            (str(data['zip']), f"{data['stn_label']} {data['adr_number']}"):
+                data['city']
+            for data in rows
+        }
+        existing = set(Address.objects.filter(
+            country=self.country,
+            zip__in={zip for zip, _address in addresses}
+        ).values_list('zip', 'address'))
+        Address.objects.bulk_create([
+            Address(
+                tenant=tenant, address=address, zip=zip, city=city,
+                country=self.country, created_by=self.admin)
+            for (zip, address), city in addresses.items()
+            if (zip, address) not in existing
+        ], ignore_conflicts=True)
+
+    def load(self, file_path):
+        ''' read file once, return created, updated '''
+        for row in read_buildings(file_path):
+            for tenant_id in self.route(row):
+                buffer = self.buffers[tenant_id]
+                buffer.append(self.make_data(row))
+                if len(buffer) >= self.CHUNK_SIZE:
+                    self.flush(tenant_id)
+
+        for tenant_id in self.tenants:
+            self.flush(tenant_id)
+        logger.info(
+            f"Buildings: {self.created} created, {self.updated} updated")
+        return self.created, self.updated
+
+
 def update_or_create_base_buildings(tenant_id=None, update=True, weekday=None):
     '''
-    Load actual Buildings, currently per tenant, not grouped
+    Load actual Buildings, all tenants in one pass
     see https://data.geo.admin.ch/ch.swisstopo.amtliches-gebaeudeadressverzeichnis/amtliches-gebaeudeadressverzeichnis_ch/amtliches-gebaeudeadressverzeichnis_ch_2056.csv.zip
+    the csv or the zip is read from core/fixtures
 
     deleted not implemented yet
     '''
@@ -211,91 +417,21 @@ def update_or_create_base_buildings(tenant_id=None, update=True, weekday=None):
         if weekday.lower() != today:
             logger.info(f"Weekday {weekday} not matching.")
             return 0, 0, 0
-    
+
     # Init
     file_path = Path(settings.BASE_DIR / 'core' / 'fixtures' / BUILDING_CSV)
-    admin = get_admin()
-    country = Country.objects.get(alpha3=COUNTRY_DEFAULT)
-    created, updated, deleted = 0, 0, 0
-
-    # db_op
-    if update:
-        db_op = AddressMunicipal.objects.update_or_create
-        db_op_a = Address.objects.update_or_create
-    else:
-        db_op = AddressMunicipal.objects.get_or_create
-        db_op_a = Address.objects.get_or_create
+    if not file_path.exists():
+        file_path = file_path.with_name(BUILDING_CSV + '.zip')
 
     # Get tenants
-    queryset = TenantSetup.objects.filter(is_inactive=False)
+    queryset = TenantSetup.objects.filter(
+        is_inactive=False).select_related('tenant')
     if tenant_id:
         queryset = queryset.filter(tenant__id=tenant_id)
 
-    for tenant_setup in queryset.all():
-        # Open the CSV file
-        with open(file_path, mode='r', encoding='utf-8-sig') as csv_file:
-            csv_reader = csv.DictReader(csv_file, delimiter=';')
-            logger.info(f"Starting {tenant_setup.tenant}")
-
-            # Iterate over each row in the CSV
-            for row in csv_reader:
-                # Prepare data dictionary with relevant fields
-                zip, city = row.pop('ZIP_LABEL').split(' ', 1)
-
-                # Check scope
-                if (int(zip) not in tenant_setup.zips and
-                        int(row['BDG_EGID']) not in tenant_setup.bdg_egids):
-                    continue
-
-                address_data = {
-                    # import
-                    'zip': zip,
-                    'city': city,
-                    'com_fosnr': row['COM_FOSNR'],  # Include COM_FOSNR here
-                    'com_name': row['COM_NAME'],
-                    'com_canton': row['COM_CANTON'],
-                    'stn_label': row['STN_LABEL'],
-                    'adr_number': row['ADR_NUMBER'],
-                    'adr_status': row['ADR_STATUS'],
-                    'adr_official': (
-                        row['ADR_OFFICIAL'].strip().lower() == 'true'),
-                    'adr_modified': parse_date(row['ADR_MODIFIED'].strip()),
-                    'adr_easting': row['ADR_EASTING'],
-                    'adr_northing': row['ADR_NORTHING'],
-                    'bdg_egid': row['BDG_EGID'],
-                    'bdg_category': row['BDG_CATEGORY'],
-                    'bdg_name': (
-                        row['BDG_NAME'].strip()
-                        if row['BDG_NAME'].strip() else None),
-                    'adr_egaid': row['ADR_EGAID'],
-                    'str_esid': row['STR_ESID'],
-
-                    # custom
-                    'created_by': admin
-                }
-
-                # AddressMunicipal
-                address, _created = db_op(
-                    tenant=tenant_setup.tenant,
-                    adr_egaid=address_data.pop('adr_egaid'),
-                    defaults=address_data
-                )
-
-                # Address, we save it as well for further use
-                address_a, _created_a = db_op_a(
-                    tenant=tenant_setup.tenant,
-                    address=f"{row['STN_LABEL']} {row['ADR_NUMBER']}",
-                    zip=zip, city=city, country=country,
-                    defaults={'created_by': admin}
-                )
-
-                # Maintain
-                if _created:
-                    created += 1
-                elif update:
-                    updated += 1
-
-    return created, updated, deleted
+    building_import = BuildingImport(queryset, update)
+    created, updated = building_import.load(file_path)
+    return created, updated, 0
 
 
 def clear_company_addresses():
@@ -338,3 +474,36 @@ def update_address_label():
         address.save()
 
     return addresses.count()
+
+
+def update_address_coordinates(tenant_id=None, chunk_size=5000):
+    ''' fill in missing lat / lon of AddressMunicipal, return count '''
+    queryset = AddressMunicipal.objects.filter(
+        Q(lat=None) | Q(lon=None),
+        adr_easting__isnull=False, adr_northing__isnull=False
+    ).order_by('id').only('id', 'adr_easting', 'adr_northing')
+    if tenant_id:
+        queryset = queryset.filter(tenant__id=tenant_id)
+
+    count = 0
+    last_id = 0
+    while True:
+        # page by id as updated rows drop out of the filter
+        addresses = list(queryset.filter(id__gt=last_id)[:chunk_size])
+        if not addresses:
+            break
+
+        eastings = np.fromiter(
+            (x.adr_easting for x in addresses), dtype=float)
+        northings = np.fromiter(
+            (x.adr_northing for x in addresses), dtype=float)
+        lats, lons = convert_ch1903_to_wgs84_batch(eastings, northings)
+        for address, lat, lon in zip(addresses, lats, lons):
+            address.lat, address.lon = float(lat), float(lon)
+
+        AddressMunicipal.objects.bulk_update(addresses, ['lat', 'lon'])
+        count += len(addresses)
+        last_id = addresses[-1].id
+        logger.info(f"{count} coordinates updated.")
+
+    return count
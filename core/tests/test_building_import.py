@@ -0,0 +1,119 @@
+# core/tests/test_building_import.py
+import csv
+import tempfile
+import zipfile
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from core.models import (
+    Address, AddressMunicipal, Country, Tenant, TenantSetup)
+from core.process import BuildingImport
+
+HEADER = [
+    'ZIP_LABEL', 'COM_FOSNR', 'COM_NAME', 'COM_CANTON', 'STN_LABEL',
+    'ADR_NUMBER', 'ADR_STATUS', 'ADR_OFFICIAL', 'ADR_MODIFIED',
+    'ADR_EASTING', 'ADR_NORTHING', 'BDG_EGID', 'BDG_CATEGORY', 'BDG_NAME',
+    'ADR_EGAID', 'STR_ESID']
+
+
+def make_row(zip_label, egaid, egid, number, status='real'):
+    return [
+        zip_label, '2578', 'Gunzgen', 'SO', 'Markstrasse', number, status,
+        'true', '15.11.2024', '2630000', '1240000', str(egid), '', '',
+        str(egaid), '1']
+
+
+class BuildingImportTests(TestCase):
+    '''
+    python manage.py test core.tests.test_building_import
+
+    tenant a: zip 4617, tenant b: zip 4618 and building 100 in 4617
+    '''
+    def setUp(self):
+        self.admin = User.objects.create(username='admin')
+        Country.objects.create(
+            alpha2='CH', alpha3='CHE', name={'de': 'Schweiz'},
+            is_default=True, created_by=self.admin)
+        self.tenant_a = self.make_tenant('a', zips=[4617])
+        self.tenant_b = self.make_tenant('b', zips=[4618], bdg_egids=[100])
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        self.rows = [
+            make_row('4617 Gunzgen', 1, 100, '12'),
+            make_row('4617 Gunzgen', 2, 101, ''),  # no house number
+            make_row('4618 Boningen', 3, 102, '5'),
+            make_row('9999 Anderswo', 4, 103, '1'),  # no tenant
+        ]
+
+    def make_tenant(self, code, **setup):
+        tenant = Tenant.objects.create(
+            name=code, code=code, created_by=self.admin)
+        TenantSetup.objects.filter(tenant=tenant).update(**setup)
+        return tenant
+
+    def write_csv(self, rows, name='buildings.csv'):
+        file_path = self.directory / name
+        with open(file_path, 'w', encoding='utf-8-sig', newline='') as file:
+            writer = csv.writer(file, delimiter=';')
+            writer.writerow(HEADER)
+            writer.writerows(rows)
+        return file_path
+
+    def load(self, file_path, update=True):
+        tenant_setups = TenantSetup.objects.select_related('tenant')
+        return BuildingImport(tenant_setups, update=update).load(file_path)
+
+    def get_egaids(self, tenant):
+        return sorted(AddressMunicipal.objects.filter(
+            tenant=tenant).values_list('adr_egaid', flat=True))
+
+    def test_create(self):
+        self.assertEqual(self.load(self.write_csv(self.rows)), (4, 0))
+
+        # building 100 belongs to both tenants
+        self.assertEqual(self.get_egaids(self.tenant_a), [1, 2])
+        self.assertEqual(self.get_egaids(self.tenant_b), [1, 3])
+
+        address = AddressMunicipal.objects.get(
+            tenant=self.tenant_a, adr_egaid=2)
+        self.assertEqual(address.adr_number, '')
+        self.assertIsNone(address.bdg_name)
+        self.assertEqual(address.zip, 4617)
+        self.assertIsNotNone(address.lat)
+        self.assertTrue(Address.objects.filter(
+            zip='4617', address='Markstrasse 12').exists())
+
+    def test_update(self):
+        self.load(self.write_csv(self.rows))
+        self.rows[0] = make_row('4617 Gunzgen', 1, 100, '12', 'historical')
+
+        # unchanged rows, incl. the empty number, are not updated
+        self.assertEqual(self.load(self.write_csv(self.rows)), (0, 2))
+        self.assertEqual(set(AddressMunicipal.objects.filter(
+            adr_egaid=1).values_list('adr_status', flat=True)),
+            {'historical'})
+        self.assertEqual(AddressMunicipal.objects.get(
+            tenant=self.tenant_a, adr_egaid=2).adr_number, '')
+
+    def test_no_update(self):
+        self.load(self.write_csv(self.rows))
+        self.rows[0] = make_row('4617 Gunzgen', 1, 100, '12', 'historical')
+        self.rows.append(make_row('4617 Gunzgen', 5, 104, '14'))
+
+        self.assertEqual(
+            self.load(self.write_csv(self.rows), update=False), (1, 0))
+        self.assertEqual(AddressMunicipal.objects.get(
+            tenant=self.tenant_a, adr_egaid=1).adr_status, 'real')
+
+    def test_zip(self):
+        csv_path = self.write_csv(self.rows)
+        zip_path = self.directory / 'buildings.csv.zip'
+        with zipfile.ZipFile(zip_path, 'w') as archive:
+            archive.write(csv_path, csv_path.name)
+
+        self.assertEqual(self.load(zip_path), (4, 0))
+        self.assertEqual(self.get_egaids(self.tenant_b), [1, 3])
@@ -0,0 +1,32 @@
+import numpy as np
+from django.test import SimpleTestCase
+
+from scerp.mixins import (
+    convert_ch1903_to_wgs84, convert_ch1903_to_wgs84_batch,
+    get_transformer_ch1903_to_wgs84)
+
+
+class CoordinatesTest(SimpleTestCase):
+    '''
+    python manage.py test core.tests.test_coordinates
+    '''
+    def test_transformer_cached(self):
+        self.assertIs(
+            get_transformer_ch1903_to_wgs84(),
+            get_transformer_ch1903_to_wgs84())
+
+    def test_batch_same_as_single(self):
+        eastings = np.array([2600000, 2635000, 2683000])
+        northings = np.array([1200000, 1244000, 1248000])
+        lats, lons = convert_ch1903_to_wgs84_batch(eastings, northings)
+        for easting, northing, lat, lon in zip(
+                eastings, northings, lats, lons):
+            lat_single, lon_single = convert_ch1903_to_wgs84(
+                easting, northing)
+            self.assertAlmostEqual(lat, lat_single)
+            self.assertAlmostEqual(lon, lon_single)
+
+    def test_bern(self):
+        lat, lon = convert_ch1903_to_wgs84(2600000, 1200000)
+        self.assertAlmostEqual(lat, 46.951, places=3)
+        self.assertAlmostEqual(lon, 7.439, places=3)
@@ -73,7 +73,7 @@ def export_excel(modeladmin, request, queryset, data):
         # Create excel
         excel = ExportExcel(
             modeladmin, request, queryset, file_name, 
-            ws_title, header, footer, orientation)
+            ws_title, header, footer, orientation, data.get('stream'))
         response = excel.generate_response(col_widths)
         
         return response
@@ -86,7 +86,8 @@ def export_json(modeladmin, request, queryset, data):
         file_name = data['file_name']        
         
         # Create json
-        json_ = ExportJSON(modeladmin, request, queryset, file_name)
+        json_ = ExportJSON(
+            modeladmin, request, queryset, file_name, data.get('stream'))
         response = json_.generate_response()
         
         return response
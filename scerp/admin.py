@@ -9,8 +9,11 @@ Helpers for admin.py
 import json
 import openpyxl
 import re
+import tempfile
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font
 from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.worksheet import Worksheet
 from bs4 import BeautifulSoup
 from datetime import datetime, date
 from decimal import Decimal
@@ -19,7 +22,7 @@ from django.conf import settings
 from django.contrib import admin, messages
 from django.core.exceptions import ValidationError
 from django.forms import Textarea
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.db.models import TextChoices
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
@@ -270,12 +273,19 @@ class Display:
 
 
 class Export:
+    CHUNK_SIZE = 2000  # rows fetched per query if streamed
+    STREAM_MIN_COUNT = 10000  # suggest streaming in forms from this count
 
-    def __init__(self, modeladmin, request, queryset, filename):
+    def __init__(self, modeladmin, request, queryset, filename, stream=False):
+        '''
+        stream: iterate queryset in chunks and write rows as they come,
+            memory stays flat for large exports
+        '''
         self.modeladmin = modeladmin
         self.request = request
         self.queryset = queryset
         self.filename = filename
+        self.stream = stream
 
     def make_headers(self, headers, data=[]):
         # Convert headers if necessary
@@ -305,42 +315,66 @@ class Export:
             return value
         return force_str(value)
 
-    def get_data(self):
-        ''' get data from modeladmin queryset if not specified in modeladmin
-        '''
+    def get_queryset(self):
+        ''' queryset with related objects of list_display loaded at once '''
+        model = self.queryset.model
+        select, prefetch = set(), set()
+        for fieldname in self.modeladmin.list_display:
+            field, *sub_fields = fieldname.split('__')
+            if sub_fields:
+                relation = model._meta.get_field(field)
+                if relation.many_to_one or relation.one_to_one:
+                    select.add(field)
+            elif fieldname.startswith('display_attachment'):
+                prefetch.add('attachments')
+
+        queryset = self.queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+    def get_row(self, item):
+        item_list = []
+        for fieldname in self.modeladmin.list_display:
+            field, *sub_fields = fieldname.split('__')
+            if len(sub_fields) > 1:
+                raise ValueError("Can only output one foreign key")
+            elif sub_fields:
+                value_parent = getattr(item, field)
+                value = getattr(value_parent, sub_fields[0])
+            elif fieldname == 'display_is_inactive':
+                value = item.is_inactive
+            elif fieldname == 'display_is_protected':
+                value = item.is_protected
+            elif fieldname.startswith('display_notes'):
+                value = item.notes
+            elif fieldname.startswith('display_attachment'):
+                value = bool(item.attachments.all())  # prefetched
+            elif fieldname.startswith('display'):
+                value = getattr(self.modeladmin, fieldname)(item)
+            else:
+                value = getattr(item, field)
+            item_list.append(self.clean_value(value))
+        return item_list
+
+    def iter_data(self):
+        ''' yield rows, queryset is read in chunks if streamed '''
         # Check if existing
         func = getattr(self.modeladmin, 'get_data', None)
         if func:
-            data_list = func(self.request, self.queryset)
+            yield from func(self.request, self.queryset)
+            return
 
-        # Create list
-        else:
-            data_list = []
-            for item in self.queryset.all():
-                item_list = []
-                for fieldname in self.modeladmin.list_display:
-                    field, *sub_fields = fieldname.split('__')
-                    if len(sub_fields) > 1:
-                        raise ValueError("Can only output one foreign key")
-                    elif sub_fields:
-                        value_parent = getattr(item, field)
-                        value = getattr(value_parent, sub_fields[0])
-                    elif fieldname == 'display_is_inactive':
-                        value = item.is_inactive
-                    elif fieldname == 'display_is_protected':
-                        value = item.is_protected
-                    elif fieldname.startswith('display_notes'):
-                        value = item.notes
-                    elif fieldname.startswith('display_attachment'):
-                        value = item.attachments.exists()
-                    elif fieldname.startswith('display'):
-                        value = getattr(self.modeladmin, fieldname)(item)
-                    else:
-                        value = getattr(item, field)
-                    item_list.append(self.clean_value(value))
-                data_list.append(item_list)
-
-        return data_list
+        queryset = self.get_queryset()
+        if self.stream:
+            queryset = queryset.iterator(chunk_size=self.CHUNK_SIZE)
+        for item in queryset:
+            yield self.get_row(item)
+
+    def get_data(self):
+        ''' get data from modeladmin queryset if not specified in modeladmin
+        '''
+        return list(self.iter_data())
 
     def get_headers(self):
         ''' get headers from modeladmin queryset if not specified in modeladmin
@@ -376,31 +410,46 @@ class ExportExcel(Export):
     '''
     def __init__(
             self, modeladmin, request, queryset, filename='output.xlsx',
-            ws_title='Exported Data', header={}, footer={}, orientation=None):
+            ws_title='Exported Data', header={}, footer={}, orientation=None,
+            stream=False):
         '''
         Args:
             filename (str): Name of the exported file.
             title (str): worksheet title
             header (dict)
             footer (dict)
+            stream (bool): write only workbook, saved to a temporary file
         '''
-        super().__init__(modeladmin, request, queryset, filename)
+        super().__init__(modeladmin, request, queryset, filename, stream)
         self.ws_title = ws_title
         self.header = header
         self.footer = footer
         self.orientation = (
             orientation if orientation else PAGE_ORIENTATION.LANDSCAPE)
 
+    CONTENT_TYPE = (
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+    def set_col_widths(self, ws, headers, col_widths=None):
+        for col_num, header in enumerate(headers, 1):
+            col_letter = get_column_letter(col_num)
+            if col_widths and len(col_widths) >= col_num:
+                ws.column_dimensions[col_letter].width = (
+                    col_widths[col_num - 1])
+            else:
+                ws.column_dimensions[col_letter].width = (
+                    max(len(str(header)) + 2, 12))
+
     def set_layout(self, ws):
         # A4 Page Setup
         # Set to A4 paper size
-        ws.page_setup.paperSize = ws.PAPERSIZE_A4
+        ws.page_setup.paperSize = Worksheet.PAPERSIZE_A4
 
         # Landscape mode for better readability
         if self.orientation == PAGE_ORIENTATION.LANDSCAPE:
             ws.page_setup.orientation = PAGE_ORIENTATION.LANDSCAPE
         elif self.orientation == PAGE_ORIENTATION.PORTRAIT:
-            ws.page_setup.orientation = ws.ORIENTATION_PORTRAIT
+            ws.page_setup.orientation = Worksheet.ORIENTATION_PORTRAIT
         else:
             raise ValueError(_("No valid page orientation"))
 
@@ -440,6 +489,9 @@ class ExportExcel(Export):
         Returns:
             HttpResponse: Excel file as an HTTP response.
         '''
+        if self.stream:
+            return self.generate_response_stream(col_widths, headers, data)
+
         # Create a new workbook & worksheet
         wb = openpyxl.Workbook()
         ws = wb.active
@@ -461,38 +513,65 @@ class ExportExcel(Export):
             ws.append(row)
 
         # Adjust Column Widths
-        for col_num, header in enumerate(headers, 1):
-            col_letter = get_column_letter(col_num)
-            if col_widths and len(col_widths) >= col_num:
-                ws.column_dimensions[col_letter].width = (
-                    col_widths[col_num - 1])
-            else:
-                ws.column_dimensions[col_letter].width = (
-                    max(len(str(header)) + 2, 12))
+        self.set_col_widths(ws, headers, col_widths)
 
         # Prepare HTTP Response
-        response = HttpResponse(
-            content_type=(
-                'application/vnd.openxmlformats-officedocument'
-                '.spreadsheetml.sheet')
-        )
+        response = HttpResponse(content_type=self.CONTENT_TYPE)
         response['Content-Disposition'] = (
             f"attachment; filename={self.filename}")
         wb.save(response)
 
         return response
 
+    def generate_response_stream(self, col_widths=None, headers=[], data=[]):
+        '''
+        Same as generate_response but rows are written as they are read
+        (openpyxl write only mode) to a temporary file that gets streamed
+        '''
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet(self.ws_title)
+        self.set_layout(ws)
+
+        # Column widths must be set before the first row
+        headers = headers if headers else self.get_headers()
+        self.set_col_widths(ws, headers, col_widths)
+
+        # Make headers bold
+        bold_font = Font(bold=True)
+        cells = []
+        for header in headers:
+            cell = WriteOnlyCell(ws, value=header)
+            cell.font = bold_font
+            cells.append(cell)
+        ws.append(cells)
+
+        # Get data and write in Rows
+        for row in (data if data else self.iter_data()):
+            ws.append(row)
+
+        # File is deleted when closed by the response
+        file = tempfile.TemporaryFile(suffix='.xlsx')
+        wb.save(file)
+        file.seek(0)
+
+        return FileResponse(
+            file, as_attachment=True, filename=self.filename,
+            content_type=self.CONTENT_TYPE)
+
 
 class ExportJSON(Export):
     '''
     Generates an JSON file from provided data
     '''
-    def __init__(self, modeladmin, request, queryset, filename='output.json'):
+    def __init__(
+            self, modeladmin, request, queryset, filename='output.json',
+            stream=False):
         '''
         Args:
             filename (str): Name of the exported file. Will
+            stream (bool): serialize and send row by row
         '''
-        super().__init__(modeladmin, request, queryset, filename)
+        super().__init__(modeladmin, request, queryset, filename, stream)
 
     def generate_response(self):
         '''
@@ -507,17 +586,22 @@ class ExportJSON(Export):
         # Convert headers if necessary
         headers = self.get_headers()
 
-        # Clean data and make list of dicts
-        data_list = self.get_data()
-        data = [dict(zip(headers, x)) for x in data_list]
+        if self.stream:
+            response = StreamingHttpResponse(
+                self.iter_json(headers),
+                content_type='application/json; charset=utf-8')
+        else:
+            # Clean data and make list of dicts
+            data_list = self.get_data()
+            data = [dict(zip(headers, x)) for x in data_list]
 
-        # Create json
-        json_data = json.dumps(data, ensure_ascii=False)
+            # Create json
+            json_data = json.dumps(data, ensure_ascii=False)
 
-        # Create the HTTP response and set the appropriate content type with
-        # UTF-8 charset
-        response = HttpResponse(
-            json_data, content_type='application/json; charset=utf-8')
+            # Create the HTTP response and set the appropriate content type
+            # with UTF-8 charset
+            response = HttpResponse(
+                json_data, content_type='application/json; charset=utf-8')
 
         # Define the file name for the download (you can customize it as needed)
         response['Content-Disposition'] = (
@@ -525,6 +609,14 @@ class ExportJSON(Export):
 
         return response
 
+    def iter_json(self, headers):
+        ''' same list of dicts as generate_response, one row at a time '''
+        yield '['
+        for nr, row in enumerate(self.iter_data()):
+            yield (',' if nr else '') + json.dumps(
+                dict(zip(headers, row)), ensure_ascii=False)
+        yield ']'
+
 
 # Decorators
 class BaseAdmin:
@@ -559,8 +651,8 @@ class BaseAdmin:
     @admin.display(description='Fi')
     def display_attachment_icon(self, obj):
         '''Displays a paperclip 📎 or folder 📂 icon if attachments exist.'''
-        if obj.attachments.exists():  # ✅ Efficient query
-            url = obj.get_attachment_link(nr=1)
+        url = obj.get_attachment_link(nr=1)  # uses prefetched attachments
+        if url:
             link = f'<a href="{url}" target="_blank">📎</a>'
             return mark_safe(link)
         return ' '  # No icon if no attachments'
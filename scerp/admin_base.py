@@ -9,6 +9,7 @@ from django.conf import settings
 from django.contrib import admin, messages
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError, transaction
+from django.db.models import prefetch_related_objects
 from django.http import HttpResponseRedirect
 from django.utils.translation import gettext_lazy as _
 
@@ -90,8 +91,11 @@ class TenantFilteringAdmin(admin.ModelAdmin):
     '''
     A base admin class that handles tenant filtering efficiently.
     '''
-    protected_foreigns = []  # ForeignKey optimization fields
+    protected_foreigns = []  # ForeignKey optimization fields, nested paths
     protected_many_to_many = []  # ManyToMany optimization fields
+    protected_prefetches = []  # Prefetch objects or reverse relations
+    protected_object_prefetches = []  # same, for the change view only
+    protected_annotations = {}  # name: expression, e.g. counts for display
     has_errors = False
 
     def get_tenant_id(self, request):
@@ -129,9 +133,22 @@ class TenantFilteringAdmin(admin.ModelAdmin):
             queryset = queryset.select_related(*self.protected_foreigns)
         if self.protected_many_to_many:
             queryset = queryset.prefetch_related(*self.protected_many_to_many)
+        if self.protected_prefetches:
+            queryset = queryset.prefetch_related(*self.protected_prefetches)
+        if self.protected_annotations:
+            queryset = queryset.annotate(**self.protected_annotations)
 
         return queryset
 
+    def get_object(self, request, object_id, from_field=None):
+        '''
+        Prefetch relations of the change view, not of every list page.
+        '''
+        obj = super().get_object(request, object_id, from_field)
+        if obj is not None and self.protected_object_prefetches:
+            prefetch_related_objects([obj], *self.protected_object_prefetches)
+        return obj
+
     """    
     def get_readonly_fields(self, request, obj=None):
         ''' open change_form in read_only mode in default '''
@@ -5,7 +5,7 @@ from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django_admin_action_forms import AdminActionForm
 
-from scerp.admin import PAGE_ORIENTATION, verbose_name_plural
+from scerp.admin import Export, PAGE_ORIENTATION, verbose_name_plural
 from .admin import verbose_name_field, get_help_text, is_required_field
 
 
@@ -124,6 +124,11 @@ class ExportExcelActionForm(AdminActionForm):
     footer_right = forms.CharField(
         label=_('Footer right'), max_length=100, required=False)
 
+    # Large exports
+    stream = forms.BooleanField(
+        label=_('Stream'), required=False,
+        help_text=_("Write rows as they are read, use for large exports"))
+
 
     class Meta:
         help_text = _("{count} records selected.")
@@ -133,10 +138,11 @@ class ExportExcelActionForm(AdminActionForm):
         name_plural = verbose_name_plural(modeladmin.model)
         tenant = queryset.first().tenant
 
-        self.Meta.help_text = self.Meta.help_text.format(
-            count=queryset.count())
+        count = queryset.count()
+        self.Meta.help_text = self.Meta.help_text.format(count=count)
 
         self.fields['file_name'].initial = f'{name_plural}_{date}.xlsx'
+        self.fields['stream'].initial = count >= Export.STREAM_MIN_COUNT
         self.fields['worksheet_name'].initial = name_plural
         self.fields['col_widths'].initial = getattr(
             modeladmin, 'col_widths', '')
@@ -158,6 +164,11 @@ class ExportJSONActionForm(AdminActionForm):
     file_name = forms.CharField(
         label=_('Filename'), max_length=100)
 
+    # Large exports
+    stream = forms.BooleanField(
+        label=_('Stream'), required=False,
+        help_text=_("Write rows as they are read, use for large exports"))
+
     class Meta:
         help_text = _("{count} records selected.")
 
@@ -165,7 +176,8 @@ class ExportJSONActionForm(AdminActionForm):
         date = timezone.now().date()
         name_plural = verbose_name_plural(modeladmin.model)        
 
-        self.Meta.help_text = self.Meta.help_text.format(
-            count=queryset.count())
+        count = queryset.count()
+        self.Meta.help_text = self.Meta.help_text.format(count=count)
 
         self.fields['file_name'].initial = f'{name_plural}_{date}.json'
+        self.fields['stream'].initial = count >= Export.STREAM_MIN_COUNT
@@ -8,12 +8,16 @@ import secrets
 import string
 import yaml
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 from openpyxl import load_workbook
 
+import numpy as np
+
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
 from django.db import transaction
 from django.utils import timezone
 from django.utils.text import slugify
@@ -121,17 +125,38 @@ def safe_round(val, digits):
 
 
 # A function to convert Swiss coordinates to WGS84 (latitude/longitude)
+@lru_cache(maxsize=None)
+def get_transformer_ch1903_to_wgs84():
+    ''' building a transformer takes ms, build it once per process '''
+    # LV95 to WGS84
+    return pyproj.Transformer.from_crs(
+        'EPSG:2056', 'EPSG:4326', always_xy=True)
+
+
 def convert_ch1903_to_wgs84(easting, northing):
     try:
-        # LV95 to WGS84
-        transformer = pyproj.Transformer.from_crs(
-            'EPSG:2056', 'EPSG:4326', always_xy=True)
+        transformer = get_transformer_ch1903_to_wgs84()
         lon, lat = transformer.transform(easting, northing)
         return lat, lon
     except Exception as e:
         raise ValidationError(f"Error converting coordinates: {e}")
 
 
+def convert_ch1903_to_wgs84_batch(eastings, northings):
+    ''' convert arrays of coordinates at once
+        eastings, northings: numpy arrays or lists
+        return lats, lons as numpy arrays
+    '''
+    try:
+        transformer = get_transformer_ch1903_to_wgs84()
+        lons, lats = transformer.transform(
+            np.asarray(eastings, dtype=float),
+            np.asarray(northings, dtype=float))
+        return lats, lons
+    except Exception as e:
+        raise ValidationError(f"Error converting coordinates: {e}")
+
+
 def format_date(date, format='%d.%m.%Y'):
     formatted_date = date.strftime(format)
     return formatted_date
@@ -331,3 +356,94 @@ def find_first_match_in_nested_dict(data, key, value):
             if result:
                 return result
     return None
+
+
+def index_nested_dict(data, keys):
+    '''index all dicts in a nested dict by the values of keys, e.g.
+    data: complex dict
+    keys: ['accountId', 'id']
+    returns {'accountId': {125: {...}, ..}, 'id': {'category-985': {...}}}
+
+    One traversal in the same order as find_first_match_in_nested_dict,
+    so index[key].get(value) returns the same dict but in O(1).
+    '''
+    index = {key: {} for key in keys}
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            for key in keys:
+                value = node.get(key)
+                if value is not None:
+                    index[key].setdefault(value, node)
+            stack.extend(reversed(list(node.values())))
+        elif isinstance(node, list):
+            stack.extend(reversed(node))
+    return index
+
+
+class PrefixTrie:
+    '''trie over codes like functions '0', '01', '011' or hrm '3000.01'
+    lookups take O(length of code), e.g.
+        trie = PrefixTrie([('0', 1), ('011', 2)])
+        trie.longest_prefix('0110')  # 2
+        trie.descendants('0')  # [2]
+    '''
+    VALUE = None  # key of the value in a node, codes have no None chars
+
+    def __init__(self, items=()):
+        self.root = {}
+        for code, value in items:
+            self.add(code, value)
+
+    def _find(self, code):
+        node = self.root
+        for char in code:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node
+
+    def add(self, code, value):
+        node = self.root
+        for char in code:
+            node = node.setdefault(char, {})
+        node[self.VALUE] = value
+
+    def get(self, code, default=None):
+        node = self._find(code)
+        return default if node is None else node.get(self.VALUE, default)
+
+    def remove(self, code):
+        node = self._find(code)
+        if node:
+            node.pop(self.VALUE, None)
+
+    def longest_prefix(self, code, proper=True):
+        ''' value of the longest code being a prefix of code,
+            proper: code itself is not considered
+        '''
+        node, value = self.root, None
+        length = len(code) - 1 if proper else len(code)
+        for char in code[:length]:
+            node = node.get(char)
+            if node is None:
+                break
+            value = node.get(self.VALUE, value)
+        return value
+
+    def descendants(self, code):
+        ''' values of all codes starting with code, without code itself '''
+        node = self._find(code)
+        if node is None:
+            return []
+        values, stack = [], [
+            child for key, child in node.items() if key is not self.VALUE]
+        while stack:
+            node = stack.pop()
+            for key, child in node.items():
+                if key is self.VALUE:
+                    values.append(child)
+                else:
+                    stack.append(child)
+        return values
@@ -248,3 +248,6 @@ APPLICATION_NAME = 'SC-ERP'
 ADMIN_ACCESS_ALL = True  # Admin can access all clients
 LOGO = '/static/img/default-logo.png'
 PASSWORD_LENGTH = 16  # needed to generate generate random password
+
+# cashCtrl, True: signals write to outbox, see accounting/outbox.py
+CASH_CTRL_SYNC_ASYNC = env.bool("CASH_CTRL_SYNC_ASYNC", default=True)